@@ -0,0 +1,650 @@
+#!/usr/bin/env python3
+"""Hermetic benchmark for install_packages.py.
+
+Runs the installer against stand-in package managers in a throwaway HOME and
+reports wall time, the number of tool invocations and peak RSS per scenario.
+Nothing touches the network or the real system: apt, dpkg, brew, winget,
+cargo, fish, oh-my-posh, curl and fc-cache are shims (this same file, run
+through small wrapper scripts) with configurable latency and failure rates, and the
+rustup/oh-my-posh/font downloads come from a local --mirror.
+
+    python3 bench/bench_install.py
+    python3 bench/bench_install.py --scenario fresh --scenario large --repeat 3
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import hashlib
+import argparse
+import zipfile
+import tempfile
+import subprocess
+import statistics
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Files copied into the throwaway checkout the installer runs from
+REPO_FILES = ["install_packages.py", "gitconfig", "prompt.omp.json", ".wezterm.lua", "fish", "zsh"]
+
+# Logical tool names and ordering hints from the real manifest
+with open(os.path.join(REPO_DIR, "packages.json"), "r", encoding="utf-8") as f:
+    REPO_TOOLS = json.load(f).get("tools", {})
+
+# Tools that are always on PATH
+SHIM_TOOLS = ["sudo", "apt", "apt-get", "dpkg", "dpkg-query", "brew", "winget", "fish", "curl", "fc-cache"]
+
+# Tools that only appear once the installer has installed them
+INSTALLED_TOOLS = ["cargo", "oh-my-posh"]
+
+# Real system tools the installer and the shims need; nothing else from the
+# host PATH is visible, so a real cargo or apt can never leak into a run
+SYSTEM_TOOLS = ["sh", "bash", "env", "mkdir", "ln", "rm", "cat", "chmod", "dirname", "realpath", "sleep"]
+
+# Seconds per call and per package/crate handled by that call
+DEFAULT_LATENCY = {
+    "apt": [0.5, 0.1],
+    "apt-get": [0.5, 0.1],
+    "dpkg-query": [0.05, 0],
+    "dpkg": [0.05, 0],
+    "brew": [1.0, 0.3],
+    "winget": [1.0, 0.5],
+    "cargo": [0.1, 1.5],
+    "fish": [0.05, 0],
+    "oh-my-posh": [0.05, 0],
+    "curl": [0.2, 0],
+    "fc-cache": [0.1, 0],
+}
+
+LINUX_MANIFEST = {
+    "pkg": ["bat", "fish", "git", "bat", "hub", "zoxide", "fd", "micro", "curl", "build-essential"],
+    "cargo": ["eza", "fnm", "delta"],
+    "oh_my_posh": True,
+}
+
+
+# --- Shims -----------------------------------------------------------------
+
+def _shim_config():
+    try:
+        with open(os.environ["BENCH_CONFIG"], "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (KeyError, OSError, ValueError):
+        return {}
+
+def _shim_sleep(config, tool, items=0):
+    fixed, per_item = config.get("latency", DEFAULT_LATENCY).get(tool, [0, 0])
+    time.sleep((fixed + per_item * items) * config.get("scale", 1.0))
+
+def _shim_fails(config, tool, item):
+    """Decides deterministically whether a package or crate fails to install."""
+    if item in config.get("fail", {}).get(tool, []):
+        return True
+    rate = config.get("failure_rate", {}).get(tool, 0)
+    if not rate:
+        return False
+    digest = hashlib.sha256(f"{config.get('seed', 0)}:{tool}:{item}".encode()).hexdigest()
+    return int(digest[:8], 16) / 0xFFFFFFFF < rate
+
+def _state_file(manager):
+    state_dir = os.path.join(os.environ["HOME"], ".bench-state")
+    os.makedirs(state_dir, exist_ok=True)
+    return os.path.join(state_dir, f"{manager}.installed")
+
+def _shim_locked(config, tool):
+    """Simulates another process holding the lock for the first N calls of a manager."""
+    limit = config.get("locked_calls", {}).get(tool, 0)
+    if not limit:
+        return False
+    counter = _state_file(f"{tool}.lock-calls")
+    calls = os.path.getsize(counter) if os.path.exists(counter) else 0
+    with open(counter, "a", encoding="utf-8") as f:
+        f.write(".")
+    return calls < limit
+
+def _installed(manager):
+    try:
+        with open(_state_file(manager), "r", encoding="utf-8") as f:
+            return [line.strip() for line in f if line.strip()]
+    except OSError:
+        return []
+
+# Binaries that packages install under a different name
+PACKAGE_BINARIES = {"fd-find": "fdfind", "build-essential": "make", "git-delta": "delta"}
+
+def _mark_installed(manager, item):
+    with open(_state_file(manager), "a", encoding="utf-8") as f:
+        f.write(f"{item}\n")
+    # A stub binary for the installer's health checks; crates go where cargo puts them
+    if manager in ("apt", "brew", "cargo"):
+        bin_dir = (os.path.join(os.environ["HOME"], ".cargo", "bin") if manager == "cargo"
+                   else os.environ["BENCH_INSTALLED_BIN"])
+        os.makedirs(bin_dir, exist_ok=True)
+        path = os.path.join(bin_dir, PACKAGE_BINARIES.get(item, item))
+        if not os.path.exists(path):
+            with open(path, "w", encoding="utf-8") as f:
+                f.write(f'#!/bin/sh\necho "{item} 1.0.0"\n')
+            os.chmod(path, 0o755)
+
+def _is_outdated(config, manager, item):
+    """Whether an installed package or crate has a newer version the installer has not upgraded to yet."""
+    return item in config.get("outdated", {}).get(manager, []) and item not in _installed(f"{manager}-upgraded")
+
+def _positional(args):
+    positional, skip = [], False
+    for arg in args:
+        if skip:
+            skip = False
+        elif arg == "-o":
+            # apt's -o takes a configuration value
+            skip = True
+        elif not arg.startswith("-"):
+            positional.append(arg)
+    return positional
+
+def _shim_apt(config, tool, args):
+    if args[:1] == ["list"]:
+        _shim_sleep(config, tool)
+        print("Listing... Done")
+        if "--upgradable" in args:
+            for package in _installed("apt"):
+                if _is_outdated(config, "apt", package):
+                    print(f"{package}/stable-updates 2.0-1 amd64 [upgradable from: 1.0-1]")
+        return 0
+    packages = _positional(args[1:])
+    if _shim_locked(config, "apt"):
+        print("E: Could not get lock /var/lib/dpkg/lock-frontend. It is held by process 4242 (unattended-upgr)",
+              file=sys.stderr)
+        print("E: Unable to acquire the dpkg frontend lock (/var/lib/dpkg/lock-frontend), "
+              "is another process using it?", file=sys.stderr)
+        return 100
+    _shim_sleep(config, tool, len(packages))
+    # apt resolves the whole transaction up front and aborts it on any bad package
+    for package in packages:
+        if _shim_fails(config, "apt", package):
+            print(f"E: Unable to locate package {package}", file=sys.stderr)
+            return 100
+    installed = _installed("apt")
+    for package in packages:
+        if package in installed and "--only-upgrade" in args and _is_outdated(config, "apt", package):
+            print(f"Unpacking {package} (2.0-1) over (1.0-1) ...")
+            _mark_installed("apt-upgraded", package)
+        elif package in installed:
+            print(f"{package} is already the newest version (1.0-1).")
+        elif "--download-only" not in args:
+            print(f"Unpacking {package} (1.0-1) ...")
+            print(f"Setting up {package} (1.0-1) ...")
+            _mark_installed("apt", package)
+            installed.append(package)
+    return 0
+
+def _shim_dpkg_query(config, tool, args):
+    _shim_sleep(config, tool)
+    for package in _installed("apt"):
+        print(f"{package}\tinstall ok installed")
+    return 0
+
+def _shim_dpkg(config, tool, args):
+    _shim_sleep(config, tool)
+    packages = _positional(args)
+    return 0 if packages and all(package in _installed("apt") for package in packages) else 1
+
+def _shim_brew(config, tool, args):
+    command = args[:1]
+    if command == ["--version"]:
+        print("Homebrew 4.0.0")
+        return 0
+    if command == ["list"]:
+        _shim_sleep(config, tool)
+        names = _positional(args[1:])
+        if names:
+            return 0 if all(name in _installed("brew") for name in names) else 1
+        if "--cask" not in args:
+            for package in _installed("brew"):
+                print(f"{package} 1.0")
+        return 0
+    if command in (["install"], ["fetch"], ["upgrade"]):
+        packages = _positional(args[1:])
+        _shim_sleep(config, tool, len(packages))
+        status = 0
+        installed = _installed("brew")
+        # brew carries on past a bad formula and reports failure at the end
+        for package in packages:
+            if _shim_fails(config, "brew", package):
+                print(f'Error: No available formula with the name "{package}".', file=sys.stderr)
+                status = 1
+            elif package in installed and command == ["upgrade"] and _is_outdated(config, "brew", package):
+                print(f"==> Upgrading {package} 1.0 -> 2.0")
+                _mark_installed("brew-upgraded", package)
+            elif package in installed:
+                print(f"Warning: {package} 1.0 is already installed and up-to-date.", file=sys.stderr)
+            elif command != ["fetch"]:
+                print(f"==> Pouring {package}--1.0.bottle.tar.gz")
+                _mark_installed("brew", package)
+        return status
+    if command == ["outdated"]:
+        _shim_sleep(config, tool)
+        formulae = [{"name": package, "installed_versions": ["1.0"], "current_version": "2.0"}
+                    for package in _installed("brew") if _is_outdated(config, "brew", package)]
+        print(json.dumps({"formulae": formulae, "casks": []}))
+        return 0
+    return 0
+
+def _shim_winget(config, tool, args):
+    command = args[:1]
+    if command == ["--version"]:
+        print("v1.7.0")
+        return 0
+    _shim_sleep(config, tool, 1 if command == ["install"] else 0)
+    if command == ["install"]:
+        package = args[args.index("--id") + 1] if "--id" in args else _positional(args[1:])[0]
+        if _shim_fails(config, "winget", package):
+            print(f"No package found matching input criteria: {package}")
+            return -1978335212
+        if package in _installed("winget"):
+            print("Found an existing package already installed.")
+            return -1978335189
+        _mark_installed("winget", package)
+        print("Successfully installed")
+        return 0
+    if command == ["list"]:
+        for package in _installed("winget"):
+            print(f"{package}  {package}  1.0")
+        return 0
+    if command == ["export"]:
+        path = args[args.index("-o") + 1]
+        packages = [{"PackageIdentifier": package} for package in _installed("winget")]
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump({"Sources": [{"Packages": packages}]}, f)
+        return 0
+    return 0
+
+def _shim_cargo(config, tool, args):
+    command = args[:1]
+    if command == ["--version"]:
+        print("cargo 1.80.0")
+        return 0
+    if command == ["binstall"]:
+        print("error: no such command: `binstall`", file=sys.stderr)
+        return 101
+    if command == ["install"] and "--list" in args:
+        _shim_sleep(config, tool)
+        for crate in _installed("cargo"):
+            print(f"{crate} v{'0.9.0' if _is_outdated(config, 'cargo', crate) else '1.0.0'}:")
+            print(f"    {crate}")
+        return 0
+    if command == ["install"]:
+        crates = [arg for i, arg in enumerate(args[1:], 1)
+                  if not arg.startswith("-") and args[i - 1] != "--jobs"]
+        for crate in crates:
+            _shim_sleep(config, tool, 1)
+            if _shim_fails(config, "cargo", crate):
+                print(f"error: failed to compile `{crate} v1.0.0`", file=sys.stderr)
+                return 101
+            print(f"   Compiling {crate} v1.0.0")
+            print(f"  Installing {os.environ['HOME']}/.cargo/bin/{crate}")
+            if crate in _installed("cargo"):
+                _mark_installed("cargo-upgraded", crate)
+            else:
+                _mark_installed("cargo", crate)
+        return 0
+    return 0
+
+def _shim_fish(config, tool, args):
+    _shim_sleep(config, tool)
+    if args[:1] == ["--version"]:
+        print("fish, version 3.7.1")
+        return 0
+    return 0
+
+def _shim_oh_my_posh(config, tool, args):
+    _shim_sleep(config, tool)
+    if args[:1] in (["--version"], ["version"]):
+        print("19.0.0")
+    return 0
+
+def _shim_fc_cache(config, tool, args):
+    _shim_sleep(config, tool)
+    return 0
+
+def _shim_curl(config, tool, args):
+    _shim_sleep(config, tool)
+    if args[:1] == ["--version"]:
+        print("curl 8.5.0 (bench)")
+        return 0
+    print(f"curl: (6) network disabled in benchmark: {' '.join(args)}", file=sys.stderr)
+    return 6
+
+def _shim_sudo(config, tool, args):
+    os.execvp(args[0], args)
+
+SHIMS = {
+    "sudo": _shim_sudo,
+    "apt": _shim_apt,
+    "apt-get": _shim_apt,
+    "dpkg-query": _shim_dpkg_query,
+    "dpkg": _shim_dpkg,
+    "brew": _shim_brew,
+    "winget": _shim_winget,
+    "cargo": _shim_cargo,
+    "fish": _shim_fish,
+    "oh-my-posh": _shim_oh_my_posh,
+    "fc-cache": _shim_fc_cache,
+    "curl": _shim_curl,
+}
+
+def run_shim(tool, args):
+    """Entry point when this file is run as the shim for one tool."""
+    log_path = os.environ.get("BENCH_CALL_LOG")
+    if log_path:
+        with open(log_path, "a", encoding="utf-8") as f:
+            f.write(f"{tool} {json.dumps(args)}\n")
+    return SHIMS[tool](_shim_config(), tool, args)
+
+
+# --- Harness ---------------------------------------------------------------
+
+def large_manifest(packages=120, crates=10):
+    """A manifest well past the real one, to show per-package overheads."""
+    return {
+        "pkg": ["curl", "build-essential", "fish"] + [f"bench-pkg-{i:03d}" for i in range(packages)],
+        "cargo": [f"bench-crate-{i:02d}" for i in range(crates)],
+        "oh_my_posh": True,
+    }
+
+SCENARIOS = {
+    "fresh": {
+        "description": "nothing installed yet",
+        "manifest": LINUX_MANIFEST,
+        "config": {},
+        "warmup": False,
+    },
+    "provisioned": {
+        "description": "second run on a fully provisioned machine",
+        "manifest": LINUX_MANIFEST,
+        "config": {},
+        "warmup": True,
+    },
+    "partial-failure": {
+        "description": "one apt package and one crate fail",
+        "manifest": LINUX_MANIFEST,
+        "config": {"fail": {"apt": ["hub"], "cargo": ["git-delta"]}},
+        "warmup": False,
+        # The failed stages and the health checks both fail the run
+        "exit_code": 1,
+        # Run again in the same sandbox: the failures must be retried, not skipped
+        "retried": {"apt": ["hub"], "cargo": ["git-delta"]},
+    },
+    "lock-contention": {
+        "description": "unattended-upgrades holds the dpkg lock for the first two apt calls",
+        "manifest": LINUX_MANIFEST,
+        "config": {"locked_calls": {"apt": 2}},
+        "warmup": False,
+    },
+    "large": {
+        "description": "123 apt packages and 10 crates",
+        "manifest": large_manifest(),
+        "config": {},
+        "warmup": False,
+    },
+    "plan": {
+        "description": "--plan --force on a provisioned machine, cargo only in ~/.cargo/bin",
+        "manifest": LINUX_MANIFEST,
+        "config": {},
+        "warmup": True,
+        "args": ["--plan", "json", "--force"],
+        # Everything is installed, so these stages must plan no actions
+        "plan_idle": ["pkg-prerequisites", "pkg", "cargo"],
+    },
+    "upgrade": {
+        "description": "--upgrade on a provisioned machine with two outdated apt packages and two crates",
+        "manifest": LINUX_MANIFEST,
+        # git-delta is listed as delta, so its lookup goes through the tools table
+        "config": {"outdated": {"apt": ["bat", "git"], "cargo": ["eza", "git-delta"]}},
+        "warmup": True,
+        "args": ["--upgrade"],
+    },
+}
+
+def _crate_index_path(name):
+    if len(name) <= 2:
+        return f"{len(name)}/{name}"
+    if len(name) == 3:
+        return f"3/{name[0]}/{name}"
+    return f"{name[:2]}/{name[2:4]}/{name}"
+
+def resolved_crates(manifest):
+    """The crate IDs the installer works on for a scenario manifest, e.g. git-delta for delta."""
+    # Imported here rather than at the top, so the shims don't pay for it on every call
+    sys.path.insert(0, REPO_DIR)
+    import install_packages
+
+    compiled = install_packages.compile_manifest({"tools": REPO_TOOLS, "Linux": manifest}, None)
+    return compiled["os"]["Linux"]["cargo"] or []
+
+def _link_tool(directory, name):
+    """Writes a wrapper that runs this file as the shim for one tool."""
+    path = os.path.join(directory, name)
+    with open(path, "w", encoding="utf-8") as f:
+        f.write(f'#!/bin/sh\nexec "{sys.executable}" "{os.path.abspath(__file__)}" --shim {name} "$@"\n')
+    os.chmod(path, 0o755)
+    return path
+
+def make_sandbox(root, scenario, latency_scale):
+    """Builds the throwaway checkout, HOME, shim PATH and local mirror for one scenario."""
+    checkout = os.path.join(root, "dotfiles")
+    home = os.path.join(root, "home")
+    shim_bin = os.path.join(root, "shims")
+    system_bin = os.path.join(root, "system")
+    tools = os.path.join(root, "tools")
+    mirror = os.path.join(root, "mirror")
+    # Where the apt and brew shims put the binaries of the packages they install
+    installed_bin = os.path.join(root, "installed")
+    for directory in (checkout, home, shim_bin, system_bin, tools, mirror, installed_bin):
+        os.makedirs(directory)
+    for name in SYSTEM_TOOLS:
+        path = shutil.which(name)
+        if path:
+            os.symlink(path, os.path.join(system_bin, name))
+
+    for name in REPO_FILES:
+        source = os.path.join(REPO_DIR, name)
+        if os.path.isdir(source):
+            shutil.copytree(source, os.path.join(checkout, name), symlinks=True)
+        elif os.path.exists(source):
+            shutil.copy2(source, os.path.join(checkout, name))
+    with open(os.path.join(checkout, "packages.json"), "w", encoding="utf-8") as f:
+        json.dump({"tools": REPO_TOOLS, "Linux": scenario["manifest"]}, f, indent=2)
+
+    for name in SHIM_TOOLS:
+        _link_tool(shim_bin, name)
+    for name in INSTALLED_TOOLS:
+        _link_tool(tools, name)
+
+    # What the installer fetches through its download cache
+    rustup = (
+        "#!/bin/sh\n"
+        'mkdir -p "$HOME/.cargo/bin"\n'
+        f'ln -sf "{tools}/cargo" "$HOME/.cargo/bin/cargo"\n'
+        'echo \'export PATH="$HOME/.cargo/bin:$PATH"\' > "$HOME/.cargo/env"\n'
+        "echo 'Rust is installed now.'\n"
+    )
+    posh = f'#!/bin/sh\nexec "{tools}/oh-my-posh" "$@"\n'
+    sums = []
+    for name, content in [("rustup-init.sh", rustup), ("posh-linux-amd64", posh),
+                          ("posh-linux-arm64", posh), ("posh-linux-arm", posh)]:
+        with open(os.path.join(mirror, name), "w", encoding="utf-8") as f:
+            f.write(content)
+        sums.append(f"{hashlib.sha256(content.encode()).hexdigest()}  {name}")
+    # A stand-in Nerd Fonts archive: two families to install, one to leave out
+    font_zip = os.path.join(mirror, "FiraCode.zip")
+    with zipfile.ZipFile(font_zip, "w", zipfile.ZIP_DEFLATED) as archive:
+        for family in ("FiraCodeNerdFont", "FiraCodeNerdFontMono", "FiraCodeNerdFontPropo"):
+            for weight in ("Regular", "Bold", "Light"):
+                archive.writestr(f"{family}-{weight}.ttf", os.urandom(64 * 1024))
+        archive.writestr("LICENSE", "SIL Open Font License")
+    with open(font_zip, "rb") as f:
+        sums.append(f"{hashlib.sha256(f.read()).hexdigest()}  FiraCode.zip")
+    with open(os.path.join(mirror, "SHA256SUMS"), "w", encoding="utf-8") as f:
+        f.write("\n".join(sums) + "\n")
+
+    # Sparse crates.io index entries for --upgrade: 1.0.0 is the newest release
+    for crate in resolved_crates(scenario["manifest"]):
+        path = os.path.join(mirror, "crates-index", *_crate_index_path(crate).split("/"))
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "w", encoding="utf-8") as f:
+            for version, yanked in [("0.9.0", False), ("1.0.0", False), ("1.1.0", True), ("2.0.0-rc.1", False)]:
+                f.write(json.dumps({"name": crate, "vers": version, "yanked": yanked}) + "\n")
+
+    config = dict(scenario["config"], scale=latency_scale)
+    config_path = os.path.join(root, "shim-config.json")
+    with open(config_path, "w", encoding="utf-8") as f:
+        json.dump(config, f)
+
+    env = {
+        "HOME": home,
+        "PATH": os.pathsep.join([shim_bin, installed_bin, system_bin]),
+        "BENCH_INSTALLED_BIN": installed_bin,
+        "LANG": "C.UTF-8",
+        "BENCH_CONFIG": config_path,
+        "BENCH_CALL_LOG": os.path.join(root, "calls.log"),
+        "PYTHONDONTWRITEBYTECODE": "1",
+    }
+    return {"checkout": checkout, "home": home, "mirror": mirror, "env": env}
+
+def run_installer(sandbox, jobs, extra_args=()):
+    """Runs install_packages.py once and measures it."""
+    call_log = sandbox["env"]["BENCH_CALL_LOG"]
+    open(call_log, "w").close()
+    command = [sys.executable, os.path.join(sandbox["checkout"], "install_packages.py"),
+               "--offline", "--mirror", sandbox["mirror"], "--jobs", str(jobs)] + list(extra_args)
+    log_path = os.path.join(os.path.dirname(call_log), "installer-output.txt")
+
+    start = time.perf_counter()
+    with open(log_path, "w", encoding="utf-8") as output:
+        process = subprocess.Popen(command, stdout=output, stderr=subprocess.STDOUT,
+                                   stdin=subprocess.DEVNULL, env=sandbox["env"], cwd=sandbox["checkout"])
+        _, status, usage = os.wait4(process.pid, 0)
+    wall = time.perf_counter() - start
+    process.returncode = os.waitstatus_to_exitcode(status)
+
+    with open(call_log, "r", encoding="utf-8") as f:
+        lines = [line.split(" ", 1) for line in f if line.strip()]
+    calls = [tool for tool, _ in lines]
+    return {
+        "wall_seconds": wall,
+        "exit_code": process.returncode,
+        "tool_calls": len(calls),
+        "calls_by_tool": {tool: calls.count(tool) for tool in sorted(set(calls))},
+        # ru_maxrss is in KiB on Linux and bytes on macOS
+        "peak_rss_mb": usage.ru_maxrss / (1024 * 1024 if sys.platform == "darwin" else 1024),
+        "output": log_path,
+        "call_args": [(tool, json.loads(args)) for tool, args in lines],
+    }
+
+def retried_items(run, expected):
+    """Returns the items in expected ({tool: [package, ...]}) that the run never tried to install."""
+    missing = []
+    for tool, items in expected.items():
+        attempted = {arg for name, args in run["call_args"]
+                     if name == tool and ("install" in args or "binstall" in args)
+                     for arg in args}
+        missing += [f"{tool} {item}" for item in items if item not in attempted]
+    return missing
+
+def busy_plan_stages(run, idle):
+    """Returns the stages in idle that the --plan json output of a run still has actions for."""
+    try:
+        with open(run["output"], "r", encoding="utf-8") as f:
+            plan = json.load(f)
+    except (OSError, ValueError):
+        return ["(no plan output)"]
+    return [f"{stage['stage']}: {', '.join(action['action'] for action in stage['actions'])}"
+            for stage in plan["stages"] if stage["stage"] in idle and stage["actions"]]
+
+def run_scenario(name, jobs, repeat, latency_scale, keep):
+    scenario = SCENARIOS[name]
+    runs = []
+    not_retried = set()
+    plan_problems = set()
+    for _ in range(repeat):
+        root = tempfile.mkdtemp(prefix=f"bench-{name}-")
+        try:
+            sandbox = make_sandbox(root, scenario, latency_scale)
+            if scenario["warmup"]:
+                run_installer(sandbox, jobs)
+            runs.append(run_installer(sandbox, jobs, scenario.get("args", ())))
+            if scenario.get("plan_idle"):
+                plan_problems.update(busy_plan_stages(runs[-1], scenario["plan_idle"]))
+            if scenario.get("retried"):
+                rerun = run_installer(sandbox, jobs, scenario.get("args", ()))
+                not_retried.update(retried_items(rerun, scenario["retried"]))
+        finally:
+            if not keep:
+                shutil.rmtree(root, ignore_errors=True)
+            else:
+                print(f"  kept sandbox: {root}")
+    best = min(runs, key=lambda run: run["wall_seconds"])
+    return {
+        "scenario": name,
+        "description": scenario["description"],
+        "runs": len(runs),
+        "wall_seconds_median": statistics.median(run["wall_seconds"] for run in runs),
+        "wall_seconds_min": best["wall_seconds"],
+        "tool_calls": best["tool_calls"],
+        "calls_by_tool": best["calls_by_tool"],
+        "peak_rss_mb": max(run["peak_rss_mb"] for run in runs),
+        "exit_codes": sorted({run["exit_code"] for run in runs}),
+        "expected_exit_code": scenario.get("exit_code", 0),
+        "not_retried": sorted(not_retried),
+        "plan_problems": sorted(plan_problems),
+    }
+
+def print_results(results):
+    """Prints the results table and returns False if any scenario did not behave as expected."""
+    print(f"\n{'Scenario':<16} {'Median':>8} {'Min':>8} {'Calls':>6} {'RSS MB':>7}  Description")
+    for result in results:
+        print(f"{result['scenario']:<16} {result['wall_seconds_median']:>7.2f}s {result['wall_seconds_min']:>7.2f}s "
+              f"{result['tool_calls']:>6} {result['peak_rss_mb']:>7.1f}  {result['description']}")
+    ok = True
+    for result in results:
+        if result["exit_codes"] != [result["expected_exit_code"]]:
+            print(f"⚠️  {result['scenario']}: installer exited with {result['exit_codes']}")
+            ok = False
+        if result["not_retried"]:
+            print(f"⚠️  {result['scenario']}: a second run did not retry {', '.join(result['not_retried'])}")
+            ok = False
+        for problem in result["plan_problems"]:
+            print(f"⚠️  {result['scenario']}: the plan has actions for an installed stage: {problem}")
+            ok = False
+    return ok
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmarks install_packages.py against stand-in package managers.")
+    parser.add_argument("--scenario", action="append", choices=sorted(SCENARIOS),
+                        help="scenario to run (repeatable, default: all)")
+    parser.add_argument("--repeat", type=int, default=1, help="runs per scenario (median is reported)")
+    parser.add_argument("--jobs", type=int, default=4, help="--jobs passed to the installer")
+    parser.add_argument("--latency-scale", type=float, default=1.0,
+                        help="multiply every shim latency by this (0 measures pure overhead)")
+    parser.add_argument("--json", metavar="PATH", help="also write the results as JSON to PATH")
+    parser.add_argument("--keep", action="store_true", help="keep the sandboxes for inspection")
+    args = parser.parse_args(argv)
+
+    results = []
+    for name in args.scenario or list(SCENARIOS):
+        print(f"Running {name}...")
+        results.append(run_scenario(name, args.jobs, max(1, args.repeat), args.latency_scale, args.keep))
+
+    ok = print_results(results)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+    return 0 if ok else 1
+
+if __name__ == "__main__":
+    if sys.argv[1:2] == ["--shim"]:
+        sys.exit(run_shim(sys.argv[2], sys.argv[3:]))
+    sys.exit(main())
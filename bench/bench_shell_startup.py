@@ -0,0 +1,377 @@
+#!/usr/bin/env python3
+"""Shell startup benchmark and profiler for the fish, zsh and pwsh configs.
+
+Starts each installed shell many times with its config, reports the median
+and p95 startup time next to a bare (no config) start, and attributes the
+cost to the sourced files and the external commands they run:
+
+- fish: `--profile-startup` for the full startup and `--profile` for each
+  of config.fish, conf.d/*.fish and functions/*.fish sourced on its own
+- zsh: zshrc.sh run under `zprof` with a timestamped xtrace, which gives
+  per-file and per-command time in a single start
+- pwsh: the profile's cost is its start time minus a bare start
+
+Results can be saved as a baseline; later runs fail (exit 1) when a
+shell's median startup grows past the threshold.
+
+    python3 bench/bench_shell_startup.py
+    python3 bench/bench_shell_startup.py --save-baseline
+    python3 bench/bench_shell_startup.py --shell fish --runs 50 --threshold 0.1
+"""
+
+import os
+import re
+import sys
+import json
+import math
+import time
+import shutil
+import argparse
+import tempfile
+import subprocess
+import statistics
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+SHELLS = ["fish", "zsh", "pwsh"]
+
+DEFAULT_RUNS = 20
+
+# Per-file profiles are slower (one shell per file), so they use fewer runs
+FILE_PROFILE_RUNS = 5
+
+# A regression must exceed both the relative threshold and this many
+# milliseconds, so sub-millisecond noise never fails a run
+DEFAULT_THRESHOLD = 0.2
+DEFAULT_SLACK_MS = 5.0
+
+TOP_COMMANDS = 10
+
+# Words that only prefix the real command in a traced line
+COMMAND_PREFIXES = {"command", "builtin", "exec", "noglob", "nocorrect", "time", "env", "sudo"}
+
+def default_baseline_path():
+    state_home = os.environ.get("XDG_STATE_HOME") or os.path.expanduser("~/.local/state")
+    return os.path.join(state_home, "dotfiles", "shell-startup-baseline.json")
+
+def fish_files():
+    fish_dir = os.path.join(REPO_DIR, "fish")
+    files = [os.path.join(fish_dir, "conf.d", name) for name in sorted(os.listdir(os.path.join(fish_dir, "conf.d")))]
+    files.append(os.path.join(fish_dir, "config.fish"))
+    files += [os.path.join(fish_dir, "functions", name)
+              for name in sorted(os.listdir(os.path.join(fish_dir, "functions")))]
+    return [path for path in files if path.endswith(".fish")]
+
+def zsh_rc():
+    return os.path.join(REPO_DIR, "zsh", "zshrc.sh")
+
+def pwsh_profile():
+    return os.path.join(REPO_DIR, "pwsh", "Microsoft.PowerShell_profile.ps1")
+
+def time_run(command, env=None):
+    """Runs command once and returns its wall time in seconds."""
+    start = time.perf_counter()
+    result = subprocess.run(command, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+                            stderr=subprocess.PIPE, env=env, text=True)
+    elapsed = time.perf_counter() - start
+    if result.returncode != 0:
+        raise RuntimeError(f"{' '.join(command)} exited with {result.returncode}: {result.stderr.strip()[-300:]}")
+    return elapsed
+
+def summarize(samples):
+    """Median, p95 and min of a list of seconds, in milliseconds."""
+    ordered = sorted(samples)
+    p95 = ordered[max(0, math.ceil(0.95 * len(ordered)) - 1)]
+    return {
+        "runs": len(ordered),
+        "median_ms": statistics.median(ordered) * 1000,
+        "p95_ms": p95 * 1000,
+        "min_ms": ordered[0] * 1000,
+    }
+
+def command_word(text, ignore=()):
+    """Returns the command a traced line runs, skipping assignments and prefixes."""
+    words = text.strip().lstrip("(").split()
+    while words:
+        word = words.pop(0)
+        if "=" in word.split("/")[0] and not word.startswith("="):
+            continue
+        if word in COMMAND_PREFIXES:
+            if words and words[0].startswith("-"):
+                # `command -v x` / `builtin -n` only look things up
+                return None
+            continue
+        if word in ignore:
+            return None
+        return os.path.basename(word)
+    return None
+
+def is_external(word, known_names):
+    return word is not None and word not in known_names and shutil.which(word) is not None
+
+def top_items(totals, limit=TOP_COMMANDS):
+    ranked = sorted(totals.items(), key=lambda item: item[1]["ms"], reverse=True)
+    return [{"name": name, **values} for name, values in ranked[:limit]]
+
+def add_cost(totals, name, ms):
+    entry = totals.setdefault(name, {"ms": 0.0, "calls": 0})
+    entry["ms"] += ms
+    entry["calls"] += 1
+
+# --- fish -------------------------------------------------------------------
+
+FISH_PROFILE_ROW = re.compile(r"^\s*(\d+)\s+(\d+)\s+(-*)>\s?(.*)$")
+
+def parse_fish_profile(path):
+    """Parses a fish --profile file into (self_us, sum_us, depth, command) rows.
+
+    Continuation lines of multi-line commands are folded into their row.
+    """
+    rows = []
+    with open(path, "r", encoding="utf-8", errors="replace") as f:
+        for line in f:
+            match = FISH_PROFILE_ROW.match(line)
+            if match:
+                rows.append([int(match.group(1)), int(match.group(2)), len(match.group(3)), match.group(4)])
+            elif rows and line.strip() and not line.startswith("Time"):
+                rows[-1][3] += "\n" + line.rstrip("\n")
+    return rows
+
+def fish_quote(value):
+    return "'" + value.replace("\\", "\\\\").replace("'", "\\'") + "'"
+
+def fish_known_names(env):
+    """Builtins and functions, which never fork, as seen by an interactive fish."""
+    result = subprocess.run(["fish", "-i", "-c", "builtin -n; functions -a -n"], stdin=subprocess.DEVNULL,
+                            capture_output=True, text=True, env=env)
+    return set(re.split(r"[\s,]+", result.stdout.strip())) | {"source", ".", "if", "else", "end", "for",
+                                                              "while", "function", "begin", "switch", "case"}
+
+def fish_external_costs(rows, known_names):
+    totals = {}
+    for _, sum_us, _, text in rows:
+        # Pipelines are attributed to the command that starts them
+        word = command_word(text.split("|")[0])
+        if is_external(word, known_names):
+            add_cost(totals, word, sum_us / 1000)
+    return totals
+
+def fish_config_home(workdir):
+    """Builds an XDG_CONFIG_HOME whose fish/ holds the repo's fish config.
+
+    The entries are linked one by one into a real directory, so fish writes
+    fish_variables there and not into the repo.
+    """
+    config_home = os.path.join(workdir, "fish-config")
+    fish_dir = os.path.join(config_home, "fish")
+    os.makedirs(fish_dir, exist_ok=True)
+    for name in ("config.fish", "conf.d", "functions", "completions"):
+        source = os.path.join(REPO_DIR, "fish", name)
+        link = os.path.join(fish_dir, name)
+        if os.path.exists(source) and not os.path.lexists(link):
+            os.symlink(source, link)
+    return config_home
+
+def benchmark_fish(runs, workdir):
+    # Point fish at the repo's config, as ZDOTDIR does for zsh, rather than the user's own
+    env = dict(os.environ, XDG_CONFIG_HOME=fish_config_home(workdir))
+    bare = [time_run(["fish", "--no-config", "-i", "-c", "exit"], env) for _ in range(runs)]
+    full = [time_run(["fish", "-i", "-c", "exit"], env) for _ in range(runs)]
+
+    profile_path = os.path.join(workdir, "fish-startup.prof")
+    subprocess.run(["fish", "--profile-startup", profile_path, "-i", "-c", "exit"],
+                   stdin=subprocess.DEVNULL, capture_output=True, env=env)
+    commands = fish_external_costs(parse_fish_profile(profile_path), fish_known_names(env))
+
+    files = {}
+    file_profile = os.path.join(workdir, "fish-file.prof")
+    for path in fish_files():
+        samples = []
+        for _ in range(min(runs, FILE_PROFILE_RUNS)):
+            subprocess.run(["fish", "--no-config", "-i", "--profile", file_profile, "-c", "source " + fish_quote(path)],
+                           stdin=subprocess.DEVNULL, capture_output=True, env=env)
+            rows = parse_fish_profile(file_profile)
+            samples.append(sum(row[1] for row in rows if row[2] == 0) / 1000)
+        files[os.path.relpath(path, REPO_DIR)] = {"ms": statistics.median(samples), "calls": 1}
+    return {"startup": summarize(full), "bare": summarize(bare), "files": top_items(files, len(files)),
+            "commands": top_items(commands)}
+
+# --- zsh --------------------------------------------------------------------
+
+ZSH_PROFILE_RC = """\
+zmodload zsh/zprof
+PS4='+%D{%s.%6.}|%x|%I> '
+exec 3>&2 2>"$BENCH_TRACE"
+setopt xtrace
+source "$BENCH_ZSHRC"
+unsetopt xtrace
+exec 2>&3 3>&-
+print -rl -- ${(k)builtins} ${(k)reswords} ${(k)functions} ${(k)aliases} > "$BENCH_NAMES"
+zprof > "$BENCH_ZPROF"
+"""
+
+ZSH_TRACE_LINE = re.compile(r"^\++(\d+\.\d+)\|([^|]*)\|\d+> (.*)$")
+
+def parse_zsh_trace(path):
+    """Turns a timestamped xtrace into (file, command, milliseconds) entries.
+
+    Each traced command is charged the time until the next traced command.
+    """
+    entries = []
+    with open(path, "r", encoding="utf-8", errors="replace") as f:
+        for line in f:
+            match = ZSH_TRACE_LINE.match(line)
+            if match:
+                entries.append((float(match.group(1)), match.group(2), match.group(3)))
+    return [(source, text, (entries[i + 1][0] - stamp) * 1000)
+            for i, (stamp, source, text) in enumerate(entries[:-1])]
+
+def parse_zprof(path, limit=TOP_COMMANDS):
+    """Reads the top of zprof's summary table as function name and self time."""
+    functions = []
+    try:
+        with open(path, "r", encoding="utf-8", errors="replace") as f:
+            for line in f:
+                # num calls time self name, where each time is "ms ms/call pct%"
+                parts = line.split()
+                if len(parts) >= 9 and parts[0].rstrip(")").isdigit() and parts[-1] != "name":
+                    functions.append({"name": parts[-1], "ms": float(parts[5]), "calls": int(parts[1])})
+                elif line.startswith("-") and functions:
+                    # The detailed call graph follows the summary table
+                    break
+    except OSError:
+        pass
+    return functions[:limit]
+
+def benchmark_zsh(runs, workdir):
+    env = dict(os.environ)
+    bare = [time_run(["zsh", "-f", "-i", "-c", "exit"], env) for _ in range(runs)]
+
+    # zshrc.sh is what ~/.zshrc links to; ZDOTDIR points zsh at a wrapper
+    startup_dir = os.path.join(workdir, "zsh-startup")
+    os.makedirs(startup_dir, exist_ok=True)
+    with open(os.path.join(startup_dir, ".zshrc"), "w", encoding="utf-8") as f:
+        f.write(f'source "{zsh_rc()}"\n')
+    full = [time_run(["zsh", "-i", "-c", "exit"], dict(env, ZDOTDIR=startup_dir)) for _ in range(runs)]
+
+    profile_dir = os.path.join(workdir, "zsh-profile")
+    os.makedirs(profile_dir, exist_ok=True)
+    with open(os.path.join(profile_dir, ".zshrc"), "w", encoding="utf-8") as f:
+        f.write(ZSH_PROFILE_RC)
+    paths = {name: os.path.join(profile_dir, name) for name in ("trace", "names", "zprof")}
+    subprocess.run(["zsh", "-i", "-c", "exit"], stdin=subprocess.DEVNULL, capture_output=True,
+                   env=dict(env, ZDOTDIR=profile_dir, BENCH_ZSHRC=zsh_rc(), BENCH_TRACE=paths["trace"],
+                            BENCH_NAMES=paths["names"], BENCH_ZPROF=paths["zprof"]))
+
+    try:
+        with open(paths["names"], "r", encoding="utf-8") as f:
+            known_names = set(f.read().split())
+    except OSError:
+        known_names = set()
+    files, commands = {}, {}
+    for source, text, ms in parse_zsh_trace(paths["trace"]):
+        if source != os.path.join(profile_dir, ".zshrc"):
+            add_cost(files, os.path.relpath(source, REPO_DIR) if source.startswith(REPO_DIR) else source, ms)
+        word = command_word(text)
+        if is_external(word, known_names):
+            add_cost(commands, word, ms)
+    return {"startup": summarize(full), "bare": summarize(bare), "files": top_items(files, len(files)),
+            "commands": top_items(commands), "functions": parse_zprof(paths["zprof"])}
+
+# --- pwsh -------------------------------------------------------------------
+
+def benchmark_pwsh(runs, workdir):
+    bare = [time_run(["pwsh", "-NoLogo", "-NoProfile", "-NonInteractive", "-Command", "exit"]) for _ in range(runs)]
+    profile = pwsh_profile()
+    full = [time_run(["pwsh", "-NoLogo", "-NoProfile", "-NonInteractive", "-Command", f". '{profile}'; exit"])
+            for _ in range(runs)]
+    startup, bare_summary = summarize(full), summarize(bare)
+    files = [{"name": os.path.relpath(profile, REPO_DIR), "calls": 1,
+              "ms": max(0.0, startup["median_ms"] - bare_summary["median_ms"])}]
+    return {"startup": startup, "bare": bare_summary, "files": files, "commands": []}
+
+BENCHMARKS = {"fish": benchmark_fish, "zsh": benchmark_zsh, "pwsh": benchmark_pwsh}
+
+# --- Reporting and baselines ------------------------------------------------
+
+def print_report(results):
+    print(f"\n{'Shell':<6} {'Median':>9} {'p95':>9} {'Bare':>9} {'Config':>9}  Runs")
+    for shell, result in results.items():
+        startup, bare = result["startup"], result["bare"]
+        print(f"{shell:<6} {startup['median_ms']:>7.1f}ms {startup['p95_ms']:>7.1f}ms {bare['median_ms']:>7.1f}ms "
+              f"{startup['median_ms'] - bare['median_ms']:>7.1f}ms  {startup['runs']}")
+    for shell, result in results.items():
+        for heading, key in (("Files", "files"), ("External commands", "commands"), ("Functions (zprof)", "functions")):
+            if result.get(key):
+                print(f"\n{shell} — {heading}:")
+                for item in result[key]:
+                    print(f"  {item['ms']:>8.1f}ms  {item['calls']:>4}x  {item['name']}")
+
+def check_baseline(results, baseline, threshold, slack_ms):
+    """Compares median startup times against a saved baseline; returns the regressed shells."""
+    regressed = []
+    print()
+    for shell, result in results.items():
+        if shell not in baseline:
+            continue
+        before, after = baseline[shell]["startup"]["median_ms"], result["startup"]["median_ms"]
+        limit = max(before * (1 + threshold), before + slack_ms)
+        if after > limit:
+            print(f"❌ {shell}: startup regressed from {before:.1f}ms to {after:.1f}ms (limit {limit:.1f}ms)")
+            regressed.append(shell)
+        else:
+            print(f"✅ {shell}: {after:.1f}ms (baseline {before:.1f}ms, limit {limit:.1f}ms)")
+    return regressed
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmarks and profiles fish, zsh and pwsh startup.")
+    parser.add_argument("--shell", action="append", choices=SHELLS, help="shell to benchmark (repeatable, default: all installed)")
+    parser.add_argument("--runs", type=int, default=DEFAULT_RUNS, help="startups per shell")
+    parser.add_argument("--baseline", metavar="PATH", default=default_baseline_path(),
+                        help="baseline file to compare with (default: %(default)s)")
+    parser.add_argument("--save-baseline", action="store_true", help="write these results as the new baseline")
+    parser.add_argument("--threshold", type=float, default=DEFAULT_THRESHOLD,
+                        help="allowed relative growth of the median before failing (default: %(default)s)")
+    parser.add_argument("--slack-ms", type=float, default=DEFAULT_SLACK_MS,
+                        help="absolute growth always allowed, in milliseconds (default: %(default)s)")
+    parser.add_argument("--json", metavar="PATH", help="also write the results as JSON to PATH")
+    args = parser.parse_args(argv)
+
+    shells = args.shell or SHELLS
+    results = {}
+    with tempfile.TemporaryDirectory(prefix="bench-shell-") as workdir:
+        for shell in shells:
+            if shutil.which(shell) is None:
+                print(f"ℹ️  {shell} is not installed, skipping")
+                continue
+            print(f"Benchmarking {shell} ({args.runs} runs)...")
+            try:
+                results[shell] = BENCHMARKS[shell](max(1, args.runs), workdir)
+            except (RuntimeError, OSError) as e:
+                print(f"❌ {shell}: {e}")
+    if not results:
+        print("No shells were benchmarked.")
+        return 1
+
+    print_report(results)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+
+    if args.save_baseline:
+        os.makedirs(os.path.dirname(os.path.abspath(args.baseline)), exist_ok=True)
+        with open(args.baseline, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+        print(f"\n✅ Baseline saved to {args.baseline}")
+        return 0
+
+    try:
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            baseline = json.load(f)
+    except (OSError, ValueError):
+        print(f"\nℹ️  No baseline at {args.baseline}; run with --save-baseline to record one")
+        return 0
+    return 1 if check_baseline(results, baseline, args.threshold, args.slack_ms) else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -10,13 +10,20 @@ set -gx PATH $PATH "$HOME/.cargo/bin" $PATH
 set -gx GOPATH "$HOME/go"
 set -gx PATH $PATH "$GOPATH/bin"
 
-if command -v oh-my-posh > /dev/null
-  oh-my-posh init fish --config ~/dotfiles/prompt.omp.json | source
+# conf.d/dotfiles_init_cache.fish (written by install_packages.py) sources the
+# saved init scripts and sets these flags when they are still current
+if set -q __dotfiles_omp_cached
+  # Prompt already initialised from the cache
+else if command -v oh-my-posh > /dev/null
+  # ~/.config/fish links to fish/ in the repo, so the prompt config sits one level up
+  oh-my-posh init fish --config (builtin realpath (status dirname)/..)/prompt.omp.json | source
 else
   echo "oh-my-posh not found, please install it from https://ohmyposh.dev/docs/installation/linux"
 end
 
-if command -v zoxide > /dev/null
+if set -q __dotfiles_zoxide_cached
+  # zoxide already initialised from the cache
+else if command -v zoxide > /dev/null
   zoxide init fish | source
 else
   echo "zoxide not found, please install it from https://github.com/ajeetdsouza/zoxide"
@@ -1,13 +1,11 @@
 #!/usr/bin/env fish
 
 # Get the absolute path to the dotfiles directory
-set dotfiles_dir (dirname (realpath (status --current-filename)))
-set fish_dir (realpath (status --current-filename | xargs dirname))
+set dotfiles_dir (dirname (dirname (realpath (status --current-filename))))
 
-rm -rf ~/.config/fish
-ln -s "$fish_dir" ~/.config/fish
-rm -f ~/.gitconfig
-ln -s "$dotfiles_dir/gitconfig" ~/.gitconfig
+# Links ~/.config/fish, ~/.gitconfig and the other dotfiles. Only links that
+# differ are replaced, each atomically, so running shells never see them missing.
+python3 "$dotfiles_dir/install_packages.py" --links-only $argv
 
 # install Oh My Posh (same command can be used to update too)
 # curl -s https://ohmyposh.dev/install.sh | bash -s &
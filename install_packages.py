@@ -1,11 +1,261 @@
 #!/usr/bin/env python3
 
 import os
+import io
+import re
+import pathlib
 import json
+import argparse
+import asyncio
+import codecs
+import collections
+import hashlib
+import multiprocessing
 import subprocess
 import sys
 import platform
+import queue
+import shlex
+import shutil
+import tarfile
+import tempfile
+import threading
 import time
+import concurrent.futures
+import urllib.error
+import urllib.request
+import zipfile
+import zlib
+
+# Every external command and stage run, for the summary table and --profile-json
+_timings = []
+_timings_lock = threading.Lock()
+
+def record_timing(kind, name, start, end, exit_code=None, output_bytes=0, retries=0):
+    """Records one timed span; start and end come from time.perf_counter()."""
+    thread = threading.current_thread()
+    with _timings_lock:
+        _timings.append({
+            "kind": kind,
+            "name": name,
+            "start": start,
+            "end": end,
+            "exit_code": exit_code,
+            "output_bytes": output_bytes,
+            "retries": retries,
+            "thread": thread.name,
+            "thread_id": thread.ident,
+        })
+
+def describe_command(command):
+    """Returns a short printable form of a command list or shell string."""
+    text = command if isinstance(command, str) else " ".join(str(part) for part in command)
+    text = " ".join(text.split())
+    return text if len(text) <= 70 else text[:67] + "..."
+
+def _output_size(output):
+    if output is None:
+        return 0
+    return len(output.encode("utf-8", "replace")) if isinstance(output, str) else len(output)
+
+def run_command(command, retries=0, **kwargs):
+    """subprocess.run with its wall time, exit code and output size recorded.
+
+    retries is the number of earlier attempts at the same work, so retried
+    commands stand out in the summary.
+    """
+    start = time.perf_counter()
+    exit_code = None
+    output_bytes = 0
+    try:
+        result = subprocess.run(command, **kwargs)
+        exit_code = result.returncode
+        output_bytes = _output_size(result.stdout) + _output_size(result.stderr)
+        return result
+    except subprocess.CalledProcessError as e:
+        exit_code = e.returncode
+        output_bytes = _output_size(e.stdout) + _output_size(e.stderr)
+        raise
+    finally:
+        record_timing("command", describe_command(command), start, time.perf_counter(),
+                      exit_code=exit_code, output_bytes=output_bytes, retries=retries)
+
+# Lines of stdout/stderr kept in memory per command for error reports; the
+# full output only goes to the step's log file
+STREAM_TAIL_LINES = 20
+
+# How many runs' worth of log directories to keep
+LOG_RUNS_KEPT = 10
+
+_log_settings = {"run_dir": None}
+_log_lock = threading.Lock()
+_progress_lock = threading.Lock()
+
+def default_log_dir():
+    """Returns the directory holding per-run log folders, honouring XDG_STATE_HOME."""
+    state_home = os.environ.get("XDG_STATE_HOME") or os.path.expanduser("~/.local/state")
+    return os.path.join(state_home, "dotfiles", "logs")
+
+def run_log_dir():
+    """Returns this run's log directory, creating it (and pruning old runs) on first use."""
+    with _log_lock:
+        if _log_settings["run_dir"] is None:
+            base = default_log_dir()
+            run_dir = os.path.join(base, f"{time.strftime('%Y%m%d-%H%M%S')}-{os.getpid()}")
+            os.makedirs(run_dir, exist_ok=True)
+            runs = sorted(name for name in os.listdir(base) if os.path.isdir(os.path.join(base, name)))
+            for name in runs[:-LOG_RUNS_KEPT]:
+                shutil.rmtree(os.path.join(base, name), ignore_errors=True)
+            _log_settings["run_dir"] = run_dir
+        return _log_settings["run_dir"]
+
+def show_progress(text):
+    """Rewrites a single live status line on the terminal; a no-op when stderr is not a TTY."""
+    stream = sys.__stderr__
+    if stream is None or not stream.isatty():
+        return
+    width = shutil.get_terminal_size((80, 20)).columns - 1
+    with _progress_lock:
+        stream.write("\r\033[K" + text[:width])
+        if not text:
+            stream.write("\r")
+        stream.flush()
+
+async def _pump_process(command, shell, env, cwd, on_line):
+    limit = 1024 * 1024
+    if shell:
+        process = await asyncio.create_subprocess_shell(
+            command, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE,
+            env=env, cwd=cwd, limit=limit)
+    else:
+        process = await asyncio.create_subprocess_exec(
+            *command, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE,
+            env=env, cwd=cwd, limit=limit)
+
+    async def pump(stream, name):
+        # Chunks of an over-long line can end mid-character
+        decoder = codecs.getincrementaldecoder("utf-8")("replace")
+        while True:
+            try:
+                line = await stream.readuntil(b"\n")
+            except asyncio.IncompleteReadError as e:
+                # Output ending without a newline
+                line = e.partial
+            except asyncio.LimitOverrunError as e:
+                # A line longer than the limit; unlike readline, readuntil leaves
+                # it buffered, so pass it on in pieces without its newline
+                line = await stream.read(max(e.consumed, 1))
+            if not line:
+                break
+            on_line(name, decoder.decode(line))
+
+    await asyncio.gather(pump(process.stdout, "stdout"), pump(process.stderr, "stderr"))
+    return await process.wait()
+
+def stream_command(command, step, label=None, shell=False, env=None, cwd=None,
+                   keep=None, retries=0, check=False):
+    """Runs a command, streaming its output instead of buffering it.
+
+    Every line goes to <log dir>/<step>.log and the latest one is shown on a
+    live progress line. Only the last STREAM_TAIL_LINES lines of stdout and
+    stderr stay in memory, plus any line for which keep(line) is true, so
+    memory stays flat however much a command prints. Returns a
+    CompletedProcess whose stdout/stderr hold that retained text and whose
+    log_path points at the full log.
+    """
+    label = label or step
+    log_path = os.path.join(run_log_dir(), f"{re.sub(r'[^A-Za-z0-9_.-]+', '_', step)}.log")
+    tails = {"stdout": collections.deque(maxlen=STREAM_TAIL_LINES),
+             "stderr": collections.deque(maxlen=STREAM_TAIL_LINES)}
+    kept = {"stdout": [], "stderr": []}
+    counters = {"bytes": 0}
+    start = time.perf_counter()
+    returncode = None
+
+    with open(log_path, "a", encoding="utf-8") as log:
+        log.write(f"$ {describe_command(command)}\n")
+
+        # Streams part-way through an over-long line, which only get the stderr tag once
+        mid_line = {"stdout": False, "stderr": False}
+
+        def on_line(name, line):
+            counters["bytes"] += len(line)
+            log.write(line if name == "stdout" or mid_line[name] else f"[stderr] {line}")
+            mid_line[name] = not line.endswith("\n")
+            text = line.rstrip()
+            tails[name].append(text)
+            if keep is not None and keep(text):
+                kept[name].append(text)
+            if text:
+                show_progress(f"  ⏳ {label}: {text}")
+
+        try:
+            returncode = asyncio.run(_pump_process(command, shell, env, cwd, on_line))
+        finally:
+            show_progress("")
+            log.write(f"[exit {returncode}]\n")
+            record_timing("command", describe_command(command), start, time.perf_counter(),
+                          exit_code=returncode, output_bytes=counters["bytes"], retries=retries)
+
+    def retained(name):
+        lines = [line for line in kept[name] if line not in tails[name]] + list(tails[name])
+        return "\n".join(lines)
+
+    result = subprocess.CompletedProcess(command, returncode, retained("stdout"), retained("stderr"))
+    result.log_path = log_path
+    if check and returncode != 0:
+        raise subprocess.CalledProcessError(returncode, command, result.stdout, result.stderr)
+    return result
+
+def _mentions_already_installed(line):
+    line = line.lower()
+    return "already" in line or "no newer package versions" in line
+
+def print_timing_summary():
+    """Prints every recorded stage and command, slowest first."""
+    if not _timings:
+        return
+    print("\nTiming summary (slowest first):")
+    print(f"  {'Kind':<8} {'Time':>8} {'Exit':>5} {'Output':>9} {'Retries':>7}  Name")
+    for entry in sorted(_timings, key=lambda entry: entry["end"] - entry["start"], reverse=True):
+        exit_code = "-" if entry["exit_code"] is None else str(entry["exit_code"])
+        print(f"  {entry['kind']:<8} {entry['end'] - entry['start']:>7.2f}s {exit_code:>5} "
+              f"{entry['output_bytes']:>8}B {entry['retries']:>7}  {entry['name']}")
+
+def write_profile_json(path):
+    """Writes the recorded spans as a Chrome trace (load it in chrome://tracing or Perfetto)."""
+    if not _timings:
+        return
+    origin = min(entry["start"] for entry in _timings)
+    pid = os.getpid()
+    thread_ids = {}
+    events = []
+    for entry in sorted(_timings, key=lambda entry: entry["start"]):
+        tid = thread_ids.setdefault(entry["thread_id"], len(thread_ids) + 1)
+        events.append({
+            "name": entry["name"],
+            "cat": entry["kind"],
+            "ph": "X",
+            "ts": round((entry["start"] - origin) * 1e6),
+            "dur": round((entry["end"] - entry["start"]) * 1e6),
+            "pid": pid,
+            "tid": tid,
+            "args": {
+                "exit_code": entry["exit_code"],
+                "output_bytes": entry["output_bytes"],
+                "retries": entry["retries"],
+            },
+        })
+    names = {entry["thread_id"]: entry["thread"] for entry in _timings}
+    for thread_id, tid in thread_ids.items():
+        events.append({"name": "thread_name", "ph": "M", "pid": pid, "tid": tid,
+                       "args": {"name": names[thread_id]}})
+
+    directory = os.path.dirname(os.path.abspath(path))
+    os.makedirs(directory, exist_ok=True)
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f, indent=1)
+    print(f"\n📈 Wrote profile trace to {path}")
 
 def get_os_info():
     """Determines the operating system and returns a key and package manager."""
@@ -37,100 +287,602 @@ def is_wsl():
     except:
         return False
 
-def is_firacode_installed(os_key):
-    """Checks if FiraCode font is already installed on the system."""
-    try:
-        if os_key == "Windows":
-            # Check Windows font directories
-            font_dirs = [
-                os.path.expanduser("~\\AppData\\Local\\Microsoft\\Windows\\Fonts"),
-                "C:\\Windows\\Fonts"
-            ]
-            firacode_patterns = ['firacode', 'fira code', 'fira_code']
-
-            for font_dir in font_dirs:
-                if os.path.exists(font_dir):
-                    for file in os.listdir(font_dir):
-                        file_lower = file.lower()
-                        if any(pattern in file_lower for pattern in firacode_patterns):
-                            return True
-
-        elif os_key == "macOS":
-            # Check macOS font directories
-            font_dirs = [
-                os.path.expanduser("~/Library/Fonts"),
-                "/Library/Fonts",
-                "/System/Library/Fonts"
-            ]
-            firacode_patterns = ['firacode', 'fira code', 'fira_code']
-
-            for font_dir in font_dirs:
-                if os.path.exists(font_dir):
-                    for file in os.listdir(font_dir):
-                        file_lower = file.lower()
-                        if any(pattern in file_lower for pattern in firacode_patterns):
-                            return True
-
-        elif os_key == "Linux":
-            # Check Linux font directories
-            font_dirs = [
-                os.path.expanduser("~/.local/share/fonts"),
-                os.path.expanduser("~/.fonts"),
-                "/usr/share/fonts",
-                "/usr/local/share/fonts"
-            ]
-            firacode_patterns = ['firacode', 'fira code', 'fira_code']
-
-            for font_dir in font_dirs:
-                if os.path.exists(font_dir):
-                    for root, dirs, files in os.walk(font_dir):
-                        for file in files:
-                            file_lower = file.lower()
-                            if any(pattern in file_lower for pattern in firacode_patterns):
-                                return True
-
-        return False
+def user_font_dir(os_key):
+    """Returns the per-user directory the FiraCode Nerd Font files are installed into."""
+    if os_key == "Windows":
+        local_app_data = os.environ.get("LOCALAPPDATA") or os.path.expanduser("~\\AppData\\Local")
+        return os.path.join(local_app_data, "Microsoft", "Windows", "Fonts")
+    elif os_key == "macOS":
+        return os.path.expanduser("~/Library/Fonts")
+    elif os_key == "Linux":
+        data_home = os.environ.get("XDG_DATA_HOME") or os.path.expanduser("~/.local/share")
+        # A folder of its own keeps the fc-cache run down to just these files
+        return os.path.join(data_home, "fonts", "FiraCodeNerdFont")
+    return None
+
+def default_cache_dir():
+    """Returns the dotfiles cache directory, honouring XDG_CACHE_HOME."""
+    cache_home = os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache")
+    return os.path.join(cache_home, "dotfiles")
+
+def font_stamp_path():
+    """Returns the stamp listing the FiraCode files, the folder they are in and the archive they came from.
+
+    It lives in the cache rather than the font folder, so a font installed by
+    other means is recorded without creating a font folder of our own.
+    """
+    return os.path.join(default_cache_dir(), "firacode.json")
+
+def read_font_stamp():
+    try:
+        with open(font_stamp_path(), "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError, TypeError):
+        return {}
+
+def write_font_stamp(font_dir, files, archive_hash=None):
+    stamp_path = font_stamp_path()
+    os.makedirs(os.path.dirname(stamp_path), exist_ok=True)
+    with open(f"{stamp_path}.tmp", "w", encoding="utf-8") as f:
+        json.dump({"dir": font_dir, "archive": archive_hash, "files": files}, f, indent=2)
+    os.replace(f"{stamp_path}.tmp", stamp_path)
+
+def is_firacode_stamped():
+    """Checks whether the files listed in the font stamp are all still in place."""
+    stamp = read_font_stamp()
+    files, font_dir = stamp.get("files"), stamp.get("dir")
+    return bool(files and font_dir) and all(os.path.exists(os.path.join(font_dir, name)) for name in files)
+
+# Name fragments of the FiraCode Nerd Font family and its files
+FIRACODE_PATTERNS = ["firacodenerdfont", "firacode nerd font", "fira code nerd font"]
+
+def font_directories(os_key):
+    """Returns the font directories checked for an existing FiraCode Nerd Font on each OS."""
+    if os_key == "Windows":
+        local_app_data = os.environ.get("LOCALAPPDATA") or os.path.expanduser("~\\AppData\\Local")
+        return [os.path.join(local_app_data, "Microsoft", "Windows", "Fonts"), "C:\\Windows\\Fonts"]
+    elif os_key == "macOS":
+        return [os.path.expanduser("~/Library/Fonts"), "/Library/Fonts"]
+    elif os_key == "Linux":
+        data_home = os.environ.get("XDG_DATA_HOME") or os.path.expanduser("~/.local/share")
+        return [os.path.join(data_home, "fonts"), os.path.expanduser("~/.fonts"),
+                "/usr/share/fonts", "/usr/local/share/fonts"]
+    return []
+
+# Directory names under the font roots that never hold FiraCode but can hold
+# thousands of files (TeX Live, Noto, X11 bitmap fonts)
+FONT_SCAN_PRUNE = ("texlive", "tex-gyre", "noto", "x11", "cmap", "ghostscript")
+
+def _matches_firacode(name):
+    name_lower = name.lower()
+    return any(pattern in name_lower for pattern in FIRACODE_PATTERNS)
+
+def _find_firacode_with_fontconfig():
+    """Asks fontconfig for FiraCode, stopping at the first match. Returns None without fc-list."""
+    if find_tool("fc-list") is None:
+        return None
+    start = time.perf_counter()
+    output_bytes = 0
+    process = subprocess.Popen(["fc-list", ":", "family", "file"], stdout=subprocess.PIPE,
+                               stderr=subprocess.DEVNULL, text=True, errors="replace")
+    try:
+        for line in process.stdout:
+            output_bytes += len(line)
+            if _matches_firacode(line):
+                return line.split(":", 1)[0].strip()
+        return ""
+    finally:
+        process.stdout.close()
+        process.kill()
+        exit_code = process.wait()
+        record_timing("command", "fc-list : family file", start, time.perf_counter(),
+                      exit_code=exit_code, output_bytes=output_bytes)
+
+def _find_firacode_by_scanning(os_key):
+    """Scans the font directories, pruning large unrelated trees and stopping at the first match."""
+    for font_dir in font_directories(os_key):
+        if not os.path.isdir(font_dir):
+            continue
+        for root, dirs, files in os.walk(font_dir):
+            for name in files:
+                if _matches_firacode(name):
+                    return os.path.join(root, name)
+            dirs[:] = [name for name in dirs if not name.lower().startswith(FONT_SCAN_PRUNE)]
+            # Only Linux nests fonts by foundry/family
+            if os_key != "Linux":
+                dirs[:] = []
+    return ""
+
+def find_installed_firacode(os_key):
+    """Returns the path of a FiraCode Nerd Font installed by other means, or an empty string.
+
+    Catches fonts from before the stamp existed, such as ones `oh-my-posh
+    font install` put in ~/.local/share/fonts. Asks fontconfig when it is
+    present and scans the font directories otherwise.
+    """
+    try:
+        found = _find_firacode_with_fontconfig() if os_key in ("Linux", "macOS") else None
+        if found is None:
+            found = _find_firacode_by_scanning(os_key)
+        return found
     except Exception:
         # If there's any error checking, assume font is not installed
+        return ""
+
+def is_firacode_installed(os_key, font_dir=None):
+    """Checks whether FiraCode Nerd Font is installed.
+
+    Usually this reads one stamp file and stats the handful of files it
+    lists. Without a stamp it falls back to find_installed_firacode.
+    """
+    font_dir = font_dir or user_font_dir(os_key)
+    if not font_dir:
         return False
+    return is_firacode_stamped() or bool(find_installed_firacode(os_key))
+
+# Installed packages per manager, built from one bulk query and reused for the run
+_installed_index = {}
+
+def _query_installed_packages(package_manager):
+    """Runs a single bulk query and returns the set of installed package names."""
+    installed = set()
+    if package_manager == "apt":
+        result = run_command(["dpkg-query", "-W", "-f=${Package}\t${Status}\n"],
+                                capture_output=True, text=True)
+        if result.returncode != 0:
+            return None
+        for line in result.stdout.splitlines():
+            name, _, status = line.partition("\t")
+            if status.endswith("ok installed"):
+                # Multi-arch packages are reported as "name:arch"
+                installed.add(name.split(":")[0].lower())
+    elif package_manager == "brew":
+        for command in (["brew", "list", "--formula", "--versions"],
+                        ["brew", "list", "--cask", "--versions"]):
+            result = run_command(command, capture_output=True, text=True)
+            if result.returncode != 0:
+                continue
+            for line in result.stdout.splitlines():
+                if line.strip():
+                    installed.add(line.split()[0].lower())
+    elif package_manager == "winget":
+        installed = _query_winget_packages()
+    elif package_manager == "cargo":
+        versions = cargo_installed_versions()
+        if versions is None:
+            return None
+        installed = set(versions)
+    else:
+        return None
+    return installed
+
+def cargo_command(*args):
+    """Builds a cargo command line from the resolved cargo binary.
+
+    Right after rustup, cargo is only in ~/.cargo/bin and not on PATH, so it
+    is looked up through find_tool. Its directory goes on PATH too, for the
+    rustc and subcommands cargo runs. Raises FileNotFoundError without cargo.
+    """
+    cargo = find_tool("cargo")
+    if cargo is None:
+        raise FileNotFoundError("cargo")
+    ensure_on_path(cargo)
+    return [cargo] + list(args)
+
+def cargo_installed_versions():
+    """Returns a dict of installed crate name -> version from `cargo install --list`, or None."""
+    try:
+        result = run_command(cargo_command("install", "--list"), capture_output=True, text=True)
+    except FileNotFoundError:
+        return None
+    if result.returncode != 0:
+        return None
+    versions = {}
+    for line in result.stdout.splitlines():
+        # Crates are unindented ("eza v0.18.0:"), their binaries are indented
+        if line and not line[0].isspace():
+            parts = line.rstrip(":").split()
+            versions[parts[0].lower()] = parts[1].lstrip("v") if len(parts) > 1 else ""
+    return versions
+
+def _query_winget_packages():
+    """Lists installed WinGet package IDs, preferring the JSON export over the table output."""
+    export_path = os.path.join(tempfile.mkdtemp(), "winget-export.json")
+    try:
+        run_command(["winget", "export", "-o", export_path,
+                        "--accept-source-agreements", "--disable-interactivity"],
+                       capture_output=True, text=True)
+        if os.path.exists(export_path):
+            with open(export_path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+            return {
+                package["PackageIdentifier"].lower()
+                for source in data.get("Sources", [])
+                for package in source.get("Packages", [])
+            }
+    except (ValueError, KeyError, OSError):
+        pass
+    finally:
+        if os.path.exists(export_path):
+            os.remove(export_path)
+        os.rmdir(os.path.dirname(export_path))
+
+    # Fall back to scanning the `winget list` table when the export is unavailable
+    result = run_command(["winget", "list", "--accept-source-agreements"],
+                            capture_output=True, text=True)
+    if result.returncode != 0:
+        return None
+    return {token.lower() for token in result.stdout.split()}
+
+def get_installed_index(package_manager, refresh=False):
+    """Returns the cached set of installed packages for a manager, or None if it cannot be queried."""
+    if refresh or package_manager not in _installed_index:
+        try:
+            _installed_index[package_manager] = _query_installed_packages(package_manager)
+        except FileNotFoundError:
+            _installed_index[package_manager] = None
+    return _installed_index[package_manager]
+
+def invalidate_installed_index(package_manager):
+    """Drops the cached index so the next lookup re-queries the manager."""
+    _installed_index.pop(package_manager, None)
 
 def check_package_installed(package, package_manager):
     """Checks if a package is already installed."""
+    index = get_installed_index(package_manager)
+    if index is not None:
+        return package.lower() in index
+
+    # The bulk query failed, so probe the single package instead
     try:
         if package_manager == "winget":
-            result = subprocess.run(["winget", "list", "--id", package],
+            result = run_command(["winget", "list", "--id", package],
                                   capture_output=True, text=True)
             return result.returncode == 0 and package in result.stdout
         elif package_manager == "brew":
-            result = subprocess.run(["brew", "list", package],
+            result = run_command(["brew", "list", package],
                                   capture_output=True, text=True)
             return result.returncode == 0
         elif package_manager == "apt":
-            result = subprocess.run(["dpkg", "-l", package],
+            result = run_command(["dpkg", "-l", package],
                                   capture_output=True, text=True)
             return result.returncode == 0
     except FileNotFoundError:
         pass
     return False
 
+# Installers and artifacts fetched over the network, by the name they have in
+# the download cache and in a --mirror directory
+DOWNLOADS = {
+    "rustup-init.sh": "https://sh.rustup.rs",
+    "posh-linux-amd64": "https://cdn.ohmyposh.dev/releases/latest/posh-linux-amd64",
+    "posh-linux-arm64": "https://cdn.ohmyposh.dev/releases/latest/posh-linux-arm64",
+    "posh-linux-arm": "https://cdn.ohmyposh.dev/releases/latest/posh-linux-arm",
+    "FiraCode.zip": "https://github.com/ryanoasis/nerd-fonts/releases/latest/download/FiraCode.zip",
+}
+
+FONT_ARCHIVE = "FiraCode.zip"
+
+# Cached downloads younger than this are used without asking the server
+DOWNLOAD_MAX_AGE = 24 * 60 * 60
+
+_download_settings = {"offline": False, "mirror": None, "cache_dir": None}
+_download_lock = threading.Lock()
+
+def configure_downloads(offline=False, mirror=None, cache_dir=None):
+    """Sets where fetch_download may get files from for this run.
+
+    With a mirror, files are taken from that directory first and anything it
+    lacks is downloaded as usual. Offline runs never touch the network and
+    only use the mirror and the local cache.
+    """
+    _download_settings["offline"] = offline
+    _download_settings["mirror"] = os.path.abspath(mirror) if mirror else None
+    _download_settings["cache_dir"] = cache_dir
+
+def download_cache_dir():
+    return _download_settings["cache_dir"] or os.path.join(default_cache_dir(), "downloads")
+
+def _load_download_index():
+    try:
+        with open(os.path.join(download_cache_dir(), "index.json"), "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def _save_download_index(index):
+    path = os.path.join(download_cache_dir(), "index.json")
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(index, f, indent=2, sort_keys=True)
+    os.replace(tmp_path, path)
+
+def sha256_file(path):
+    """Returns the sha256 of a file, read in chunks."""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def _blob_path(sha256):
+    return os.path.join(download_cache_dir(), "sha256", sha256)
+
+def _store_blob(path):
+    """Moves a downloaded file into the content-addressed store and returns its sha256."""
+    sha256 = sha256_file(path)
+    blob = _blob_path(sha256)
+    os.makedirs(os.path.dirname(blob), exist_ok=True)
+    os.replace(path, blob)
+    return sha256
+
+def read_checksums(directory):
+    """Reads a sha256sum-style SHA256SUMS file from a directory into a name -> sha256 dict."""
+    checksums = {}
+    try:
+        with open(os.path.join(directory, "SHA256SUMS"), "r", encoding="utf-8") as f:
+            for line in f:
+                parts = line.split()
+                if len(parts) == 2:
+                    checksums[parts[1].lstrip("*")] = parts[0].lower()
+    except OSError:
+        pass
+    return checksums
+
+def _fetch_from_mirror(name, mirror):
+    """Copies a file from the mirror into the cache after checking it against SHA256SUMS.
+
+    Files that SHA256SUMS does not list are refused, as there is nothing to
+    check them against.
+    """
+    source = os.path.join(mirror, name)
+    if not os.path.isfile(source):
+        return None
+    expected = read_checksums(mirror).get(name)
+    if expected is None:
+        print(f"  ❌ {name} in mirror {mirror} is not listed in its SHA256SUMS, not using it")
+        return None
+    sha256 = sha256_file(source)
+    if expected != sha256:
+        print(f"  ❌ Checksum mismatch for {name} in mirror {mirror}")
+        return None
+    blob = _blob_path(sha256)
+    if not os.path.exists(blob):
+        os.makedirs(os.path.dirname(blob), exist_ok=True)
+        tmp_path = f"{blob}.{os.getpid()}.tmp"
+        shutil.copyfile(source, tmp_path)
+        os.replace(tmp_path, blob)
+    return sha256
+
+def _fetch_from_network(url, cached):
+    """Downloads url into the cache, revalidating an existing entry with ETag/Last-Modified.
+
+    Returns the new index entry, or the cached one if the server says it is unchanged.
+    """
+    request = urllib.request.Request(url, headers={"User-Agent": "dotfiles-installer"})
+    if cached and os.path.exists(_blob_path(cached["sha256"])):
+        if cached.get("etag"):
+            request.add_header("If-None-Match", cached["etag"])
+        if cached.get("last_modified"):
+            request.add_header("If-Modified-Since", cached["last_modified"])
+
+    os.makedirs(download_cache_dir(), exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=download_cache_dir(), suffix=".part")
+    start = time.perf_counter()
+    status = None
+    size = 0
+    try:
+        try:
+            with os.fdopen(fd, "wb") as f, urllib.request.urlopen(request, timeout=60) as response:
+                status = getattr(response, "status", 200)
+                for chunk in iter(lambda: response.read(1024 * 1024), b""):
+                    size += len(chunk)
+                    f.write(chunk)
+                headers = response.headers
+        except urllib.error.HTTPError as e:
+            status = e.code
+            if e.code == 304:
+                return dict(cached, fetched_at=time.time())
+            raise
+        return {
+            "sha256": _store_blob(tmp_path),
+            "etag": headers.get("ETag"),
+            "last_modified": headers.get("Last-Modified"),
+            "fetched_at": time.time(),
+        }
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        record_timing("download", url, start, time.perf_counter(), exit_code=status, output_bytes=size)
+
+def fetch_download(name, sha256=None):
+    """Returns a local path for one of DOWNLOADS, using the cache, mirror or network.
+
+    Files live in a content-addressed store under the cache directory, so every
+    path handed out has been checked against its own hash (and against sha256,
+    or the mirror's SHA256SUMS, when given). Returns None if the file cannot be
+    obtained or fails verification.
+    """
+    url = DOWNLOADS.get(name, name)
+    mirror = _download_settings["mirror"]
+    offline = _download_settings["offline"]
+
+    with _download_lock:
+        index = _load_download_index()
+        cached = index.get(url)
+        entry = None
+
+        if mirror:
+            mirrored = _fetch_from_mirror(name, mirror)
+            if mirrored:
+                entry = {"sha256": mirrored, "fetched_at": time.time(), "source": "mirror"}
+
+        if entry is None and cached and os.path.exists(_blob_path(cached["sha256"])):
+            fresh = time.time() - cached.get("fetched_at", 0) < DOWNLOAD_MAX_AGE
+            if offline or fresh or (sha256 and cached["sha256"] == sha256):
+                entry = cached
+
+        if entry is None:
+            if offline:
+                where = f"mirror {mirror}" if mirror else "the download cache"
+                print(f"  ❌ {name} is not available in {where} and network access is disabled")
+                return None
+            if mirror:
+                print(f"  ℹ️  {name} is not usable from mirror {mirror}, downloading it instead")
+            try:
+                print(f"  Downloading {url}...")
+                entry = _fetch_from_network(url, cached)
+            except (OSError, urllib.error.URLError) as e:
+                if cached and os.path.exists(_blob_path(cached["sha256"])):
+                    print(f"  ⚠️  Could not refresh {url} ({e}), using the cached copy")
+                    entry = cached
+                else:
+                    print(f"  ❌ Failed to download {url}: {e}")
+                    return None
+
+        blob = _blob_path(entry["sha256"])
+        if sha256_file(blob) != entry["sha256"] or (sha256 and entry["sha256"] != sha256):
+            print(f"  ❌ Checksum verification failed for {name}")
+            os.remove(blob)
+            index.pop(url, None)
+            _save_download_index(index)
+            return None
+
+        index[url] = entry
+        _save_download_index(index)
+        return blob
+
+def fill_mirror(directory):
+    """Fetches every entry in DOWNLOADS into directory and writes its SHA256SUMS."""
+    os.makedirs(directory, exist_ok=True)
+    checksums = read_checksums(directory)
+    for name in DOWNLOADS:
+        blob = fetch_download(name)
+        if blob is None:
+            continue
+        shutil.copyfile(blob, os.path.join(directory, name))
+        checksums[name] = os.path.basename(blob)
+        print(f"  ✅ {name}")
+    with open(os.path.join(directory, "SHA256SUMS"), "w", encoding="utf-8") as f:
+        for name in sorted(checksums):
+            f.write(f"{checksums[name]}  {name}\n")
+    return True
+
+def rustup_environment():
+    """Returns the environment for rustup, pointing it at the mirror's rustup tree when there is one."""
+    env = os.environ.copy()
+    mirror = _download_settings["mirror"]
+    if mirror and os.path.isdir(os.path.join(mirror, "rustup")):
+        # A local copy of static.rust-lang.org laid out as dist/ and rustup/
+        root = pathlib.Path(mirror, "rustup").as_uri()
+        env["RUSTUP_DIST_SERVER"] = root
+        env["RUSTUP_UPDATE_ROOT"] = f"{root}/rustup"
+    return env
+
+def linux_arch():
+    """Maps the machine type to the architecture names used by release artifacts."""
+    machine = platform.machine().lower()
+    if machine in ("x86_64", "amd64"):
+        return "amd64"
+    elif machine in ("aarch64", "arm64"):
+        return "arm64"
+    elif machine.startswith("arm"):
+        return "arm"
+    return machine
+
+# Where installers put tools that may not be on this process's PATH yet
+TOOL_SEARCH_DIRS = [
+    os.path.expanduser("~/.local/bin"),
+    os.path.expanduser("~/.cargo/bin"),
+    "/opt/homebrew/bin",
+    "/usr/local/bin",
+    "/home/linuxbrew/.linuxbrew/bin",
+]
+
+# Extra install locations for tools that don't use one of the prefixes above
+TOOL_EXTRA_DIRS = {
+    "oh-my-posh": [
+        os.path.expanduser("~\\AppData\\Local\\Programs\\oh-my-posh\\bin"),
+        "C:\\Program Files\\oh-my-posh\\bin",
+        os.path.expanduser("~\\AppData\\Local\\Microsoft\\WinGet\\Packages\\JanDeDobbeleer.OhMyPosh_Microsoft.Winget.Source_8wekyb3d8bbwe"),
+    ],
+}
+
+# Tool name -> {"path": ..., "version": ...} for this run
+_tools = {}
+_tools_lock = threading.Lock()
+
+def find_tool(name):
+    """Returns the full path of a tool from PATH or the known install prefixes, or None.
+
+    Lookups are cached for the run; stages that install something call
+    invalidate_tools() so the next lookup sees the new binaries.
+    """
+    with _tools_lock:
+        entry = _tools.get(name)
+        if entry is None:
+            search_path = os.pathsep.join([os.environ.get("PATH", "")] + TOOL_SEARCH_DIRS +
+                                          TOOL_EXTRA_DIRS.get(name, []))
+            entry = _tools[name] = {"path": shutil.which(name, path=search_path)}
+        return entry["path"]
+
+def tool_version(name):
+    """Returns the first line of a tool's --version output, probing it at most once per run.
+
+    None means the tool is missing or its --version failed.
+    """
+    path = find_tool(name)
+    if path is None:
+        return None
+    with _tools_lock:
+        entry = _tools.get(name, {})
+        if "version" in entry:
+            return entry["version"]
+    try:
+        result = run_command([path, "--version"], capture_output=True, text=True)
+        lines = result.stdout.strip().splitlines()
+        version = lines[0] if result.returncode == 0 and lines else None
+    except OSError:
+        version = None
+    with _tools_lock:
+        if name in _tools:
+            _tools[name]["version"] = version
+    return version
+
+def invalidate_tools(*names):
+    """Forgets cached lookups for names, or for every tool when no names are given."""
+    with _tools_lock:
+        if not names:
+            _tools.clear()
+        for name in names:
+            _tools.pop(name, None)
+
+def ensure_on_path(binary):
+    """Puts a binary's directory on this process's PATH so child processes find it by name."""
+    directory = os.path.dirname(binary)
+    if directory not in os.environ.get("PATH", "").split(os.pathsep):
+        os.environ["PATH"] = os.pathsep.join([directory, os.environ.get("PATH", "")])
+
 def check_and_install_manager(package_manager):
     """Checks if a package manager is installed and installs it if possible."""
     try:
         if package_manager == "apt":
             return True
-        elif package_manager == "brew":
-            subprocess.run(["brew", "--version"], check=True, capture_output=True)
-            return True
-        elif package_manager == "winget":
-            subprocess.run(["winget", "--version"], check=True, capture_output=True)
+        elif package_manager in ("brew", "winget"):
+            if tool_version(package_manager) is None:
+                raise FileNotFoundError(package_manager)
             return True
         else:
             return False
-    except (subprocess.CalledProcessError, FileNotFoundError):
+    except FileNotFoundError:
         print(f"❌ '{package_manager}' not found.")
         if package_manager == "brew":
             print("Installing Homebrew...")
-            subprocess.run(["/bin/bash", "-c", "$(curl -fsSL https://raw.githubusercontent.com/Homebrew/install/HEAD/install.sh)"], check=True)
+            run_command(["/bin/bash", "-c", "$(curl -fsSL https://raw.githubusercontent.com/Homebrew/install/HEAD/install.sh)"], check=True)
+            invalidate_tools("brew")
+            brew = find_tool("brew")
+            if brew:
+                ensure_on_path(brew)
             print("✅ Homebrew installed.")
             return True
         elif package_manager == "winget":
@@ -142,35 +894,33 @@ def check_and_install_manager(package_manager):
 def check_and_install_cargo():
     """Checks if Cargo is installed and installs Rust/Cargo silently if needed, then sources env."""
     try:
-        # Check if cargo is already installed by running in a subprocess (standard check)
-        subprocess.run(["cargo", "--version"], check=True, capture_output=True)
+        # Finds cargo on PATH or in ~/.cargo/bin from an earlier rustup run
+        if tool_version("cargo") is None:
+            raise FileNotFoundError("cargo")
+        ensure_on_path(find_tool("cargo"))
         print("✅ Cargo is already installed.")
         return True
-    except (subprocess.CalledProcessError, FileNotFoundError):
+    except FileNotFoundError:
         print("❌ Cargo not found. Installing Rust and sourcing environment...")
         try:
-            # CORRECTED COMMAND: Use the TILDE (~) for the path and use double quotes.
-            # We must pass this as a single string and set shell=True to handle the pipe (|).
-            # Note: Rustup creates the .cargo/env file *after* it runs, so sourcing immediately may fail.
-            # The most reliable method is to perform the PATH update after installation.
-
             # --- Phase 1: Install Rust ---
-            install_command = "curl --proto '=https' --tlsv1.2 -sSf https://sh.rustup.rs | sh -s -- -y"
-            subprocess.run(install_command, check=True, shell=True)
+            # The rustup script comes from the download cache (or --mirror) instead of curl | sh
+            script = fetch_download("rustup-init.sh")
+            if script is None:
+                print("❌ Could not get the rustup installer. Cannot install Rust.")
+                return False
+            stream_command(["sh", script, "-y"], step="rustup", label="rustup", check=True,
+                           env=rustup_environment())
             print("✅ Rust and Cargo installed.")
 
-            # --- Phase 2: Manually Update Python's PATH ---
-            # Now that Rust is installed, we force a bash shell to source the env file
-            # and print the resulting PATH to update Python's environment.
-
-            # Use Tilde (~) expansion for robustness
-            path_command = "bash -c '. \"$HOME/.cargo/env\" && echo $PATH'"
-
-            # Using 'bash -c' ensures the command is run in an environment that understands 'source'/'dot'
-            new_path = subprocess.run(path_command, shell=True, capture_output=True, text=True, check=True).stdout.strip()
-
-            # Update the PATH in the current Python environment
-            os.environ['PATH'] = new_path
+            # --- Phase 2: Update Python's PATH ---
+            # ~/.cargo/env only prepends ~/.cargo/bin, so do the same directly
+            invalidate_tools("cargo", "rustup")
+            cargo = find_tool("cargo")
+            if cargo is None:
+                print("❌ rustup finished but cargo was not found in ~/.cargo/bin.")
+                return False
+            ensure_on_path(cargo)
 
             print(f"✅ Python's OS environment PATH updated. Cargo should now be available.")
             return True
@@ -178,70 +928,659 @@ def check_and_install_cargo():
             print(f"❌ Failed to install Rust/Cargo or source environment. Error: {e}")
             return False
         except FileNotFoundError:
-            print("❌ Error: 'curl' or 'bash' not found. Cannot install Rust.")
+            print("❌ Error: 'sh' not found. Cannot install Rust.")
             return False
 
-def install_with_manager(packages, package_manager):
-    """Installs packages using the specified manager."""
-    print(f"\nInstalling packages with {package_manager}...")
-    for package in packages:
-        try:
-            print(f"  - Installing {package}...")
-            if package_manager == "brew":
-                command = ["brew", "install", package]
-            elif package_manager == "winget":
-                command = ["winget", "install", "--id", package, "--silent", "--exact"]
-            elif package_manager == "apt":
-                command = ["sudo", "apt", "install", "-y", package]
+# Managers whose CLI accepts several packages in a single install invocation
+BATCH_MANAGERS = ("brew", "apt")
 
-            result = subprocess.run(command, capture_output=True, text=True)
+# Managers that can download packages into their cache without installing them
+PREFETCH_MANAGERS = ("brew", "apt")
 
-            # Handle different exit codes
-            if result.returncode == 0:
-                print(f"  ✅ Successfully installed {package}")
-            elif package_manager == "winget" and result.returncode == 1:
-                # WinGet returns 1 when package is already installed
-                print(f"  ℹ️  {package} is already installed (up to date)")
-            elif package_manager == "winget" and result.returncode == -1978335189:
-                # Another common WinGet "already installed" code
-                print(f"  ℹ️  {package} is already installed")
+# Package archive directory set by --package-cache; None keeps the managers' own
+_package_cache = {"dir": None}
+
+def configure_package_cache(directory):
+    """Points apt's archive directory and Homebrew's download cache at directory.
+
+    A directory seeded with .deb files lets apt install those without
+    downloading them, which also makes the prefetch stage testable offline.
+    """
+    if not directory:
+        return
+    directory = os.path.abspath(os.path.expanduser(directory))
+    # apt refuses to use an archive directory without a partial/ subdirectory
+    os.makedirs(os.path.join(directory, "partial"), exist_ok=True)
+    _package_cache["dir"] = directory
+    os.environ["HOMEBREW_CACHE"] = directory
+
+def package_cache_options(package_manager):
+    """Extra manager arguments that select the --package-cache directory."""
+    if package_manager == "apt" and _package_cache["dir"]:
+        return ["-o", f"Dir::Cache::archives={_package_cache['dir']}/"]
+    return []
+
+def build_install_command(packages, package_manager):
+    """Builds the install command for one or more packages."""
+    if package_manager == "brew":
+        return ["brew", "install"] + list(packages)
+    elif package_manager == "winget":
+        # WinGet only takes a single --id per invocation
+        return ["winget", "install", "--id", packages[0], "--silent", "--exact"]
+    elif package_manager == "apt":
+        return ["sudo", "apt", "install", "-y"] + package_cache_options("apt") + list(packages)
+    return None
+
+# Exit codes and output that mean another process holds the manager's lock
+# (unattended-upgrades right after boot, or a second brew run)
+LOCK_EXIT_CODES = {"apt": (100,), "brew": (1,)}
+LOCK_PATTERNS = {
+    "apt": ["could not get lock", "unable to acquire the dpkg frontend lock",
+            "unable to lock the administration directory", "unable to lock directory"],
+    "brew": ["another active homebrew", "has already locked", "process is already running",
+             "please wait for it to finish or terminate it"],
+}
+
+class ManagerLocked(Exception):
+    """Raised when a package manager command failed because another process holds its lock.
+
+    run_stages re-queues the stage after a backoff instead of failing it.
+    """
+
+def lock_holder(package_manager, result):
+    """Returns a description of who holds the manager's lock, or None if the failure was something else."""
+    if result.returncode not in LOCK_EXIT_CODES.get(package_manager, ()):
+        return None
+    output = f"{result.stdout or ''}\n{result.stderr or ''}"
+    if not any(pattern in output.lower() for pattern in LOCK_PATTERNS[package_manager]):
+        return None
+    # apt: "It is held by process 1234 (unattended-upgr)"
+    match = re.search(r"held by process (\d+) \(([^)]+)\)", output)
+    return f"{match.group(2)} (pid {match.group(1)})" if match else "another process"
+
+def check_manager_lock(package_manager, result):
+    """Raises ManagerLocked when result failed on lock contention."""
+    holder = lock_holder(package_manager, result)
+    if holder:
+        raise ManagerLocked(f"the {package_manager} lock is held by {holder}")
+
+def _keeps_lock_lines(line):
+    line = line.lower()
+    return _mentions_already_installed(line) or "lock" in line
+
+def build_prefetch_command(packages, package_manager):
+    """Builds the command that downloads packages (and their dependencies) without installing them."""
+    if package_manager == "brew":
+        return ["brew", "fetch", "--deps"] + list(packages)
+    elif package_manager == "apt":
+        return ["sudo", "apt-get", "install", "--download-only", "-y"] + package_cache_options("apt") + list(packages)
+    return None
+
+def is_already_installed_output(package, output):
+    """Checks whether manager output reports a package as already installed."""
+    for line in output.lower().splitlines():
+        if package.lower() not in line.replace('"', ' ').split():
+            continue
+        # apt: "bat is already the newest version (0.24.0-1)."
+        # brew: "Warning: bat 0.24.0 is already installed and up-to-date."
+        if "already the newest version" in line or "already installed" in line:
+            return True
+    return False
+
+def report_install_result(package, package_manager, result):
+    """Prints the status of a single package install and returns True on success."""
+    if result.returncode == 0:
+        output = f"{result.stdout or ''}\n{result.stderr or ''}"
+        if is_already_installed_output(package, output):
+            print(f"  ℹ️  {package} is already up to date")
+        else:
+            print(f"  ✅ Successfully installed {package}")
+        return True
+    elif package_manager == "winget" and result.returncode == 1:
+        # WinGet returns 1 when package is already installed
+        print(f"  ℹ️  {package} is already installed (up to date)")
+        return True
+    elif package_manager == "winget" and result.returncode == -1978335189:
+        # Another common WinGet "already installed" code
+        print(f"  ℹ️  {package} is already installed")
+        return True
+
+    # Other error codes - let's be more helpful
+    error_msg = result.stderr.strip() if result.stderr else result.stdout.strip()
+    if "already installed" in error_msg.lower() or "no newer package versions" in error_msg.lower():
+        print(f"  ℹ️  {package} is already up to date")
+        return True
+
+    print(f"  ❌ Failed to install {package}. Exit code: {result.returncode}")
+    if error_msg:
+        print(f"    Details: {error_msg}")
+    if getattr(result, "log_path", None):
+        print(f"    Full log: {result.log_path}")
+    return False
+
+def install_packages_individually(packages, package_manager, retries=0):
+    """Installs packages one subprocess at a time, reporting each result.
+
+    Returns True if every package installed.
+    """
+    ok = True
+    for package in packages:
+        print(f"  - Installing {package}...")
+        command = build_install_command([package], package_manager)
+        result = stream_command(command, step=f"{package_manager}-install-{package}", label=package,
+                                keep=_keeps_lock_lines, retries=retries)
+        check_manager_lock(package_manager, result)
+        ok = report_install_result(package, package_manager, result) and ok
+    return ok
+
+def install_packages_batched(packages, package_manager):
+    """Installs all packages in one manager invocation, retrying only the failures.
+
+    Returns True if every package ended up installed.
+    """
+    print(f"  - Installing {len(packages)} packages in one batch: {' '.join(packages)}")
+    command = build_install_command(packages, package_manager)
+    result = stream_command(command, step=f"{package_manager}-install", label=f"{package_manager} install",
+                            keep=_keeps_lock_lines)
+    check_manager_lock(package_manager, result)
+    output = f"{result.stdout or ''}\n{result.stderr or ''}"
+
+    if result.returncode == 0:
+        for package in packages:
+            if is_already_installed_output(package, output):
+                print(f"  ℹ️  {package} is already up to date")
             else:
-                # Other error codes - let's be more helpful
-                error_msg = result.stderr.strip() if result.stderr else result.stdout.strip()
-                if "already installed" in error_msg.lower() or "no newer package versions" in error_msg.lower():
-                    print(f"  ℹ️  {package} is already up to date")
+                print(f"  ✅ Successfully installed {package}")
+        return True
+
+    # apt aborts the whole transaction on a single bad package and brew stops
+    # part way through, so only the packages reported as already installed are
+    # known to be fine. Everything else gets retried on its own.
+    retry = []
+    for package in packages:
+        if is_already_installed_output(package, output):
+            print(f"  ℹ️  {package} is already up to date")
+        else:
+            retry.append(package)
+
+    print(f"  ⚠️  Batch install failed (exit code {result.returncode}), retrying {len(retry)} package(s) individually")
+    print(f"    Log: {result.log_path}")
+    return install_packages_individually(retry, package_manager, retries=1)
+
+def install_with_manager(packages, package_manager, batch=True, skip_installed=True):
+    """Installs packages using the specified manager.
+
+    When batch is True and the manager supports it, every package is passed to a
+    single install command and only the packages that failed are retried one by one.
+    With skip_installed, packages already in the installed index are never handed
+    to the installer. Returns True if every package is installed afterwards.
+    """
+    print(f"\nInstalling packages with {package_manager}...")
+    # Drop duplicate entries while keeping the manifest order
+    packages = list(dict.fromkeys(packages))
+
+    try:
+        if skip_installed:
+            pending = []
+            for package in packages:
+                if check_package_installed(package, package_manager):
+                    print(f"  ℹ️  {package} is already installed")
                 else:
-                    print(f"  ❌ Failed to install {package}. Exit code: {result.returncode}")
-                    if error_msg:
-                        print(f"    Details: {error_msg}")
+                    pending.append(package)
+            packages = pending
+        if not packages:
+            return True
 
-        except FileNotFoundError:
-            print(f"  ❌ Package manager '{package_manager}' not found. Please install it first.")
-            break
+        if batch and package_manager in BATCH_MANAGERS and len(packages) > 1:
+            return install_packages_batched(packages, package_manager)
+        return install_packages_individually(packages, package_manager)
+    except FileNotFoundError:
+        print(f"  ❌ Package manager '{package_manager}' not found. Please install it first.")
+        return False
+    finally:
+        invalidate_installed_index(package_manager)
+        # New packages can bring new binaries, so later lookups must look again
+        if packages:
+            invalidate_tools()
+
+def prefetch_packages(packages, package_manager):
+    """Downloads the packages that are not installed yet into the manager's cache.
+
+    Runs while other stages work so the install afterwards only unpacks from
+    the local archive cache. A failed prefetch is not fatal: whatever is
+    missing is downloaded by the install as usual.
+    """
+    if package_manager not in PREFETCH_MANAGERS:
+        return True
+    pending = [package for package in dict.fromkeys(packages)
+               if not check_package_installed(package, package_manager)]
+    if not pending:
+        return True
 
-def install_cargo_packages(packages):
-    """Installs packages using Cargo."""
-    print("\nInstalling Cargo packages...")
+    print(f"\nPrefetching {len(pending)} {package_manager} packages: {' '.join(pending)}")
+    try:
+        result = stream_command(build_prefetch_command(pending, package_manager),
+                                step=f"{package_manager}-prefetch", label=f"{package_manager} prefetch",
+                                keep=_keeps_lock_lines)
+        check_manager_lock(package_manager, result)
+    except FileNotFoundError:
+        print(f"  ❌ Package manager '{package_manager}' not found.")
+        return True
+    if result.returncode == 0:
+        print(f"  ✅ Downloaded {len(pending)} packages ahead of install")
+    else:
+        print(f"  ⚠️  Prefetch failed (exit code {result.returncode}), packages will be downloaded during install")
+        print(f"    Log: {result.log_path}")
+    return True
+
+# Persistent build directory so dependency artifacts survive between cargo installs
+CARGO_TARGET_DIR = os.path.join(default_cache_dir(), "cargo-target")
+
+# Roughly how many cores one crate build keeps busy; sets how many crates build at once
+CARGO_CPUS_PER_BUILD = 4
+
+# Size the build slots under CARGO_TARGET_DIR may reach together before the
+# least recently used ones are cleared
+CARGO_TARGET_MAX_BYTES = 4 * 1024 ** 3
+
+def has_cargo_binstall():
+    """Checks whether cargo-binstall is available for prebuilt binaries."""
+    return find_tool("cargo-binstall") is not None
+
+def binstall_cargo_packages(packages, wanted=None):
+    """Fetches prebuilt binaries with cargo-binstall and returns the crates it could not provide.
+
+    wanted maps crates to the version an upgrade is after; those only count
+    as done once that version is installed.
+    """
+    print(f"  - Fetching prebuilt binaries with cargo-binstall: {' '.join(packages)}")
+    command = cargo_command("binstall", "--no-confirm", "--disable-strategies", "compile", *packages)
+    result = run_command(command, capture_output=True, text=True)
+    if result.returncode != 0:
+        print(f"  ⚠️  cargo-binstall exited with {result.returncode}, compiling what is missing")
+
+    versions = cargo_installed_versions() or {}
+    invalidate_installed_index("cargo")
+    missing = []
     for package in packages:
+        version = versions.get(package.lower())
+        if version is not None and (not wanted or version_key(version) >= version_key(wanted[package])):
+            print(f"  ✅ Successfully {'upgraded' if wanted else 'installed'} {package} (prebuilt)")
+        else:
+            missing.append(package)
+    return missing
+
+def _cargo_build(package, target_dir, build_jobs):
+    """Compiles one crate with cargo install and returns the completed process."""
+    env = os.environ.copy()
+    env["CARGO_TARGET_DIR"] = target_dir
+    command = cargo_command("install", "--jobs", str(build_jobs), package)
+    return stream_command(command, step=f"cargo-install-{package}", label=f"cargo {package}", env=env)
+
+def _dir_size(path):
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.lstat(os.path.join(root, name)).st_size
+            except OSError:
+                pass
+    return total
+
+def prune_cargo_target_dirs(target_dir=CARGO_TARGET_DIR, max_bytes=CARGO_TARGET_MAX_BYTES):
+    """Clears the least recently used build slots until they fit in max_bytes together.
+
+    Every build touches its slot dir, so the slots' mtimes give their last use.
+    A cleared slot only costs its crates' dependencies being compiled again.
+    """
+    try:
+        names = os.listdir(target_dir)
+    except OSError:
+        return
+    slots = []
+    for name in names:
+        path = os.path.join(target_dir, name)
+        if os.path.isdir(path) and not os.path.islink(path):
+            slots.append((os.stat(path).st_mtime, _dir_size(path), path))
+    total = sum(size for _, size, _ in slots)
+    for _, size, path in sorted(slots):
+        if total <= max_bytes:
+            break
+        shutil.rmtree(path, ignore_errors=True)
+        total -= size
+        print(f"  ℹ️  Cleared cargo build cache {path} ({size // 1024 ** 2} MB)")
+
+def install_cargo_packages(packages, cpu_budget=None, target_dir=CARGO_TARGET_DIR):
+    """Installs packages using Cargo.
+
+    Prebuilt binaries come from cargo-binstall when it is installed. Crates that
+    still need compiling build concurrently, splitting cpu_budget (all cores by
+    default) between them, with at least two at once when there is more than
+    one. Each build slot keeps its own persistent target dir under target_dir:
+    cargo locks a target dir for the whole build, so one shared dir would
+    serialise the builds, while per-slot dirs still let later crates and later
+    runs reuse compiled dependencies. The slots are pruned back to
+    CARGO_TARGET_MAX_BYTES afterwards. Returns True if every crate is
+    installed afterwards.
+    """
+    print("\nInstalling Cargo packages...")
+    pending = []
+    for package in dict.fromkeys(packages):
+        if check_package_installed(package, "cargo"):
+            print(f"  ℹ️  {package} is already installed")
+        else:
+            pending.append(package)
+
+    if pending and has_cargo_binstall():
+        pending = binstall_cargo_packages(pending)
+    return compile_cargo_packages(pending, cpu_budget, target_dir)
+
+def compile_cargo_packages(pending, cpu_budget=None, target_dir=CARGO_TARGET_DIR, upgrade=False):
+    """Compiles crates with cargo install, several at once; see install_cargo_packages.
+
+    Returns True if every crate built.
+    """
+    verb, action, done = ("upgrade", "Upgrading", "upgraded") if upgrade else ("install", "Installing", "installed")
+    if not pending:
+        invalidate_installed_index("cargo")
+        invalidate_tools()
+        return True
+
+    cpu_budget = max(1, cpu_budget or os.cpu_count() or 1)
+    # Linking and single-threaded crates leave cores idle, so two builds overlap
+    # well even when the budget only covers one
+    slots = min(len(pending), max(2, cpu_budget // CARGO_CPUS_PER_BUILD))
+    build_jobs = max(1, cpu_budget // slots)
+    slot_dirs = [os.path.join(target_dir, str(slot)) for slot in range(slots)]
+    free_dirs = queue.Queue()
+    for slot_dir in slot_dirs:
+        os.makedirs(slot_dir, exist_ok=True)
+        free_dirs.put(slot_dir)
+
+    def build(package):
+        slot_dir = free_dirs.get()
         try:
-            print(f"  - Installing {package} with cargo...")
-            command = ["cargo", "install", package]
-            subprocess.run(command, check=True)
-            print(f"  ✅ Successfully installed {package}")
-        except subprocess.CalledProcessError as e:
-            print(f"  ❌ Failed to install {package}. Error: {e}")
+            os.utime(slot_dir)
+            return _cargo_build(package, slot_dir, build_jobs)
+        finally:
+            free_dirs.put(slot_dir)
+
+    print(f"  - Compiling {len(pending)} crate(s), {slots} at a time with {build_jobs} job(s) each")
+    ok = True
+    with concurrent.futures.ThreadPoolExecutor(max_workers=slots) as executor:
+        futures = {}
+        for package in pending:
+            print(f"  - {action} {package} with cargo...")
+            futures[executor.submit(build, package)] = package
+        for future in concurrent.futures.as_completed(futures):
+            package = futures[future]
+            try:
+                result = future.result()
+            except FileNotFoundError:
+                print(f"  ❌ Failed to {verb} {package}. Error: cargo not found")
+                ok = False
+                continue
+            if result.returncode == 0:
+                print(f"  ✅ Successfully {done} {package}")
+            else:
+                ok = False
+                print(f"  ❌ Failed to {verb} {package}. Exit code: {result.returncode}")
+                details = (result.stderr or result.stdout).strip().splitlines()[-10:]
+                for line in details:
+                    print(f"    {line}")
+                print(f"    Full log: {result.log_path}")
+    prune_cargo_target_dirs(target_dir)
+    invalidate_installed_index("cargo")
+    invalidate_tools()
+    return ok
+
+# Sparse registry index that `cargo install` resolves crate versions from. A
+# --mirror can carry a copy under crates-index/ with the same layout.
+CRATES_INDEX_URL = "https://index.crates.io"
+
+def version_key(version):
+    """Sort key for a version string such as "0.24.0", "v1.2" or "1:2.39.2-1"."""
+    version = version.split(":", 1)[-1].lstrip("v")
+    return tuple(int(part) for part in re.findall(r"\d+", version))
+
+def _crate_index_path(name):
+    """Path of a crate's entry in the sparse index (see the Cargo registry docs)."""
+    name = name.lower()
+    if len(name) <= 2:
+        return f"{len(name)}/{name}"
+    if len(name) == 3:
+        return f"3/{name[0]}/{name}"
+    return f"{name[:2]}/{name[2:4]}/{name}"
+
+def latest_crate_version(name):
+    """Returns the newest stable, non-yanked version of a crate, or None if it cannot be looked up.
+
+    Like fetch_download, a mirror's crates-index/ copy is read first and the
+    network is only used when it has no entry and the run is not --offline.
+    """
+    path = _crate_index_path(name)
+    mirror = _download_settings["mirror"]
+    text = None
+    if mirror:
+        try:
+            with open(os.path.join(mirror, "crates-index", *path.split("/")), "r", encoding="utf-8") as f:
+                text = f.read()
+        except OSError:
+            pass
+    if text is None and not _download_settings["offline"]:
+        url = f"{CRATES_INDEX_URL}/{path}"
+        request = urllib.request.Request(url, headers={"User-Agent": "dotfiles-installer"})
+        start = time.perf_counter()
+        status = None
+        try:
+            with urllib.request.urlopen(request, timeout=30) as response:
+                status = getattr(response, "status", 200)
+                text = response.read().decode("utf-8")
+        except urllib.error.HTTPError as e:
+            status = e.code
+        except (OSError, urllib.error.URLError):
+            pass
+        finally:
+            record_timing("download", url, start, time.perf_counter(), exit_code=status,
+                          output_bytes=len(text or ""))
+    if text is None:
+        return None
+
+    versions = []
+    for line in text.splitlines():
+        try:
+            entry = json.loads(line)
+        except ValueError:
+            continue
+        # Pre-releases ("2.0.0-rc.1") are never picked by a plain cargo install
+        if not entry.get("yanked") and "-" not in entry.get("vers", "-"):
+            versions.append(entry["vers"])
+    return max(versions, key=version_key) if versions else None
+
+def query_outdated(packages, package_manager):
+    """Asks a manager once which of packages have a newer version available.
+
+    Returns a dict of package -> (installed version, available version) in
+    the order of packages, or None if the manager cannot be queried.
+    Packages that are not installed are never reported.
+    """
+    wanted = {package.lower(): package for package in packages}
+    outdated = {}
+    if package_manager == "apt":
+        # apt only knows about new versions once its lists are refreshed
+        result = stream_command(["sudo", "apt-get", "update"], step="apt-update", label="apt update",
+                                keep=_keeps_lock_lines)
+        check_manager_lock("apt", result)
+        result = run_command(["apt", "list", "--upgradable"], capture_output=True, text=True)
+        if result.returncode != 0:
+            return None
+        for line in result.stdout.splitlines():
+            # "bat/noble-updates 0.24.0-1ubuntu0.1 amd64 [upgradable from: 0.24.0-1]"
+            match = re.match(r"^([^/\s]+)/\S+\s+(\S+)\s.*\[upgradable from: ([^\]]+)\]", line)
+            if match and match.group(1).lower() in wanted:
+                outdated[wanted[match.group(1).lower()]] = (match.group(3), match.group(2))
+    elif package_manager == "brew":
+        result = run_command(["brew", "outdated", "--json=v2"], capture_output=True, text=True)
+        if result.returncode != 0:
+            return None
+        try:
+            data = json.loads(result.stdout or "{}")
+        except ValueError:
+            return None
+        if isinstance(data, list):
+            data = {"formulae": data}
+        for entry in data.get("formulae", []) + data.get("casks", []):
+            name = entry.get("name", "")
+            # Manifest entries may be tap-qualified ("homebrew/cask/wezterm")
+            package = wanted.get(name.lower()) or next(
+                (package for key, package in wanted.items() if key.rsplit("/", 1)[-1] == name.lower()), None)
+            if package:
+                installed = entry.get("installed_versions") or [entry.get("installed_version", "")]
+                outdated[package] = (installed[-1], entry.get("current_version", ""))
+    elif package_manager == "winget":
+        result = run_command(["winget", "upgrade", "--accept-source-agreements"], capture_output=True, text=True)
+        if result.returncode not in (0, 1) or not result.stdout:
+            return None
+        # Table rows: Name  Id  Version  Available  Source
+        for line in result.stdout.splitlines():
+            tokens = line.split()
+            for i, token in enumerate(tokens[:-2]):
+                if token.lower() in wanted:
+                    outdated[wanted[token.lower()]] = (tokens[i + 1], tokens[i + 2])
+                    break
+    elif package_manager == "cargo":
+        installed = cargo_installed_versions()
+        if installed is None:
+            return None
+        crates = [package for package in packages if package.lower() in installed]
+        with concurrent.futures.ThreadPoolExecutor(max_workers=min(8, len(crates) or 1)) as executor:
+            latest = dict(zip(crates, executor.map(latest_crate_version, crates)))
+        for crate in crates:
+            if latest[crate] is None:
+                print(f"  ⚠️  Could not look up the latest version of {crate}")
+            elif version_key(latest[crate]) > version_key(installed[crate.lower()]):
+                outdated[crate] = (installed[crate.lower()], latest[crate])
+    else:
+        return None
+    return {package: outdated[package] for package in packages if package in outdated}
+
+def build_upgrade_command(packages, package_manager):
+    """Builds the command that upgrades already installed packages."""
+    if package_manager == "brew":
+        return ["brew", "upgrade"] + list(packages)
+    elif package_manager == "winget":
+        return ["winget", "upgrade", "--id", packages[0], "--silent", "--exact"]
+    elif package_manager == "apt":
+        return ["sudo", "apt", "install", "--only-upgrade", "-y"] + package_cache_options("apt") + list(packages)
+    return None
+
+def _run_upgrade(packages, package_manager, step, retries=0):
+    result = stream_command(build_upgrade_command(packages, package_manager), step=step,
+                            label=f"{package_manager} upgrade", keep=_keeps_lock_lines, retries=retries)
+    check_manager_lock(package_manager, result)
+    return result
+
+def upgrade_with_manager(packages, package_manager):
+    """Upgrades the outdated ones among packages with one outdated query and one upgrade call.
+
+    A failed batch is retried one package at a time, like installs. Returns
+    True if everything that was outdated got upgraded.
+    """
+    print(f"\nChecking {package_manager} packages for upgrades...")
+    packages = list(dict.fromkeys(packages))
+    try:
+        outdated = query_outdated(packages, package_manager)
+        if outdated is None:
+            print(f"  ❌ Could not ask {package_manager} which packages are outdated")
+            return False
+        current = len([package for package in packages if package not in outdated
+                       and check_package_installed(package, package_manager)])
+        if current:
+            print(f"  ℹ️  {current} package(s) already up to date")
+        if not outdated:
+            return True
+        for package, (installed, available) in outdated.items():
+            print(f"  - {package} {installed} -> {available}")
+
+        pending = list(outdated)
+        if package_manager in BATCH_MANAGERS and len(pending) > 1:
+            result = _run_upgrade(pending, package_manager, f"{package_manager}-upgrade")
+            if result.returncode == 0:
+                print(f"  ✅ Upgraded {len(pending)} packages in one batch")
+                return True
+            print(f"  ⚠️  Batch upgrade failed (exit code {result.returncode}), retrying {len(pending)} package(s) individually")
+            print(f"    Log: {result.log_path}")
+
+        ok = True
+        for package in pending:
+            result = _run_upgrade([package], package_manager, f"{package_manager}-upgrade-{package}",
+                                  retries=1 if len(pending) > 1 and package_manager in BATCH_MANAGERS else 0)
+            if result.returncode == 0:
+                print(f"  ✅ Upgraded {package}")
+            else:
+                ok = False
+                print(f"  ❌ Failed to upgrade {package}. Exit code: {result.returncode}")
+                print(f"    Full log: {result.log_path}")
+        return ok
+    except FileNotFoundError:
+        print(f"  ❌ Package manager '{package_manager}' not found.")
+        return False
+    finally:
+        invalidate_installed_index(package_manager)
+        invalidate_tools()
+
+def upgrade_cargo_packages(packages, cpu_budget=None, target_dir=CARGO_TARGET_DIR):
+    """Rebuilds only the crates whose registry version is newer than the installed one.
+
+    Prebuilt binaries come from cargo-binstall when it is installed; the rest
+    compile in parallel as in install_cargo_packages.
+    """
+    print("\nChecking Cargo crates for upgrades...")
+    cargo = find_tool("cargo")
+    if cargo is None:
+        print("  ℹ️  Cargo is not installed, nothing to upgrade")
+        return True
+    ensure_on_path(cargo)
+    outdated = query_outdated(list(dict.fromkeys(packages)), "cargo")
+    if outdated is None:
+        print("  ❌ Could not list the installed crates")
+        return False
+    if not outdated:
+        print("  ℹ️  All crates are up to date")
+        return True
+    for crate, (installed, available) in outdated.items():
+        print(f"  - {crate} {installed} -> {available}")
+
+    pending = list(outdated)
+    if has_cargo_binstall():
+        pending = binstall_cargo_packages(pending, wanted={crate: outdated[crate][1] for crate in pending})
+    return compile_cargo_packages(pending, cpu_budget, target_dir, upgrade=True)
 
 def install_oh_my_posh_linux():
-    """Installs oh-my-posh using the official installation script for Linux."""
+    """Installs the oh-my-posh release binary into ~/.local/bin on Linux.
+
+    This is what the official install.sh does, but fetching the binary directly
+    lets it come from the download cache or a --mirror directory.
+    """
     print("\nInstalling oh-my-posh...")
+    home = os.path.expanduser("~")
     try:
-        # Download and install oh-my-posh using the official script
-        command = "curl -s https://ohmyposh.dev/install.sh | bash -s"
-        subprocess.run(command, shell=True, check=True)
+        binary = fetch_download(f"posh-linux-{linux_arch()}")
+        if binary is None:
+            print("❌ Failed to install oh-my-posh: could not get the release binary")
+            return False
+
+        install_dir = os.path.join(home, ".local/bin")
+        target = os.path.join(install_dir, "oh-my-posh")
+        os.makedirs(install_dir, exist_ok=True)
+        tmp_target = f"{target}.{os.getpid()}.tmp"
+        shutil.copyfile(binary, tmp_target)
+        os.chmod(tmp_target, 0o755)
+        os.replace(tmp_target, target)
+        invalidate_tools("oh-my-posh")
         print("✅ oh-my-posh installed successfully")
 
         # Add oh-my-posh to PATH in shell rc files if needed
-        home = os.path.expanduser("~")
         shell_files = [
             os.path.join(home, ".bashrc"),
             os.path.join(home, ".zshrc")
@@ -250,7 +1589,11 @@ def install_oh_my_posh_linux():
         omp_path = os.path.join(home, '.local/bin')
         path_export = f'export PATH="{omp_path}:$PATH"'
 
+        repo_dir = os.path.dirname(os.path.abspath(__file__))
         for shell_file in shell_files:
+            # ~/.zshrc links into this repo, which must not be edited
+            if os.path.realpath(shell_file).startswith(repo_dir + os.sep):
+                continue
             if os.path.exists(shell_file):
                 with open(shell_file, "r") as f:
                     content = f.read()
@@ -262,12 +1605,124 @@ def install_oh_my_posh_linux():
                     print(f"✅ Added oh-my-posh to PATH in {shell_file}")
 
         return True
-    except subprocess.CalledProcessError as e:
+    except OSError as e:
         print(f"❌ Failed to install oh-my-posh. Error: {e}")
         return False
-    except FileNotFoundError:
-        print("❌ Error: 'curl' or 'bash' not found. Cannot install oh-my-posh.")
-        return False
+
+# Generated into ~/.config/fish/conf.d so new shells source saved init scripts
+# instead of running `oh-my-posh init` and `zoxide init` every time
+FISH_INIT_CACHE_NAME = "dotfiles_init_cache.fish"
+
+# A stale cache starts a background rebuild at most this often, in seconds
+FISH_REFRESH_INTERVAL = 60 * 60
+
+def _fish_init_sources(script_dir):
+    """Lists the init scripts to cache as (tool, flag variable, init arguments)."""
+    prompt_config = os.path.join(script_dir, "prompt.omp.json")
+    return [
+        ("oh-my-posh", "__dotfiles_omp_cached", ["init", "fish", "--config", prompt_config]),
+        ("zoxide", "__dotfiles_zoxide_cached", ["init", "fish"]),
+    ]
+
+def _fish_quote(value):
+    return "'" + str(value).replace("\\", "\\\\").replace("'", "\\'") + "'"
+
+def refresh_fish_init_cache(script_dir=None, fish_config_dir=None, force=False):
+    """Regenerates the cached fish init script when a tool or prompt.omp.json changed.
+
+    The cache key covers each tool's path, version and mtime plus the
+    prompt.omp.json hash. The generated file re-checks the binaries' and
+    the prompt config's mtimes with fish builtins, so a stale cache is never
+    sourced: the shell falls back to the live init in config.fish and
+    rebuilds the cache in the background, at most once per
+    FISH_REFRESH_INTERVAL so a rebuild that keeps failing doesn't start a
+    python3 with every shell.
+    """
+    script_dir = script_dir or os.path.dirname(os.path.abspath(__file__))
+    fish_config_dir = fish_config_dir or os.path.expanduser("~/.config/fish")
+    cache_path = os.path.join(fish_config_dir, "conf.d", FISH_INIT_CACHE_NAME)
+    prompt_config = os.path.join(script_dir, "prompt.omp.json")
+
+    tools = []
+    for tool, flag, init_args in _fish_init_sources(script_dir):
+        binary = find_tool(tool)
+        if binary is None:
+            continue
+        binary = os.path.realpath(binary)
+        tools.append({
+            "tool": tool,
+            "flag": flag,
+            "binary": binary,
+            "version": tool_version(tool),
+            "mtime": int(os.stat(binary).st_mtime),
+            "init_args": init_args,
+        })
+
+    key = make_fingerprint([[t["binary"], t["version"], t["mtime"]] for t in tools],
+                           file_hash(prompt_config))
+    try:
+        with open(cache_path, "r", encoding="utf-8") as f:
+            if not force and f"# key: {key}\n" in f.read(4096):
+                print("  ℹ️  Fish init cache is up to date")
+                return True
+    except OSError:
+        pass
+
+    prompt_mtime = int(os.stat(prompt_config).st_mtime) if os.path.exists(prompt_config) else 0
+    lines = [
+        "# Generated by install_packages.py, do not edit.",
+        f"# key: {key}",
+        "# Each block is only used while the binary it came from is unchanged;",
+        "# otherwise config.fish runs the live init and the cache is rebuilt.",
+        "if not builtin -q path",
+        "  return",
+        "end",
+        "set -l __dotfiles_stale 0",
+    ]
+    for tool in tools:
+        result = run_command([tool["binary"]] + tool["init_args"], capture_output=True, text=True)
+        if result.returncode != 0:
+            print(f"  ⚠️  {tool['tool']} init failed, it will keep running at shell start")
+            continue
+        init_script = result.stdout
+        if tool["tool"] == "oh-my-posh":
+            # The session id must differ per shell, so generate it when sourcing
+            init_script = re.sub(r"(POSH_SESSION_ID\s+)[\"']?[0-9a-fA-F-]{36}[\"']?",
+                                 r"\1(string join - (random) (random) (random) (random))", init_script)
+            mtime_checks = (f"test (path mtime -- {_fish_quote(tool['binary'])}) = {tool['mtime']}; "
+                            f"and test (path mtime -- {_fish_quote(prompt_config)}) = {prompt_mtime}")
+        else:
+            mtime_checks = f"test (path mtime -- {_fish_quote(tool['binary'])}) = {tool['mtime']}"
+        lines += [
+            f"if {mtime_checks}",
+            f"  set -g {tool['flag']} 1",
+            *[f"  {line}" if line.strip() else "" for line in init_script.splitlines()],
+            "else",
+            "  set __dotfiles_stale 1",
+            "end",
+        ]
+    refresh_stamp = os.path.join(default_cache_dir(), "fish-init-refresh")
+    lines += [
+        f"set -l __dotfiles_stamp {_fish_quote(refresh_stamp)}",
+        "if test $__dotfiles_stale = 1",
+        "  and begin",
+        "    not test -e $__dotfiles_stamp",
+        f"    or test (path mtime --relative -- $__dotfiles_stamp) -gt {FISH_REFRESH_INTERVAL}",
+        "  end",
+        "  mkdir -p (path dirname -- $__dotfiles_stamp); and echo -n > $__dotfiles_stamp",
+        f"  command {_fish_quote(sys.executable)} {_fish_quote(os.path.join(script_dir, 'install_packages.py'))} "
+        "--refresh-shell-cache >/dev/null 2>&1 &",
+        "  disown 2>/dev/null",
+        "end",
+    ]
+
+    os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+    tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        f.write("\n".join(lines) + "\n")
+    os.replace(tmp_path, cache_path)
+    print(f"  ✅ Fish init cache written to {cache_path}")
+    return True
 
 def setup_fish_post_install(os_key):
     """Set up fish shell after all packages are installed."""
@@ -275,26 +1730,27 @@ def setup_fish_post_install(os_key):
 
     try:
         # Check if fish is available
-        fish_check = subprocess.run(["fish", "--version"], capture_output=True, text=True)
-        if fish_check.returncode != 0:
+        if tool_version("fish") is None:
             print("❌ Fish shell is not available")
             return False
 
-        # Update PATH to include oh-my-posh if it was installed
-        home = os.path.expanduser("~")
-        omp_path = os.path.join(home, '.local/bin')
+        # The init cache also covers zoxide, so it is rebuilt whether or not
+        # oh-my-posh is there; otherwise a stale cache would outlive it
+        fish_config_path = os.path.expanduser("~/.config/fish")
+        if os.path.exists(fish_config_path):
+            refresh_fish_init_cache(fish_config_dir=fish_config_path)
 
-        if os.path.exists(os.path.join(omp_path, 'oh-my-posh')):
-            print(f"  ✅ Found oh-my-posh at {omp_path}")
+        omp_binary = find_tool("oh-my-posh")
+        if omp_binary:
+            print(f"  ✅ Found oh-my-posh at {omp_binary}")
 
             # Check if fish config exists and can be sourced
-            fish_config_path = os.path.expanduser("~/.config/fish")
             if os.path.exists(fish_config_path):
                 print("  ✅ Fish configuration directory exists")
 
                 # Try to run a simple fish command to verify configuration works
                 test_cmd = f'fish -c "echo \\"Fish configuration test\\""'
-                test_result = subprocess.run(test_cmd, shell=True, capture_output=True, text=True)
+                test_result = run_command(test_cmd, shell=True, capture_output=True, text=True)
 
                 if test_result.returncode == 0:
                     print("  ✅ Fish configuration is working")
@@ -307,7 +1763,7 @@ def setup_fish_post_install(os_key):
             else:
                 print(f"  ❌ Fish configuration directory not found at {fish_config_path}")
         else:
-            print(f"  ⚠️  oh-my-posh not found at {omp_path}")
+            print("  ⚠️  oh-my-posh not found on PATH or in ~/.local/bin")
 
         return False
 
@@ -315,275 +1771,1795 @@ def setup_fish_post_install(os_key):
         print(f"❌ Error setting up fish shell: {e}")
         return False
 
-def install_fish_config():
-    """Installs fish shell configuration by running fish/install.fish script."""
-    print("\nInstalling fish shell configuration...")
-
-    script_dir = os.getcwd()
-    fish_dir = os.path.join(script_dir, "fish")
-    script_path = os.path.join(fish_dir, "install.fish")
-    gitconfig_path = os.path.join(script_dir, "gitconfig")
-
-    print(f"  Script directory: {script_dir}")
-    print(f"  Fish directory: {fish_dir}")
-    print(f"  Expected gitconfig: {gitconfig_path}")
+ZPLUG_REPO = "https://github.com/zplug/zplug"
+
+# function name() {  /  function name {  /  name() {
+ZSH_FUNCTION_START = re.compile(r"^(?:function\s+([\w.:+-]+)\s*(?:\(\))?|([\w.:+-]+)\s*\(\))\s*\{\s*$")
+
+def _sh_quote(value):
+    return "'" + str(value).replace("'", "'\\''") + "'"
+
+def zsh_cache_dir():
+    return os.path.join(default_cache_dir(), "zsh")
+
+def split_zsh_functions(text):
+    """Splits a file of zsh function definitions into autoloadable bodies.
+
+    Only top-level definitions whose closing brace is alone at the start of
+    a line are recognised. Returns (functions, rest): an ordered dict of
+    name -> body (with the comments above the definition kept on top) and
+    whatever code sat outside the definitions. Returns None if a definition
+    is never closed.
+    """
+    functions = {}
+    rest = []
+    comments = []
+    lines = text.splitlines()
+    i = 0
+    while i < len(lines):
+        line = lines[i]
+        match = ZSH_FUNCTION_START.match(line)
+        if not match:
+            if line.startswith("#") or not line.strip():
+                comments.append(line)
+            else:
+                rest += comments + [line]
+                comments = []
+            i += 1
+            continue
+        try:
+            end = next(j for j in range(i + 1, len(lines)) if re.match(r"^\}\s*$", lines[j]))
+        except StopIteration:
+            return None
+        name = match.group(1) or match.group(2)
+        while comments and not comments[0].strip():
+            comments.pop(0)
+        functions[name] = "\n".join(comments + lines[i + 1:end]) + "\n"
+        comments = []
+        i = end + 1
+    return functions, "\n".join(rest).strip()
+
+def _zplug_declarations(zshrc_text):
+    """Pulls the `zplug "owner/repo", ...` lines (with their continuations) out of zshrc.sh."""
+    declarations = []
+    continuing = False
+    for line in zshrc_text.splitlines():
+        if continuing or re.match(r"""^zplug\s+["']""", line):
+            declarations.append(line)
+            continuing = line.rstrip().endswith("\\")
+    return declarations
+
+def install_zplug(zshrc_text, zplug_home=None):
+    """Installs zplug (or fast-forwards an existing clone) and the plugins zshrc.sh declares.
+
+    Doing this here means an interactive shell never has to clone or
+    download anything before its first prompt.
+    """
+    zplug_home = zplug_home or os.path.expanduser("~/.zplug")
+    if not os.path.exists(os.path.join(zplug_home, "init.zsh")):
+        print(f"  - Cloning zplug into {zplug_home}")
+        result = stream_command(["git", "clone", "--depth", "1", ZPLUG_REPO, zplug_home],
+                                step="zplug-clone", label="zplug")
+        if result.returncode != 0:
+            print(f"  ❌ Failed to clone zplug. Log: {result.log_path}")
+            return False
+    elif os.path.isdir(os.path.join(zplug_home, ".git")):
+        result = stream_command(["git", "-C", zplug_home, "pull", "--ff-only", "--quiet"],
+                                step="zplug-pull", label="zplug")
+        if result.returncode != 0:
+            print(f"  ⚠️  Could not update zplug, keeping the current version. Log: {result.log_path}")
+
+    declarations = _zplug_declarations(zshrc_text)
+    if not declarations:
+        return True
+    script = "\n".join([f"export ZPLUG_HOME={_sh_quote(zplug_home)}",
+                        f"source {_sh_quote(os.path.join(zplug_home, 'init.zsh'))}",
+                        *declarations,
+                        "zplug check || zplug install"])
+    result = stream_command(["zsh", "-f", "-c", script], step="zplug-install", label="zplug plugins")
+    if result.returncode != 0:
+        print(f"  ⚠️  Installing zplug plugins failed, the shell will offer to retry. Log: {result.log_path}")
+    else:
+        print(f"  ✅ zplug and {len(declarations)} plugin declaration(s) are installed")
+    return True
+
+def _zcompile(output, *sources, flags="-U"):
+    """Compiles zsh scripts into a .zwc word code file; returns True on success."""
+    result = run_command(["zsh", "-f", "-c", f'zcompile {flags} -- "$@"', "zcompile", output, *sources],
+                         capture_output=True, text=True)
+    if result.returncode != 0:
+        print(f"  ⚠️  zcompile {os.path.basename(output)} failed: {(result.stderr or '').strip()}")
+        return False
+    return True
+
+def build_zsh_startup(script_dir=None, cache_dir=None, zshrc_link=None, force=False):
+    """Compiles the zsh startup files and turns functions.sh into autoloaded functions.
+
+    Writes ~/.zshrc.zwc and zsh/aliases.sh.zwc, which zsh uses instead of
+    the sources while they are newer than them, plus a cache directory
+    holding one file per function from functions.sh, its compiled digest
+    and functions.zsh, which zshrc.sh sources to autoload them. Nothing is
+    rebuilt while the sources and zsh are unchanged.
+    """
+    script_dir = script_dir or os.path.dirname(os.path.abspath(__file__))
+    cache_dir = cache_dir or zsh_cache_dir()
+    zshrc_link = zshrc_link or os.path.expanduser("~/.zshrc")
+    zsh_dir = os.path.join(script_dir, "zsh")
+    functions_path = os.path.join(zsh_dir, "functions.sh")
+    aliases_path = os.path.join(zsh_dir, "aliases.sh")
+    loader_path = os.path.join(cache_dir, "functions.zsh")
+    key_path = os.path.join(cache_dir, "key")
+
+    os.makedirs(cache_dir, exist_ok=True)
+    key = make_fingerprint(tool_version("zsh"), link_fingerprint(zshrc_link),
+                           [file_hash(path) for path in (os.path.join(zsh_dir, "zshrc.sh"), aliases_path, functions_path)])
+    try:
+        with open(key_path, "r", encoding="utf-8") as f:
+            if not force and f.read().strip() == key and os.path.exists(loader_path):
+                print("  ℹ️  Compiled zsh startup files are up to date")
+                return True
+    except OSError:
+        pass
 
-    if not os.path.exists(script_path):
-        print(f"❌ Fish install script not found at: {script_path}")
+    ok = True
+    # zsh only looks for <file>.zwc next to the path it sources, so ~/.zshrc
+    # is compiled through the link rather than zsh/zshrc.sh
+    if os.path.exists(zshrc_link):
+        ok = _zcompile(f"{zshrc_link}.zwc", zshrc_link) and ok
+    if os.path.exists(aliases_path):
+        ok = _zcompile(f"{aliases_path}.zwc", aliases_path) and ok
+
+    with open(functions_path, "r", encoding="utf-8") as f:
+        split = split_zsh_functions(f.read())
+    if split is None:
+        print("  ⚠️  Could not split zsh/functions.sh into functions, zshrc.sh will source it as is")
+        ok = False
+    else:
+        functions, rest = split
+        functions_dir = os.path.join(cache_dir, "functions")
+        # Build next to the old directory and swap it in, so a starting shell
+        # never sees half of the functions
+        staging_dir = tempfile.mkdtemp(prefix="functions.", dir=cache_dir)
+        for name, body in functions.items():
+            with open(os.path.join(staging_dir, name), "w", encoding="utf-8") as f:
+                f.write(body)
+        if functions and not _zcompile(os.path.join(cache_dir, "functions.zwc"),
+                                       *[os.path.join(staging_dir, name) for name in functions], flags="-Uz"):
+            ok = False
+        shutil.rmtree(functions_dir, ignore_errors=True)
+        os.replace(staging_dir, functions_dir)
+
+        lines = [
+            "# Generated by install_packages.py from zsh/functions.sh, do not edit.",
+            "# Each function's body is only read on its first call.",
+            f"fpath=({_sh_quote(functions_dir)} $fpath)",
+        ]
+        if functions:
+            lines.append(f"autoload -Uz {' '.join(functions)}")
+        if rest:
+            lines += ["", rest]
+        tmp_path = f"{loader_path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write("\n".join(lines) + "\n")
+        os.replace(tmp_path, loader_path)
+        ok = _zcompile(f"{loader_path}.zwc", loader_path) and ok
+        print(f"  ✅ {len(functions)} zsh functions will autoload from {functions_dir}")
+
+    if ok:
+        with open(key_path, "w", encoding="utf-8") as f:
+            f.write(key + "\n")
+        print("  ✅ Compiled zsh startup files")
+    return ok
+
+def setup_zsh(script_dir=None, force=False):
+    """Prepares zsh ahead of time: zplug and its plugins, compiled startup files and autoloaded functions."""
+    print("\nSetting up zsh...")
+    zsh = find_tool("zsh")
+    if zsh is None:
+        print("ℹ️  zsh is not installed, skipping")
+        return True
+    ensure_on_path(zsh)
+    script_dir = script_dir or os.path.dirname(os.path.abspath(__file__))
+    with open(os.path.join(script_dir, "zsh", "zshrc.sh"), "r", encoding="utf-8") as f:
+        zshrc_text = f.read()
+    if find_tool("git") is None:
+        print("  ⚠️  git is not installed, cannot install zplug")
+        zplug_ok = False
+    else:
+        zplug_ok = install_zplug(zshrc_text)
+    return build_zsh_startup(script_dir, force=force) and zplug_ok
+
+# Links deployed into $HOME, as (link relative to $HOME, target relative to the repo).
+# The shell configs find prompt.omp.json and the zsh includes through these
+# links, so the repo can be checked out anywhere.
+DOTFILE_LINKS = [
+    (".config/fish", "fish"),
+    (".gitconfig", "gitconfig"),
+    (".wezterm.lua", ".wezterm.lua"),
+    (".zshrc", "zsh/zshrc.sh"),
+]
+
+def dotfile_links(home=None, repo_dir=None):
+    """Returns DOTFILE_LINKS as absolute (link, target) pairs."""
+    home = home or os.path.expanduser("~")
+    repo_dir = repo_dir or os.path.dirname(os.path.abspath(__file__))
+    return [(os.path.join(home, link), os.path.join(repo_dir, target)) for link, target in DOTFILE_LINKS]
+
+def link_status(link, target):
+    """Compares one link with the filesystem using a single lstat (plus readlink).
+
+    Returns "ok", "missing" (nothing there), "stale" (a symlink pointing
+    elsewhere), "conflict" (a real file or directory) or "no-source" when
+    the repo file is missing.
+    """
+    if not os.path.lexists(target):
+        return "no-source"
+    try:
+        stat = os.lstat(link)
+    except FileNotFoundError:
+        return "missing"
+    except OSError:
+        return "conflict"
+    if os.path.islink(link):
+        current = os.readlink(link)
+        if not os.path.isabs(current):
+            current = os.path.join(os.path.dirname(link), current)
+        return "ok" if os.path.normpath(current) == os.path.normpath(target) else "stale"
+    # The link location already is the target, e.g. a repo checked out in place
+    if os.path.samestat(stat, os.stat(target)):
+        return "ok"
+    return "conflict"
+
+def _swap_link(link, target):
+    """Points link at target by renaming a fresh temporary link over it, so it never disappears."""
+    os.makedirs(os.path.dirname(link), exist_ok=True)
+    tmp_link = f"{link}.dotfiles-tmp-{os.getpid()}"
+    if os.path.lexists(tmp_link):
+        os.remove(tmp_link)
+    os.symlink(target, tmp_link, target_is_directory=os.path.isdir(target))
+    try:
+        os.replace(tmp_link, link)
+    except OSError:
+        os.remove(tmp_link)
+        raise
+
+def deploy_links(links=None, backup=True):
+    """Creates or fixes the dotfile links that differ from the desired map.
+
+    Links that are already correct are left untouched, so a no-op run only
+    stats each path. A real file or directory in the way is moved to
+    <path>.backup-<timestamp> unless backup is False, in which case it is skipped.
+    Returns True when every link ends up correct.
+    """
+    links = links if links is not None else dotfile_links()
+    all_ok = True
+    unchanged = 0
+    for link, target in links:
+        status = link_status(link, target)
+        if status == "ok":
+            unchanged += 1
+            continue
+        if status == "no-source":
+            print(f"  ⚠️  {target} does not exist, not linking {link}")
+            all_ok = False
+            continue
+        try:
+            if status == "conflict":
+                if not backup:
+                    print(f"  ⚠️  {link} exists and is not a link, skipping")
+                    all_ok = False
+                    continue
+                backup_path = f"{link}.backup-{time.strftime('%Y%m%d%H%M%S')}"
+                os.rename(link, backup_path)
+                print(f"  ℹ️  Moved {link} to {backup_path}")
+            _swap_link(link, target)
+            print(f"  ✅ Linked {link} -> {target}")
+        except OSError as e:
+            print(f"  ❌ Could not link {link}: {e}")
+            all_ok = False
+    if unchanged:
+        print(f"  ℹ️  {unchanged} link(s) already up to date")
+    return all_ok
+
+def install_dotfile_links(backup=True):
+    """Links the fish, git, wezterm, zsh and oh-my-posh configs into $HOME."""
+    print("\nLinking dotfiles...")
+    return deploy_links(backup=backup)
+
+# Members of the Nerd Fonts FiraCode archive that get installed: the regular
+# and Mono families. The proportional "Propo" variants, README and LICENSE
+# stay in the archive.
+FONT_MEMBER_PATTERN = re.compile(r"^FiraCodeNerdFont(Mono)?-[A-Za-z]+\.(ttf|otf)$")
+
+# Where Windows looks up per-user fonts
+WINDOWS_FONTS_KEY = r"Software\Microsoft\Windows NT\CurrentVersion\Fonts"
+
+def _file_crc32(path):
+    crc = 0
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            crc = zlib.crc32(chunk, crc)
+    return crc
+
+def extract_font_files(archive, font_dir):
+    """Copies the FONT_MEMBER_PATTERN members of a zip archive into font_dir.
+
+    Each member is streamed from the archive into a temporary file and
+    renamed into place, so memory use stays flat and a half-written font is
+    never visible. Files that already match the archive are left alone.
+    Returns the installed file names and how many of them were written.
+    """
+    os.makedirs(font_dir, exist_ok=True)
+    names = []
+    written = 0
+    with zipfile.ZipFile(archive) as zf:
+        for info in zf.infolist():
+            name = os.path.basename(info.filename)
+            if info.is_dir() or not FONT_MEMBER_PATTERN.match(name):
+                continue
+            names.append(name)
+            target = os.path.join(font_dir, name)
+            if (os.path.exists(target) and os.path.getsize(target) == info.file_size
+                    and _file_crc32(target) == info.CRC):
+                continue
+            tmp_path = f"{target}.{os.getpid()}.tmp"
+            try:
+                # zipfile checks the member's CRC as it is read
+                with zf.open(info) as source, open(tmp_path, "wb") as dest:
+                    shutil.copyfileobj(source, dest, 1024 * 1024)
+                os.replace(tmp_path, target)
+            finally:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+            written += 1
+    return names, written
+
+def register_windows_fonts(font_dir, names):
+    """Registers per-user font files so Windows applications see them without a sign-out."""
+    import winreg
+    import ctypes
+
+    with winreg.CreateKey(winreg.HKEY_CURRENT_USER, WINDOWS_FONTS_KEY) as key:
+        for name in names:
+            path = os.path.join(font_dir, name)
+            winreg.SetValueEx(key, f"{os.path.splitext(name)[0]} (TrueType)", 0, winreg.REG_SZ, path)
+            ctypes.windll.gdi32.AddFontResourceW(path)
+
+def refresh_font_cache(os_key, font_dir, names):
+    """Tells the OS about new font files, touching only font_dir."""
+    if os_key == "Linux":
+        if find_tool("fc-cache") is None:
+            print("  ℹ️  fc-cache not found, fonts will be picked up on next login")
+            return
+        # Without -f, fc-cache only rescans directories whose contents changed
+        result = run_command(["fc-cache", font_dir], capture_output=True, text=True)
+        if result.returncode != 0:
+            print(f"  ⚠️  fc-cache exited with {result.returncode}: {(result.stderr or '').strip()}")
+    elif os_key == "Windows":
+        register_windows_fonts(font_dir, names)
+
+def install_firacode_font(os_key, archive=None):
+    """Installs the FiraCode Nerd Font into the per-user font directory.
+
+    The archive comes from the download cache (or a --mirror), or from
+    archive when a local zip is given, so the font is downloaded once rather
+    than on every install.
+    """
+    print("\nInstalling FiraCode font...")
+
+    # Skip font installation in WSL
+    if os_key == "Linux" and is_wsl():
+        print("⚠️  Skipping font installation in WSL environment")
+        print("   Fonts should be installed from Windows host, not WSL")
+        print("   Run install_packages.py from Windows PowerShell/Command Prompt")
+        return True  # Return True since this is expected behavior
+
+    font_dir = user_font_dir(os_key)
+    if font_dir is None:
+        print(f"❌ No font directory known for {os_key}")
         return False
 
-    if not os.path.exists(gitconfig_path):
-        print(f"❌ Gitconfig file not found at: {gitconfig_path}")
+    if archive is None:
+        if is_firacode_stamped():
+            print("ℹ️  FiraCode font is already installed, skipping installation")
+            return True
+        existing = find_installed_firacode(os_key)
+        if existing:
+            # Stamp it so later runs don't need to look again
+            write_font_stamp(os.path.dirname(existing), [os.path.basename(existing)])
+            print(f"ℹ️  FiraCode font is already installed at {existing}, skipping installation")
+            return True
+
+    if archive is None:
+        archive = fetch_download(FONT_ARCHIVE)
+        if archive is None:
+            print("❌ Failed to install FiraCode font: could not get the font archive")
+            return False
+    elif not os.path.isfile(archive):
+        print(f"❌ Font archive not found: {archive}")
         return False
 
     try:
-        # Check if fish is installed
-        fish_check = subprocess.run(["fish", "--version"], capture_output=True, text=True)
-        if fish_check.returncode != 0:
-            print("❌ Fish shell is not installed. Please install fish first.")
+        names, written = extract_font_files(archive, font_dir)
+        if not names:
+            print(f"❌ No FiraCode Nerd Font files in {archive}")
             return False
+        if written:
+            refresh_font_cache(os_key, font_dir, names)
+        write_font_stamp(font_dir, names, sha256_file(archive))
+    except Exception as e:
+        print(f"❌ Unexpected error installing font: {e}")
+        return False
 
-        print(f"  Running fish install script: {script_path}")
-        # Run the script from the script directory to ensure proper path resolution
-        result = subprocess.run(["fish", script_path], capture_output=True, text=True, cwd=script_dir)
+    if written:
+        print(f"✅ FiraCode font installed successfully ({written} of {len(names)} files into {font_dir})")
+    else:
+        print(f"ℹ️  FiraCode font is already installed in {font_dir}")
+    return True
 
-        if result.returncode == 0:
-            print("✅ Fish shell configuration installed successfully")
-            if result.stdout:
-                print(f"  Output: {result.stdout.strip()}")
-
-            # Verify the symlink was created correctly
-            fish_config_path = os.path.expanduser("~/.config/fish")
-            if os.path.islink(fish_config_path):
-                link_target = os.readlink(fish_config_path)
-                expected_target = fish_dir
-                print(f"  ✅ Fish config symlinked: {fish_config_path} -> {link_target}")
-                if os.path.abspath(link_target) != os.path.abspath(expected_target):
-                    print(f"  ⚠️  Warning: Link target doesn't match expected path")
-                    print(f"      Expected: {expected_target}")
-                    print(f"      Actual: {link_target}")
-            else:
-                print(f"  ❌ Fish config symlink not found at {fish_config_path}")
-
-            # Check gitconfig symlink too
-            gitconfig_link_path = os.path.expanduser("~/.gitconfig")
-            if os.path.islink(gitconfig_link_path):
-                link_target = os.readlink(gitconfig_link_path)
-                expected_target = gitconfig_path
-                print(f"  ✅ Gitconfig symlinked: {gitconfig_link_path} -> {link_target}")
-                if os.path.abspath(link_target) != os.path.abspath(expected_target):
-                    print(f"  ⚠️  Warning: Gitconfig link target doesn't match expected path")
-                    print(f"      Expected: {expected_target}")
-                    print(f"      Actual: {link_target}")
+# Seconds each health check may take before it is reported as timed out
+VERIFY_TIMEOUT = 10
+
+# Worker processes the health checks run in
+VERIFY_WORKERS = 8
+
+def default_health_report_path():
+    """Returns where the JSON health report goes, next to the state file."""
+    return os.path.join(os.path.dirname(default_state_path()), "health.json")
+
+def check_binary(tool, binaries, timeout=VERIFY_TIMEOUT):
+    """Health check for one tool: one of binaries is found and `--version` succeeds.
+
+    Runs in a worker process, so it only takes and returns plain data.
+    """
+    start = time.perf_counter()
+    check = {"kind": "binary", "name": tool, "status": "failed", "path": None, "detail": ""}
+    path = next(filter(None, (find_tool(binary) for binary in binaries)), None)
+    if path is None:
+        check["detail"] = f"not found (looked for {', '.join(binaries)})"
+    else:
+        check["path"] = path
+        try:
+            result = subprocess.run([path, "--version"], capture_output=True, text=True,
+                                    errors="replace", timeout=timeout, stdin=subprocess.DEVNULL)
+            lines = (result.stdout or result.stderr).strip().splitlines()
+            if result.returncode == 0 and lines:
+                check["status"] = "ok"
+                check["detail"] = lines[0].strip()
             else:
-                print(f"  ❌ Gitconfig symlink not found at {gitconfig_link_path}")
+                check["detail"] = f"--version exited with {result.returncode}"
+        except subprocess.TimeoutExpired:
+            check["status"] = "timeout"
+            check["detail"] = f"--version did not finish within {timeout}s"
+        except OSError as e:
+            check["detail"] = f"could not run: {e}"
+    check["seconds"] = time.perf_counter() - start
+    return check
+
+def check_link(link, target):
+    """Health check for one dotfile symlink."""
+    start = time.perf_counter()
+    status = link_status(link, target)
+    return {"kind": "link", "name": link.replace(os.path.expanduser("~"), "~", 1),
+            "status": "ok" if status == "ok" else "failed", "path": target,
+            "detail": f"-> {target}" if status == "ok" else status,
+            "seconds": time.perf_counter() - start}
+
+def verify_installation(os_key, manifest, timeout=VERIFY_TIMEOUT, jobs=VERIFY_WORKERS):
+    """Runs the health checks for every tool in the manifest and the dotfile links, in a process pool.
+
+    Each `--version` gets timeout seconds and is reported as timed out
+    after that. Returns the report as a dict.
+    """
+    start = time.perf_counter()
+    tools = manifest["binaries"]
+    checks = []
+    if tools:
+        # Forking is cheapest and safe while no other thread is running,
+        # which main() makes sure of; otherwise fall back to a fork server.
+        # Windows only has spawn.
+        if not hasattr(os, "fork"):
+            method = "spawn"
+        else:
+            method = "fork" if threading.active_count() == 1 else "forkserver"
+        with concurrent.futures.ProcessPoolExecutor(max_workers=max(1, min(jobs, len(tools))),
+                                                    mp_context=multiprocessing.get_context(method)) as executor:
+            futures = {tool: executor.submit(check_binary, tool, binaries, timeout)
+                       for tool, binaries in tools.items()}
+            for tool, future in futures.items():
+                try:
+                    checks.append(future.result())
+                except Exception as e:
+                    checks.append({"kind": "binary", "name": tool, "status": "failed", "path": None,
+                                   "detail": str(e), "seconds": None})
+
+    # A link check is one lstat, cheaper than handing it to a worker
+    if os_key in ["macOS", "Linux"]:
+        checks += [check_link(link, target) for link, target in dotfile_links()]
+
+    elapsed = time.perf_counter() - start
+    return {
+        "host": platform.node(),
+        "os": os_key,
+        "checked_at": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "elapsed_seconds": elapsed,
+        "healthy": all(check["status"] == "ok" for check in checks),
+        "checks": checks,
+    }
+
+def print_health_report(report):
+    """Prints the health report, problems first."""
+    counts = collections.Counter(check["status"] for check in report["checks"])
+    print(f"\nHealth report: {len(report['checks'])} checks, {counts['ok']} ok, {counts['failed']} failed, "
+          f"{counts['timeout']} timed out ({report['elapsed_seconds']:.1f}s)")
+    icons = {"ok": "✅", "failed": "❌", "timeout": "⏳"}
+    for check in sorted(report["checks"], key=lambda check: check["status"] == "ok"):
+        detail = check["detail"] if len(check["detail"]) <= 80 else f"{check['detail'][:77]}..."
+        print(f"  {icons.get(check['status'], '❌')} {check['name']:<28} {detail}")
+
+def write_health_report(report, path):
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2)
+    os.replace(tmp_path, path)
+
+def run_verification(os_key, manifest, report_path=None, timeout=VERIFY_TIMEOUT):
+    """Checks the installation, prints the report and saves it as JSON; returns True when healthy."""
+    print("\nVerifying installed tools...")
+    report = verify_installation(os_key, manifest, timeout=timeout)
+    print_health_report(report)
+    report_path = report_path or default_health_report_path()
+    try:
+        write_health_report(report, report_path)
+        print(f"ℹ️  Wrote health report to {report_path}")
+    except OSError as e:
+        print(f"⚠️  Could not write health report to {report_path}: {e}")
+    return report["healthy"]
+
+STATE_VERSION = 1
+
+# Files whose metadata changes whenever a manager installs or removes something
+MANAGER_STATE_PATHS = {
+    "apt": ["/var/lib/dpkg/status"],
+    "brew": ["/opt/homebrew/Cellar", "/opt/homebrew/Caskroom", "/usr/local/Cellar", "/usr/local/Caskroom"],
+    "winget": [os.path.expanduser("~\\AppData\\Local\\Microsoft\\WinGet\\Packages")],
+    "cargo": [os.path.expanduser("~/.cargo/.crates.toml"), os.path.expanduser("~/.cargo/.crates2.json")],
+}
+
+_state_lock = threading.Lock()
+
+def default_state_path():
+    """Returns the state file location, honouring XDG_STATE_HOME."""
+    state_home = os.environ.get("XDG_STATE_HOME") or os.path.expanduser("~/.local/state")
+    return os.path.join(state_home, "dotfiles", "install-state.json")
+
+def load_state(path):
+    """Loads the state file, starting fresh if it is missing, unreadable or from another version."""
+    # "skipped" and "ran" collect this run's recorded steps by outcome; they are not saved
+    state = {"version": STATE_VERSION, "path": path, "steps": {}, "skipped": set(), "ran": set()}
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+        if data.get("version") == STATE_VERSION:
+            state["steps"] = data.get("steps", {})
+    except (OSError, ValueError):
+        pass
+    return state
+
+def save_state(state):
+    """Writes the state file atomically so an interrupted run never leaves it half written."""
+    path = state["path"]
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump({"version": STATE_VERSION, "steps": state["steps"]}, f, indent=2, sort_keys=True)
+    os.replace(tmp_path, path)
+
+def path_fingerprint(path):
+    """Describes a file or directory by size and mtime without reading it."""
+    try:
+        stat = os.stat(path)
+        return [path, stat.st_size, stat.st_mtime_ns]
+    except OSError:
+        return [path, None]
+
+def binary_fingerprint(name):
+    """Describes an executable by where it resolves to and its file metadata."""
+    binary = find_tool(name)
+    return path_fingerprint(binary) if binary else [name, None]
+
+def link_fingerprint(path):
+    """Describes a symlink by its target."""
+    try:
+        return [path, os.readlink(path)]
+    except OSError:
+        return [path, None]
 
-            return True
+def file_hash(path):
+    """Returns the sha256 of a file's content."""
+    try:
+        with open(path, "rb") as f:
+            return hashlib.sha256(f.read()).hexdigest()
+    except OSError:
+        return None
+
+def make_fingerprint(*parts):
+    """Hashes JSON-serialisable parts into a single fingerprint string."""
+    return hashlib.sha256(json.dumps(parts, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+def step_unchanged(state, name, fingerprint, force=False):
+    """Checks whether a step completed before with the fingerprint it has now."""
+    recorded = state["steps"].get(name, {}).get("fingerprint") if state else None
+    return not force and recorded is not None and recorded == fingerprint()
+
+def run_recorded_step(state, name, fingerprint, func, force=False):
+    """Runs func unless the state file says it already completed with the same fingerprint.
+
+    fingerprint is a callable so it can be computed before the step (to decide
+    whether to skip) and again afterwards (to record what the step produced).
+    A step returning False is treated as failed and is not recorded.
+    """
+    if state is None:
+        return func()
+
+    if step_unchanged(state, name, fingerprint, force):
+        print(f"\nℹ️  {name}: unchanged since last run, skipping")
+        with _state_lock:
+            state.setdefault("skipped", set()).add(name)
+        return True
+
+    with _state_lock:
+        state.setdefault("ran", set()).add(name)
+    result = func()
+    if result is not False:
+        with _state_lock:
+            state["steps"][name] = {
+                "fingerprint": fingerprint(),
+                "completed_at": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+            }
+            save_state(state)
+    return result
+
+def nothing_changed(state):
+    """Whether every recorded step of this run was skipped as unchanged."""
+    return bool(state and state.get("skipped")) and not state.get("ran")
+
+def acquire_run_lock(state_path):
+    """Takes an exclusive lock next to the state file so overlapping runs don't race.
+
+    Returns the open lock file (keep it alive for the run), or None if another
+    run holds the lock. Locking is skipped on platforms without fcntl.
+    """
+    try:
+        import fcntl
+    except ImportError:
+        return True
+    lock_path = f"{state_path}.lock"
+    os.makedirs(os.path.dirname(lock_path), exist_ok=True)
+    lock_file = open(lock_path, "w")
+    try:
+        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        lock_file.close()
+        return None
+    return lock_file
+
+# Bump when the compiled manifest layout changes so old cache entries are ignored
+MANIFEST_VERSION = 2
+
+# Package manager used by each OS section of packages.json
+OS_MANAGERS = {"macOS": "brew", "Windows": "winget", "Linux": "apt"}
+
+MANIFEST_OS_KEYS = {"pkg", "cargo", "oh_my_posh"}
+MANIFEST_TOOL_KEYS = {"brew", "apt", "winget", "cargo", "requires", "needed_by", "bin"}
+
+# Stages a tool can be needed by; such tools are installed in pkg-prerequisites
+# so those stages can start before the rest of the package list is done
+PREREQUISITE_STAGES = ["cargo", "oh-my-posh"]
+
+# oh-my-posh package IDs on the managers that ship it
+OMP_PACKAGES = ["oh-my-posh", "JanDeDobbeleer.OhMyPosh"]
+
+class ManifestError(ValueError):
+    """Raised when packages.json does not match the manifest schema."""
+
+    def __init__(self, errors):
+        super().__init__("; ".join(errors))
+        self.errors = errors
+
+def _is_name_list(value):
+    return isinstance(value, list) and all(isinstance(item, str) and item for item in value)
+
+def validate_manifest(raw):
+    """Checks a parsed packages.json against the manifest schema; returns a list of problems.
+
+    The top level holds one section per OS ("macOS", "Windows", "Linux") and
+    an optional "tools" table mapping logical tool names to per-manager
+    package IDs (null when a manager doesn't ship the tool), with optional
+    "requires" ordering hints, "needed_by" stage hints and "bin", the
+    binary (or list of alternative binaries, null for none) that --verify
+    checks for.
+    """
+    if not isinstance(raw, dict):
+        return ["top level must be an object"]
+    errors = []
+
+    tools = raw.get("tools", {})
+    if not isinstance(tools, dict):
+        errors.append("tools: must be an object")
+        tools = {}
+    for name, spec in tools.items():
+        where = f"tools.{name}"
+        if not isinstance(spec, dict):
+            errors.append(f"{where}: must be an object")
+            continue
+        for key, value in spec.items():
+            if key not in MANIFEST_TOOL_KEYS:
+                errors.append(f"{where}: unknown key '{key}'")
+            elif key in ("requires", "needed_by"):
+                if not _is_name_list(value):
+                    errors.append(f"{where}.{key}: must be a list of names")
+                elif key == "needed_by":
+                    errors += [f"{where}.needed_by: unknown stage '{stage}'"
+                               for stage in value if stage not in PREREQUISITE_STAGES]
+            elif key == "bin":
+                if value is not None and not (isinstance(value, str) and value) and not _is_name_list(value):
+                    errors.append(f"{where}.bin: must be a binary name, a list of them or null")
+            elif value is not None and not (isinstance(value, str) and value):
+                errors.append(f"{where}.{key}: must be a package ID or null")
+
+    for os_key, section in raw.items():
+        if os_key == "tools":
+            continue
+        if os_key not in OS_MANAGERS:
+            errors.append(f"{os_key}: unknown OS, expected one of {', '.join(OS_MANAGERS)}")
+            continue
+        if not isinstance(section, dict):
+            errors.append(f"{os_key}: must be an object")
+            continue
+        for key, value in section.items():
+            if key not in MANIFEST_OS_KEYS:
+                errors.append(f"{os_key}: unknown key '{key}'")
+            elif key == "oh_my_posh":
+                if not isinstance(value, bool):
+                    errors.append(f"{os_key}.oh_my_posh: must be true or false")
+            elif not _is_name_list(value):
+                errors.append(f"{os_key}.{key}: must be a list of package names")
+    return errors
+
+def _order_by_requires(names, tools):
+    """Orders names so each comes after the names it requires; otherwise keeps file order."""
+    ordered, visiting, done = [], [], set()
+
+    def visit(name):
+        if name in done:
+            return
+        if name in visiting:
+            cycle = visiting[visiting.index(name):] + [name]
+            raise ManifestError([f"tools: requires cycle {' -> '.join(cycle)}"])
+        visiting.append(name)
+        for dependency in tools.get(name, {}).get("requires", []):
+            if dependency in names:
+                visit(dependency)
+        visiting.pop()
+        done.add(name)
+        ordered.append(name)
+
+    for name in names:
+        visit(name)
+    return ordered
+
+def _resolve_names(names, manager, tools, where, notes):
+    """Maps logical names to package IDs for one manager, dropping duplicates."""
+    ids = []
+    for name in _order_by_requires(list(dict.fromkeys(names)), tools):
+        package = tools.get(name, {}).get(manager, name)
+        if package is None:
+            notes.append(f"{where}: {name} is not available from {manager}, skipping")
+        elif package in ids:
+            notes.append(f"{where}: {name} resolves to {package}, which is already listed")
         else:
-            print(f"❌ Failed to install fish configuration. Exit code: {result.returncode}")
-            if result.stderr:
-                print(f"  Error: {result.stderr.strip()}")
-            if result.stdout:
-                print(f"  Output: {result.stdout.strip()}")
-            return False
-    except FileNotFoundError:
-        print("❌ Fish shell is not installed or not in PATH")
-        return False
+            ids.append(package)
+    for name in dict.fromkeys(names):
+        if names.count(name) > 1:
+            notes.append(f"{where}: {name} is listed {names.count(name)} times")
+    return ids
+
+def _needed_early(names, tools):
+    """Names with a needed_by hint, plus everything they require."""
+    needed, pending = set(), [name for name in names if tools.get(name, {}).get("needed_by")]
+    while pending:
+        name = pending.pop()
+        if name not in needed:
+            needed.add(name)
+            pending += tools.get(name, {}).get("requires", [])
+    return needed
+
+def _binary_checks(names, tools):
+    """Maps logical names to the binaries --verify looks for, skipping tools without one."""
+    checks = {}
+    for name in names:
+        binaries = tools.get(name, {}).get("bin", name)
+        if binaries:
+            checks[name] = [binaries] if isinstance(binaries, str) else list(binaries)
+    return checks
+
+def compile_manifest(raw, source_hash):
+    """Turns a validated packages.json into per-OS install lists of package IDs.
+
+    Each OS entry holds the manager, the prerequisite and remaining package
+    IDs in install order, the cargo crates (None when there is no cargo
+    section), whether the run installs oh-my-posh and the binaries to check
+    for each installed tool.
+    """
+    tools = raw.get("tools", {})
+    compiled = {"version": MANIFEST_VERSION, "source_hash": source_hash, "os": {}, "notes": []}
+    for os_key, section in raw.items():
+        if os_key == "tools":
+            continue
+        manager = OS_MANAGERS[os_key]
+        notes = compiled["notes"]
+        names = section.get("pkg", [])
+        early = _needed_early(names, tools)
+        prerequisites = _resolve_names([name for name in names if name in early], manager, tools,
+                                       f"{os_key}.pkg", notes)
+        packages = [package for package in
+                    _resolve_names([name for name in names if name not in early], manager, tools,
+                                   f"{os_key}.pkg", notes)
+                    if package not in prerequisites]
+        cargo = None
+        if "cargo" in section:
+            cargo = _resolve_names(section["cargo"], "cargo", tools, f"{os_key}.cargo", notes)
+        oh_my_posh = bool(section.get("oh_my_posh"))
+        installed = [name for name in names if tools.get(name, {}).get(manager, name) is not None]
+        if cargo is not None:
+            installed += [name for name in section["cargo"] if tools.get(name, {}).get("cargo", name) is not None]
+        if oh_my_posh:
+            installed.append("oh-my-posh")
+        compiled["os"][os_key] = {
+            "manager": manager,
+            "prerequisites": prerequisites,
+            "packages": packages,
+            "cargo": cargo,
+            # Linux downloads the release binary; elsewhere it's a regular package
+            "oh_my_posh": oh_my_posh,
+            "installs_oh_my_posh": oh_my_posh if os_key == "Linux" else
+                                   any(package in OMP_PACKAGES for package in prerequisites + packages),
+            "binaries": _binary_checks(dict.fromkeys(installed), tools),
+        }
+    return compiled
+
+def load_manifest(path="packages.json", cache_dir=None):
+    """Loads the compiled manifest for packages.json, compiling it on a cache miss.
+
+    Compiled manifests are cached under the sha256 of the file's bytes, so an
+    unchanged packages.json is never re-validated or re-resolved. Raises
+    ManifestError when the file is invalid.
+    """
+    with open(path, "rb") as f:
+        data = f.read()
+    source_hash = hashlib.sha256(data).hexdigest()
+    manifest_dir = os.path.join(cache_dir or default_cache_dir(), "manifest")
+    cache_path = os.path.join(manifest_dir, f"{source_hash}.json")
+    try:
+        with open(cache_path, "r", encoding="utf-8") as f:
+            compiled = json.load(f)
+        if compiled.get("version") == MANIFEST_VERSION:
+            return compiled
+    except (OSError, ValueError):
+        pass
+
+    try:
+        raw = json.loads(data)
+    except ValueError as e:
+        raise ManifestError([f"invalid JSON: {e}"])
+    errors = validate_manifest(raw)
+    if errors:
+        raise ManifestError(errors)
+    compiled = compile_manifest(raw, source_hash)
+
+    try:
+        os.makedirs(manifest_dir, exist_ok=True)
+        # Only the current manifest is worth keeping
+        for name in os.listdir(manifest_dir):
+            if name.endswith(".json"):
+                os.remove(os.path.join(manifest_dir, name))
+        tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(compiled, f, indent=2)
+        os.replace(tmp_path, cache_path)
+    except OSError:
+        pass
+    return compiled
+
+DEFAULT_JOBS = 4
+
+# Backoff for stages re-queued because a package manager's lock was held:
+# the first retry waits LOCK_RETRY_INITIAL seconds, doubling up to
+# LOCK_RETRY_MAX_DELAY, and a stage gives up after LOCK_WAIT_TIMEOUT
+LOCK_RETRY_INITIAL = 2
+LOCK_RETRY_MAX_DELAY = 60
+LOCK_WAIT_TIMEOUT = 600
+
+class _StageOutput:
+    """Stdout proxy that sends print() output from stage threads to per-stage buffers."""
+
+    def __init__(self, stream):
+        self._stream = stream
+        self._local = threading.local()
+
+    def capture(self, buffer):
+        self._local.buffer = buffer
+
+    def write(self, text):
+        buffer = getattr(self._local, "buffer", None)
+        if buffer is not None:
+            return buffer.write(text)
+        return self._stream.write(text)
+
+    def flush(self):
+        self._stream.flush()
+
+    def emit(self, text):
+        """Writes straight to the real stream, bypassing any capture."""
+        self._stream.write(text)
+        self._stream.flush()
+
+    def __getattr__(self, name):
+        return getattr(self._stream, name)
+
+def make_stage(name, func, deps=()):
+    """Describes a unit of work for run_stages and the stages it must wait for."""
+    return {"name": name, "func": func, "deps": list(deps)}
+
+def _run_stage(stage, output, capture):
+    """Runs one stage in a worker thread, capturing its output if requested."""
+    buffer = io.StringIO()
+    if capture:
+        output.capture(buffer)
+    start = time.perf_counter()
+    value = error = None
+    try:
+        value = stage["func"]()
     except Exception as e:
-        print(f"❌ Unexpected error installing fish configuration: {e}")
-        return False
+        error = e
+    finally:
+        output.capture(None)
+    end = time.perf_counter()
+    record_timing("stage", stage["name"], start, end,
+                  exit_code=1 if error is not None or value is False else 0)
+    return value, error, buffer.getvalue(), end - start
+
+# Stages that only speed later ones up; their failing doesn't fail the run
+ADVISORY_STAGES = {"pkg-prefetch"}
+
+def failed_stages(stages, results):
+    """Names of stages that raised, were skipped or returned False."""
+    return [stage["name"] for stage in stages
+            if stage["name"] not in ADVISORY_STAGES
+            and (stage["name"] not in results or results[stage["name"]] is False)]
+
+def run_stages(stages, jobs=DEFAULT_JOBS, lock_timeout=LOCK_WAIT_TIMEOUT):
+    """Runs stages concurrently as soon as their dependencies have finished.
+
+    Each stage's output is buffered and printed in the order the stages were
+    declared, so the log reads the same as a serial run. With jobs=1 stages run
+    one at a time and print live. A stage whose dependency raised is skipped.
+    A stage that raises ManagerLocked is re-queued with exponential backoff
+    for up to lock_timeout seconds; it gives its worker back while it waits,
+    so stages that don't need the lock keep running.
+    Returns a dict mapping stage names to their return values.
+    """
+    names = [stage["name"] for stage in stages]
+    for stage in stages:
+        unknown = [dep for dep in stage["deps"] if dep not in names]
+        if unknown:
+            raise ValueError(f"Stage '{stage['name']}' depends on unknown stage(s): {', '.join(unknown)}")
+
+    capture = jobs > 1
+    original_stdout = sys.stdout
+    output = _StageOutput(original_stdout)
+    results = {}
+    failed = set()
+    finished = {}
+    pending = list(stages)
+    running = {}
+    # (ready at, stage) for stages waiting out a package manager lock
+    waiting = []
+    lock_waits = {}
+    next_to_print = 0
+
+    if capture:
+        sys.stdout = output
+    try:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, jobs)) as executor:
+            while pending or running or waiting:
+                for ready_at, stage in list(waiting):
+                    if ready_at <= time.monotonic():
+                        waiting.remove((ready_at, stage))
+                        future = executor.submit(_run_stage, stage, output, capture)
+                        running[future] = stage
+
+                for stage in list(pending):
+                    if any(dep in failed for dep in stage["deps"]):
+                        pending.remove(stage)
+                        failed.add(stage["name"])
+                        finished[stage["name"]] = f"\n⚠️  Skipping {stage['name']}: a stage it depends on failed\n"
+                    elif all(dep in results for dep in stage["deps"]):
+                        pending.remove(stage)
+                        future = executor.submit(_run_stage, stage, output, capture)
+                        running[future] = stage
+
+                next_ready = min(ready_at for ready_at, _ in waiting) if waiting else None
+                if running:
+                    timeout = max(0, next_ready - time.monotonic()) if next_ready is not None else None
+                    done, _ = concurrent.futures.wait(running, timeout=timeout,
+                                                      return_when=concurrent.futures.FIRST_COMPLETED)
+                    for future in done:
+                        stage = running.pop(future)
+                        value, error, text, elapsed = future.result()
+                        if isinstance(error, ManagerLocked):
+                            first_try, delay = lock_waits.get(stage["name"], (time.monotonic() - elapsed, 0))
+                            delay = min(LOCK_RETRY_MAX_DELAY, delay * 2 or LOCK_RETRY_INITIAL)
+                            if time.monotonic() + delay - first_try <= lock_timeout:
+                                # The next attempt starts the stage over, so this
+                                # attempt's output is dropped rather than replayed
+                                lock_waits[stage["name"]] = (first_try, delay)
+                                waiting.append((time.monotonic() + delay, stage))
+                                output.emit(f"\n⏳ {stage['name']}: {error}, retrying in {delay:.0f}s\n")
+                                continue
+                            error = ManagerLocked(f"{error}, gave up after {time.monotonic() - first_try:.0f}s")
+                        if error is not None:
+                            failed.add(stage["name"])
+                            text += f"\n❌ Stage {stage['name']} failed after {elapsed:.1f}s: {error}\n"
+                        else:
+                            results[stage["name"]] = value
+                        finished[stage["name"]] = text
+                elif waiting:
+                    time.sleep(max(0, next_ready - time.monotonic()))
+                elif pending:
+                    # Nothing running and nothing runnable means a dependency cycle
+                    cycle = ", ".join(stage["name"] for stage in pending)
+                    raise ValueError(f"Stage dependency cycle between: {cycle}")
+
+                # Flush output in declaration order as earlier stages complete
+                while next_to_print < len(names) and names[next_to_print] in finished:
+                    output.emit(finished[names[next_to_print]])
+                    next_to_print += 1
+    finally:
+        if capture:
+            sys.stdout = original_stdout
+
+    return results
+
+def parse_args(argv=None):
+    """Parses command line options."""
+    parser = argparse.ArgumentParser(description="Installs packages and dotfiles for this machine.")
+    parser.add_argument("--jobs", "-j", type=int, default=DEFAULT_JOBS,
+                        help=f"number of install stages to run at once (default: {DEFAULT_JOBS})")
+    parser.add_argument("--lock-timeout", type=float, default=LOCK_WAIT_TIMEOUT, metavar="SECONDS",
+                        help="how long to keep retrying apt/brew while another process holds their lock "
+                             "(default: %(default)s)")
+    parser.add_argument("--cargo-cpus", type=int, default=None,
+                        help="CPU cores Cargo builds may use in total (default: all cores)")
+    parser.add_argument("--profile-json", metavar="PATH",
+                        help="write a Chrome trace-event profile of every stage and command to PATH")
+    parser.add_argument("--package-cache", metavar="DIR",
+                        help="download apt/brew packages into DIR and install from it (a directory of .deb files works offline)")
+    parser.add_argument("--offline", action="store_true",
+                        help="never use the network for installers; use only --mirror and the download cache")
+    parser.add_argument("--mirror", metavar="DIR",
+                        help="take installers and artifacts from DIR (checked against DIR/SHA256SUMS), "
+                             "downloading whatever it lacks unless --offline is given")
+    parser.add_argument("--fill-mirror", metavar="DIR",
+                        help="download every installer and artifact into DIR for use with --mirror, then exit")
+    parser.add_argument("--plan", nargs="?", const="text", choices=["text", "json"],
+                        help="print the actions a run would take and their estimated cost, without installing anything")
+    parser.add_argument("--font-archive", metavar="ZIP",
+                        help="install the FiraCode Nerd Font from this local zip instead of downloading it")
+    parser.add_argument("--refresh-shell-cache", action="store_true",
+                        help="only rebuild the cached fish init script and the compiled zsh startup files "
+                             "if their inputs changed")
+    parser.add_argument("--links-only", action="store_true",
+                        help="only create or fix the dotfile symlinks, then exit")
+    parser.add_argument("--keep-conflicts", action="store_true",
+                        help="leave real files that are in the way of a dotfile link alone instead of "
+                             "moving them to <path>.backup-<timestamp>")
+    parser.add_argument("--verify", action="store_true",
+                        help="only check that every tool and dotfile link is in place and write a health report")
+    parser.add_argument("--verify-timeout", type=float, default=VERIFY_TIMEOUT, metavar="SECONDS",
+                        help="time each health check may take (default: %(default)s)")
+    parser.add_argument("--health-report", metavar="PATH",
+                        help="where to write the JSON health report (default: next to the state file)")
+    parser.add_argument("--upgrade", action="store_true",
+                        help="upgrade the installed packages and crates that are outdated instead of installing")
+    parser.add_argument("--fleet", metavar="INVENTORY",
+                        help="provision every host in INVENTORY over ssh instead of this machine")
+    parser.add_argument("--fleet-jobs", type=int, default=FLEET_JOBS, metavar="N",
+                        help="hosts to provision at once in --fleet mode (default: %(default)s)")
+    parser.add_argument("--ssh-option", action="append", default=[], metavar="OPTION",
+                        help="extra ssh -o option for --fleet, e.g. StrictHostKeyChecking=accept-new (repeatable)")
+    parser.add_argument("--remote-args", default="", metavar="ARGS",
+                        help="arguments passed to install_packages.py on each --fleet host")
+    parser.add_argument("--fleet-report", metavar="PATH", help="also write the --fleet report as JSON to PATH")
+    parser.add_argument("--force", action="store_true",
+                        help="ignore the state file and re-run every step")
+    parser.add_argument("--state-file", default=default_state_path(),
+                        help="where completed steps are recorded (default: %(default)s)")
+    return parser.parse_args(argv)
+
+def stage_fingerprints(os_key, package_manager, manifest_hash):
+    """Returns a callable per stage name that fingerprints that stage's inputs and results."""
+    home = os.path.expanduser("~")
+    script_dir = os.getcwd()
 
-    def install_omp_font(os_key):
-        """Installs FiraCode font using oh-my-posh for all platforms."""
-        print("\nInstalling FiraCode font...")
+    def manager_fingerprint():
+        return make_fingerprint(manifest_hash, os_key, binary_fingerprint(package_manager),
+                                [path_fingerprint(path) for path in MANAGER_STATE_PATHS.get(package_manager, [])])
+
+    def cargo_fingerprint():
+        return make_fingerprint(manifest_hash, binary_fingerprint("cargo"),
+                                [path_fingerprint(path) for path in MANAGER_STATE_PATHS["cargo"]])
+
+    def links_fingerprint():
+        return make_fingerprint([link_fingerprint(link) for link, _ in dotfile_links(home, script_dir)])
+
+    def omp_fingerprint():
+        return make_fingerprint(binary_fingerprint("oh-my-posh"))
+
+    def font_fingerprint():
+        return make_fingerprint(os_key, path_fingerprint(font_stamp_path()))
+
+    def fish_post_fingerprint():
+        return make_fingerprint(links_fingerprint(), binary_fingerprint("fish"), omp_fingerprint())
+
+    def zsh_fingerprint():
+        sources = [file_hash(os.path.join(script_dir, "zsh", name)) for name in ("zshrc.sh", "aliases.sh", "functions.sh")]
+        artifacts = [os.path.join(home, ".zshrc.zwc"), os.path.join(zsh_cache_dir(), "functions.zsh"),
+                     os.path.join(home, ".zplug", "init.zsh")]
+        return make_fingerprint(links_fingerprint(), binary_fingerprint("zsh"), binary_fingerprint("git"),
+                                sources, [path_fingerprint(path) for path in artifacts])
+
+    return {
+        "pkg-prerequisites": manager_fingerprint,
+        "pkg": manager_fingerprint,
+        "cargo": cargo_fingerprint,
+        "links": links_fingerprint,
+        "oh-my-posh": omp_fingerprint,
+        "font": font_fingerprint,
+        "fish-post": fish_post_fingerprint,
+        "zsh": zsh_fingerprint,
+    }
+
+def build_install_stages(os_key, package_manager, manifest, cargo_cpus=None, state=None, force=False,
+                         backup_conflicts=True, font_archive=None):
+    """Builds the dependency graph of install stages for this OS.
+
+    manifest is this OS's entry from the compiled manifest. When a state is
+    given, each stage is skipped if its fingerprint matches the one recorded
+    after its last successful run. The links stage always runs: it only
+    changes links that differ, so it is as cheap as a state check.
+    """
+    stages = []
+    prerequisites = manifest["prerequisites"]
+    remaining = manifest["packages"]
+    packages = prerequisites + remaining
+    manager_ok = {}
+    fingerprints = stage_fingerprints(os_key, package_manager, manifest["source_hash"])
+
+    def recorded(name, func):
+        return lambda: run_recorded_step(state, name, fingerprints[name], func, force=force)
+
+    # A stage that returns False is neither recorded in the state file nor
+    # counted as done, so packages that failed are tried again next run
+    def install_prerequisites():
+        manager_ok["ok"] = check_and_install_manager(package_manager)
+        if not manager_ok["ok"]:
+            return False
+        return install_with_manager(prerequisites, package_manager) if prerequisites else True
 
-        # Skip font installation in WSL
-        if os_key == "Linux" and is_wsl():
-            print("⚠️  Skipping font installation in WSL environment")
-            print("   Fonts should be installed from Windows host, not WSL")
-            print("   Run 'oh-my-posh font install firacode' from Windows PowerShell/Command Prompt")
-            return True  # Return True since this is expected behavior
+    def install_packages():
+        if manager_ok.get("ok") is False:
+            return False
+        return install_with_manager(remaining, package_manager) if remaining else True
 
-        # Check if FiraCode font is already installed
-        if is_firacode_installed(os_key):
-            print("ℹ️  FiraCode font is already installed, skipping installation")
+    def prefetch():
+        # Nothing to fetch when the pkg stage is going to be skipped
+        if manager_ok.get("ok") is False or step_unchanged(state, "pkg", fingerprints["pkg"], force):
             return True
+        return prefetch_packages(remaining, package_manager)
 
-        # Add a small delay to ensure package installation has completed
-        import time
-        time.sleep(2)
-        # Prepare environment based on OS
-        updated_env = os.environ.copy()
-        omp_binary_path = None
-        try:
-            if os_key == "Linux":
-                # Update PATH for current session to include oh-my-posh
-                home = os.path.expanduser("~")
-                omp_path = os.path.join(home, '.local/bin')
-                omp_binary_path = os.path.join(omp_path, 'oh-my-posh')
-                updated_env['PATH'] = f"{omp_path}:{updated_env.get('PATH', '')}"
-    
-                # Debug: Check if binary exists
-                print(f"  Checking for oh-my-posh at: {omp_binary_path}")
-                if os.path.exists(omp_binary_path):
-                    print(f"  ✅ Found oh-my-posh binary")
-                else:
-                    print(f"  ❌ oh-my-posh binary not found at expected location")
-    
-            elif os_key == "macOS":
-                # Add common Homebrew paths for oh-my-posh
-                homebrew_paths = ['/opt/homebrew/bin', '/usr/local/bin']
-                current_path = updated_env.get('PATH', '')
-                for path in homebrew_paths:
-                    if path not in current_path:
-                        updated_env['PATH'] = f"{path}:{current_path}"
-                        current_path = updated_env['PATH']
-            elif os_key == "Windows":
-                # On Windows, find oh-my-posh installed via WinGet
-                possible_paths = [
-                    os.path.expanduser("~\\AppData\\Local\\Programs\\oh-my-posh\\bin"),
-                    "C:\\Program Files\\oh-my-posh\\bin",
-                    os.path.expanduser("~\\AppData\\Local\\Microsoft\\WinGet\\Packages\\JanDeDobbeleer.OhMyPosh_Microsoft.Winget.Source_8wekyb3d8bbwe")
-                ]
-                current_path = updated_env.get('PATH', '')
-                omp_binary_path = None
-    
-                print("  Checking WinGet installation paths for oh-my-posh...")
-                for path in possible_paths:
-                    omp_exe = os.path.join(path, 'oh-my-posh.exe')
-                    print(f"    Checking: {omp_exe}")
-                    if os.path.exists(omp_exe):
-                        print(f"    ✅ Found oh-my-posh.exe at: {path}")
-                        omp_binary_path = omp_exe
-                        if path not in current_path:
-                            updated_env['PATH'] = f"{path};{current_path}"
-                        break
-                    else:
-                        print(f"    ❌ Not found at: {path}")
-    
-                if not omp_binary_path:
-                    print("  ❌ oh-my-posh.exe not found in any expected WinGet locations")
-    
-            # Debug: Show the PATH we're using
-            print(f"  Using PATH: {updated_env['PATH'][:100]}...")
-    
-            # Try to run oh-my-posh version first to verify it's accessible
-            print("  Checking oh-my-posh accessibility...")
-            version_result = subprocess.run(["oh-my-posh", "--version"],
-                                           capture_output=True, text=True, env=updated_env)
-    
-            if version_result.returncode == 0:
-                print(f"  ✅ oh-my-posh is accessible, version: {version_result.stdout.strip()}")
-            else:
-                print(f"  ❌ oh-my-posh version check failed: {version_result.stderr.strip()}")
-                raise FileNotFoundError("oh-my-posh not accessible")
-    
-            # Try to run oh-my-posh font install
-            print("  Running font installation...")
-            try:
-                result = subprocess.run(["oh-my-posh", "font", "install", "firacode"],
-                                      capture_output=True, text=True, env=updated_env, timeout=60)
-    
-                print(f"  Font installation exit code: {result.returncode}")
-                if result.stdout:
-                    print(f"  Stdout: {result.stdout.strip()}")
-                if result.stderr:
-                    print(f"  Stderr: {result.stderr.strip()}")
-    
-                if result.returncode == 0:
-                    print("✅ FiraCode font installed successfully")
-                    return True
-                else:
-                    # If it fails, provide helpful message
-                    print(f"❌ Failed to install FiraCode font. Exit code: {result.returncode}")
-                    print("You can install it manually later with: oh-my-posh font install firacode")
-                    return False
-    
-            except subprocess.TimeoutExpired:
-                print("❌ Font installation timed out after 60 seconds")
-                print("You can install it manually later with: oh-my-posh font install firacode")
-                return False
-
-        except FileNotFoundError as e:
-            print("❌ Error: 'oh-my-posh' command not found. Make sure oh-my-posh is installed and in PATH.")
-            print("You can install it manually later with: oh-my-posh font install firacode")
-            return False
-        except Exception as e:
-            print(f"❌ Unexpected error installing font: {e}")
-            print("You can install it manually later with: oh-my-posh font install firacode")
+    def install_cargo():
+        if not check_and_install_cargo():
             return False
+        return install_cargo_packages(manifest["cargo"], cpu_budget=cargo_cpus)
+
+    if packages:
+        stages.append(make_stage("pkg-prerequisites",
+                                 recorded("pkg-prerequisites", install_prerequisites)))
+        pkg_deps = ["pkg-prerequisites"]
+        # Downloads for the main list run alongside the cargo and oh-my-posh
+        # stages; the install then unpacks from the local archive cache
+        if remaining and package_manager in PREFETCH_MANAGERS:
+            stages.append(make_stage("pkg-prefetch", prefetch, ["pkg-prerequisites"]))
+            pkg_deps = ["pkg-prefetch"]
+        stages.append(make_stage("pkg", recorded("pkg", install_packages), pkg_deps))
+    base = ["pkg-prerequisites"] if packages else []
+
+    # Cargo only needs curl and a C toolchain, so it builds alongside the main package list
+    if manifest["cargo"] is not None:
+        stages.append(make_stage("cargo", recorded("cargo", install_cargo), base))
+
+    shell_stages = []
+    if os_key in ["macOS", "Linux"]:
+        # Linking needs nothing installed, so it runs straight away
+        stages.append(make_stage("links", lambda: install_dotfile_links(backup=backup_conflicts)))
+        shell_stages.append("links")
+        if packages:
+            # fish itself comes from the package manager
+            shell_stages.append("pkg")
+
+    if os_key == "Linux" and manifest["oh_my_posh"]:
+        stages.append(make_stage("oh-my-posh",
+                                 recorded("oh-my-posh", install_oh_my_posh_linux), base))
+
+    if manifest["installs_oh_my_posh"]:
+        # The font comes straight from its archive, so it needs nothing installed first
+        stages.append(make_stage("font", recorded("font", lambda: install_firacode_font(os_key, font_archive))))
+
+    if os_key in ["macOS", "Linux"]:
+        deps = shell_stages + [stage["name"] for stage in stages if stage["name"] in ("font", "oh-my-posh")]
+        stages.append(make_stage("fish-post",
+                                 recorded("fish-post", lambda: setup_fish_post_install(os_key)),
+                                 deps))
+        # zplug and the compiled startup files only need zsh, git and ~/.zshrc
+        stages.append(make_stage("zsh", recorded("zsh", lambda: setup_zsh(force=force)), shell_stages))
+    return stages
+
+def build_upgrade_stages(package_manager, manifest, cargo_cpus=None):
+    """Builds the stages for --upgrade: one per manager, all running at once.
+
+    Nothing is installed that is not there already, and the state file is
+    left alone.
+    """
+    stages = []
+    packages = manifest["prerequisites"] + manifest["packages"]
+    if packages:
+        stages.append(make_stage(f"upgrade-{package_manager}",
+                                 lambda: upgrade_with_manager(packages, package_manager)))
+    if manifest["cargo"]:
+        stages.append(make_stage("upgrade-cargo",
+                                 lambda: upgrade_cargo_packages(manifest["cargo"], cpu_budget=cargo_cpus)))
+    return stages
+
+# Rough wall-clock estimates, in seconds, used by --plan
+PLAN_COSTS = {
+    "apt": (15, 5),       # fixed cost per invocation, cost per package
+    "brew": (20, 15),
+    "apt-prefetch": (5, 3),
+    "brew-prefetch": (5, 10),
+    "apt-cached": (10, 2),  # installing what the prefetch stage downloaded
+    "brew-cached": (15, 5),
+    "winget": (0, 30),
+    "brew-bootstrap": 120,
+    "rustup": 60,
+    "cargo-binstall": 5,
+    "cargo-compile": 180,
+    "oh-my-posh": 10,
+    "oh-my-posh-cached": 1,
+    "zplug": 30,
+    "zcompile": 1,
+    "font": 30,
+    "font-cached": 2,
+    "symlink": 0.1,
+    "verify": 0.5,
+}
+
+def _manager_install_cost(package_manager, count, kind=None):
+    fixed, per_package = PLAN_COSTS.get(f"{package_manager}-{kind}" if kind else package_manager, (0, 30))
+    if package_manager in BATCH_MANAGERS:
+        return fixed + per_package * count
+    return (fixed + per_package) * count
+
+def _plan_manager_packages(packages, package_manager, kind=None):
+    missing = [package for package in packages if not check_package_installed(package, package_manager)]
+    if not missing:
+        return []
+    if kind == "prefetch":
+        command = describe_command(build_prefetch_command(missing, package_manager))
+        return [(command, _manager_install_cost(package_manager, len(missing), kind))]
+    if package_manager in BATCH_MANAGERS:
+        command = describe_command(build_install_command(missing, package_manager))
+        return [(command, _manager_install_cost(package_manager, len(missing), kind))]
+    return [(describe_command(build_install_command([package], package_manager)),
+             _manager_install_cost(package_manager, 1)) for package in missing]
+
+def plan_stage_actions(name, os_key, package_manager, manifest):
+    """Predicts the actions one stage would take on this machine, as (description, seconds) pairs."""
+    home = os.path.expanduser("~")
+    actions = []
+
+    if name == "pkg-prerequisites":
+        if package_manager == "brew" and find_tool("brew") is None:
+            actions.append(("install Homebrew", PLAN_COSTS["brew-bootstrap"]))
+        elif package_manager == "winget" and find_tool("winget") is None:
+            actions.append(("WinGet is missing, packages cannot be installed", 0))
+            return actions
+        actions += _plan_manager_packages(manifest["prerequisites"], package_manager)
+
+    elif name == "pkg-prefetch":
+        actions += _plan_manager_packages(manifest["packages"], package_manager, "prefetch")
+
+    elif name == "pkg":
+        kind = "cached" if package_manager in PREFETCH_MANAGERS else None
+        actions += _plan_manager_packages(manifest["packages"], package_manager, kind)
+
+    elif name == "cargo":
+        if find_tool("cargo") is None:
+            actions.append(("install Rust with rustup", PLAN_COSTS["rustup"]))
+            missing = list(manifest["cargo"])
+        else:
+            missing = [crate for crate in manifest["cargo"]
+                       if not check_package_installed(crate, "cargo")]
+        if missing and has_cargo_binstall():
+            actions.append((f"cargo binstall {' '.join(missing)} (compile on miss)",
+                            PLAN_COSTS["cargo-binstall"] * len(missing)))
+        else:
+            actions += [(f"cargo install {crate}", PLAN_COSTS["cargo-compile"]) for crate in missing]
+
+    elif name == "links":
+        for link, target in dotfile_links(home, os.getcwd()):
+            status = link_status(link, target)
+            if status in ("missing", "stale"):
+                actions.append((f"link {link} -> {target}", PLAN_COSTS["symlink"]))
+            elif status == "conflict":
+                actions.append((f"back up {link} and link it -> {target}", PLAN_COSTS["symlink"]))
+
+    elif name == "oh-my-posh":
+        url = DOWNLOADS.get(f"posh-linux-{linux_arch()}")
+        cached = _load_download_index().get(url)
+        fresh = cached and time.time() - cached.get("fetched_at", 0) < DOWNLOAD_MAX_AGE
+        cost = PLAN_COSTS["oh-my-posh-cached"] if fresh else PLAN_COSTS["oh-my-posh"]
+        actions.append((f"install oh-my-posh into {os.path.join(home, '.local/bin')}", cost))
+
+    elif name == "font":
+        if not (os_key == "Linux" and is_wsl()) and not is_firacode_installed(os_key):
+            cached = _load_download_index().get(DOWNLOADS[FONT_ARCHIVE])
+            fresh = cached and time.time() - cached.get("fetched_at", 0) < DOWNLOAD_MAX_AGE
+            cost = PLAN_COSTS["font-cached"] if fresh else PLAN_COSTS["font"]
+            actions.append((f"install FiraCode Nerd Font into {user_font_dir(os_key)}", cost))
+
+    elif name == "fish-post":
+        actions.append(("verify fish configuration", PLAN_COSTS["verify"]))
+
+    elif name == "zsh":
+        if find_tool("zsh") is not None:
+            if not os.path.exists(os.path.join(home, ".zplug", "init.zsh")):
+                actions.append((f"clone zplug into {os.path.join(home, '.zplug')} and install its plugins",
+                                PLAN_COSTS["zplug"]))
+            actions.append(("zcompile the zsh startup files and autoloaded functions", PLAN_COSTS["zcompile"]))
+
+    return actions
+
+def build_install_plan(os_key, package_manager, manifest, state=None, force=False):
+    """Works out what main() would do on this machine without running any installer.
+
+    Returns a dict with one entry per stage (in run order) holding its predicted
+    actions, plus serial and critical-path time estimates.
+    """
+    stages = build_install_stages(os_key, package_manager, manifest, state=state, force=force)
+    fingerprints = stage_fingerprints(os_key, package_manager, manifest["source_hash"])
+    plan = {"os": os_key, "package_manager": package_manager, "stages": []}
+    finish = {}
+
+    for stage in stages:
+        name = stage["name"]
+        if name in fingerprints and step_unchanged(state, name, fingerprints[name], force):
+            actions, note = [], "unchanged since last run"
+        else:
+            actions = plan_stage_actions(name, os_key, package_manager, manifest)
+            note = "" if actions else "nothing to do"
+        cost = sum(seconds for _, seconds in actions)
+        # Stages start once all their dependencies are done
+        finish[name] = max([finish[dep] for dep in stage["deps"]] + [0]) + cost
+        plan["stages"].append({
+            "stage": name,
+            "deps": stage["deps"],
+            "actions": [{"action": action, "seconds": seconds} for action, seconds in actions],
+            "note": note,
+        })
+
+    # The health checks run once every stage has finished
+    checks = len(manifest["binaries"]) + (len(DOTFILE_LINKS) if os_key in ["macOS", "Linux"] else 0)
+    plan["stages"].append({
+        "stage": "verify",
+        "deps": [stage["name"] for stage in stages],
+        "actions": [{"action": f"check {checks} tools and links, write the health report",
+                     "seconds": PLAN_COSTS["verify"]}],
+        "note": "",
+    })
+    finish["verify"] = max(finish.values(), default=0) + PLAN_COSTS["verify"]
+
+    plan["changes"] = sum(len(stage["actions"]) for stage in plan["stages"]
+                          if stage["stage"] not in ("fish-post", "verify"))
+    plan["serial_seconds"] = sum(action["seconds"] for stage in plan["stages"] for action in stage["actions"])
+    plan["critical_path_seconds"] = max(finish.values()) if finish else 0
+    return plan
+
+def format_duration(seconds):
+    minutes, seconds = divmod(int(round(seconds)), 60)
+    return f"{minutes}m {seconds:02d}s" if minutes else f"{seconds}s"
+
+def print_install_plan(plan):
+    """Prints a plan from build_install_plan as a table."""
+    print(f"Install plan for {plan['os']} ({plan['package_manager']}):")
+    step = 0
+    for stage in plan["stages"]:
+        if not stage["actions"]:
+            print(f"   -  {stage['stage']:<18} ({stage['note']})")
+            continue
+        for action in stage["actions"]:
+            step += 1
+            print(f"  {step:>2}. {stage['stage']:<18} {action['action']:<60} ~{format_duration(action['seconds'])}")
+
+    if plan["changes"] == 0:
+        print("\n✅ Nothing to install, this machine is already provisioned")
+    print(f"\nEstimated time: {format_duration(plan['serial_seconds'])} serial, "
+          f"{format_duration(plan['critical_path_seconds'])} along the critical path")
+
+# Hosts provisioned at once in --fleet mode
+FLEET_JOBS = 8
+
+# Where the repo goes on each host, unless the inventory sets dir=
+FLEET_REMOTE_DIR = "~/dotfiles"
+
+# Repo paths never pushed to hosts when the repo is not a git checkout
+FLEET_EXCLUDE = {".git", "__pycache__", ".pytest_cache", ".venv", "venv"}
+
+# Files generated on this machine, which hold its own paths
+FLEET_GENERATED = re.compile(r"(^|/)(dotfiles_init_cache\.fish|[^/]+\.zwc)$")
+
+FLEET_HOST_OPTIONS = {"name", "port", "identity", "dir", "python"}
+
+def read_inventory(path):
+    """Parses a fleet inventory file.
+
+    Each line is `[user@]host[:port]` optionally followed by key=value
+    options (name, port, identity, dir, python); `#` starts a comment.
+    Raises ValueError on unknown options.
+    """
+    hosts = []
+    with open(path, "r", encoding="utf-8") as f:
+        for number, line in enumerate(f, 1):
+            line = line.split("#", 1)[0].strip()
+            if not line:
+                continue
+            target, *options = line.split()
+            host = {"name": target, "target": target, "port": None, "identity": None,
+                    "dir": FLEET_REMOTE_DIR, "python": "python3"}
+            match = re.match(r"^([^:]+):(\d+)$", target)
+            if match:
+                host["target"], host["port"] = match.group(1), match.group(2)
+            for option in options:
+                key, sep, value = option.partition("=")
+                if not sep or key not in FLEET_HOST_OPTIONS:
+                    raise ValueError(f"{path}:{number}: unknown host option '{option}'")
+                host[key] = value
+            hosts.append(host)
+    return hosts
+
+def repo_files(repo_dir):
+    """Lists the repo files to push, relative to repo_dir.
+
+    In a git checkout these are the tracked files as they are in the working
+    tree, so untracked and ignored files (generated caches, local secrets,
+    stray patches) stay on this machine. Otherwise every file is listed
+    except FLEET_EXCLUDE and FLEET_GENERATED.
+    """
+    git = find_tool("git")
+    if git and os.path.exists(os.path.join(repo_dir, ".git")):
+        result = run_command([git, "-C", repo_dir, "ls-files", "-z"], capture_output=True)
+        if result.returncode == 0:
+            names = result.stdout.decode("utf-8", "surrogateescape").split("\0")
+            # Tracked files deleted in the working tree are left out
+            return sorted(name for name in names if name and os.path.lexists(os.path.join(repo_dir, name)))
+        print(f"  ⚠️  git ls-files failed (exit {result.returncode}), pushing the whole tree instead")
+
+    files = []
+    for root, dirs, names in os.walk(repo_dir):
+        dirs[:] = sorted(d for d in dirs if d not in FLEET_EXCLUDE)
+        for name in sorted(names):
+            relative = os.path.relpath(os.path.join(root, name), repo_dir).replace(os.sep, "/")
+            if not FLEET_GENERATED.search(relative):
+                files.append(relative)
+    return files
+
+def build_repo_archive(repo_dir):
+    """Packs the files from repo_files into an in-memory tar.gz for pushing to hosts."""
+    buffer = io.BytesIO()
+    with tarfile.open(fileobj=buffer, mode="w:gz") as archive:
+        for name in repo_files(repo_dir):
+            archive.add(os.path.join(repo_dir, name), arcname=name, recursive=False)
+    return buffer.getvalue()
+
+def ssh_command(host, control_dir, ssh_options=()):
+    """Builds the ssh prefix for a host, sharing one master connection per host."""
+    command = ["ssh", "-o", "BatchMode=yes", "-o", "ControlMaster=auto",
+               "-o", f"ControlPath={control_dir}/%C", "-o", "ControlPersist=120"]
+    if host["port"]:
+        command += ["-p", host["port"]]
+    if host["identity"]:
+        command += ["-i", os.path.expanduser(host["identity"])]
+    for option in ssh_options:
+        command += ["-o", option]
+    return command + [host["target"]]
+
+def remote_path(path):
+    """Quotes a path for the remote shell, keeping a leading ~ expandable."""
+    if path == "~":
+        return '"$HOME"'
+    if path.startswith("~/"):
+        return '"$HOME"/' + shlex.quote(path[2:])
+    return shlex.quote(path)
+
+def _keeps_problem_lines(line):
+    return "❌" in line or "⚠️" in line
+
+def provision_host(host, archive, control_dir, ssh_options=(), remote_args=()):
+    """Pushes the repo to one host and runs install_packages.py there.
+
+    Returns a report dict with the host's status ("ok", "failed" or
+    "unreachable"), the time spent connecting, pushing and running, the
+    remote exit code and any problem lines the remote run printed.
+    """
+    start = time.perf_counter()
+    report = None
+    try:
+        report = _provision_host(host, archive, control_dir, ssh_options, remote_args)
+        return report
+    finally:
+        record_timing("host", host["name"], start, time.perf_counter(),
+                      exit_code=None if report is None else report["exit_code"])
+
+def _provision_host(host, archive, control_dir, ssh_options, remote_args):
+    name = host["name"]
+    ssh = ssh_command(host, control_dir, ssh_options)
+    report = {"host": name, "status": "unreachable", "exit_code": None,
+              "connect_seconds": None, "push_seconds": None, "run_seconds": None, "problems": []}
+
+    # Opening the master connection up front means the push and the run reuse it
+    start = time.perf_counter()
+    # Hosts run in parallel, so none of them may read the operator's stdin
+    result = run_command(ssh + ["true"], stdin=subprocess.DEVNULL, capture_output=True, text=True, timeout=60)
+    report["connect_seconds"] = time.perf_counter() - start
+    if result.returncode != 0:
+        report["problems"] = (result.stderr or "").strip().splitlines()[-3:]
+        print(f"[{name}] ❌ Could not connect: {' '.join(report['problems']) or f'exit {result.returncode}'}")
+        return report
+    print(f"[{name}] ✅ Connected in {report['connect_seconds']:.1f}s")
+
+    start = time.perf_counter()
+    remote_dir = host["dir"]
+    quoted_dir = remote_path(remote_dir)
+    result = run_command(ssh + [f"mkdir -p {quoted_dir} && tar -xzf - -C {quoted_dir}"],
+                         input=archive, capture_output=True, timeout=300)
+    report["push_seconds"] = time.perf_counter() - start
+    if result.returncode != 0:
+        report["status"] = "failed"
+        report["problems"] = result.stderr.decode(errors="replace").strip().splitlines()[-3:]
+        print(f"[{name}] ❌ Could not push the repo (exit {result.returncode})")
+        return report
+    print(f"[{name}] ✅ Pushed the repo to {remote_dir} in {report['push_seconds']:.1f}s")
+
+    start = time.perf_counter()
+    remote = (f"cd {quoted_dir} && {shlex.quote(host['python'])} install_packages.py "
+              + " ".join(shlex.quote(arg) for arg in remote_args))
+    # -n: the remote run gets /dev/null as stdin
+    result = stream_command(ssh[:1] + ["-n"] + ssh[1:] + [remote.strip()], step=f"fleet-{name}", label=name,
+                            keep=_keeps_problem_lines)
+    report["run_seconds"] = time.perf_counter() - start
+    report["exit_code"] = result.returncode
+    report["problems"] = [line.strip() for line in result.stdout.splitlines() if _keeps_problem_lines(line)]
+    report["log"] = result.log_path
+    report["status"] = "ok" if result.returncode == 0 else "failed"
+    icon = "✅" if result.returncode == 0 else "❌"
+    print(f"[{name}] {icon} install_packages.py exited with {result.returncode} after {report['run_seconds']:.1f}s")
+    return report
+
+def run_fleet(hosts, jobs=FLEET_JOBS, ssh_options=(), remote_args=(), repo_dir=None):
+    """Provisions every host in the inventory, at most jobs at a time, and returns their reports."""
+    repo_dir = repo_dir or os.path.dirname(os.path.abspath(__file__))
+    archive = build_repo_archive(repo_dir)
+    print(f"Provisioning {len(hosts)} host(s), {jobs} at a time ({len(archive) // 1024} KiB repo archive)...")
+
+    # A short path: ssh control sockets must fit in sun_path
+    control_dir = tempfile.mkdtemp(prefix="dotfiles-ssh-")
+    try:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, jobs)) as executor:
+            futures = [executor.submit(provision_host, host, archive, control_dir, ssh_options, remote_args)
+                       for host in hosts]
+            reports = []
+            for host, future in zip(hosts, futures):
+                try:
+                    reports.append(future.result())
+                except Exception as e:
+                    print(f"[{host['name']}] ❌ {e}")
+                    reports.append({"host": host["name"], "status": "failed", "exit_code": None,
+                                    "connect_seconds": None, "push_seconds": None, "run_seconds": None,
+                                    "problems": [str(e)]})
+    finally:
+        for host in hosts:
+            run_command(ssh_command(host, control_dir, ssh_options)[:-1] + ["-O", "exit", host["target"]],
+                        stdin=subprocess.DEVNULL, capture_output=True)
+        shutil.rmtree(control_dir, ignore_errors=True)
+    return reports
+
+def print_fleet_report(reports, elapsed):
+    """Prints one line per host plus totals."""
+    counts = collections.Counter(report["status"] for report in reports)
+    print(f"\nFleet report: {len(reports)} host(s), {counts['ok']} ok, {counts['failed']} failed, "
+          f"{counts['unreachable']} unreachable, {format_duration(elapsed)} total")
+    print(f"  {'Host':<28} {'Status':<12} {'Connect':>8} {'Push':>8} {'Run':>9} {'Exit':>5}")
+
+    def seconds(value):
+        return "-" if value is None else f"{value:.1f}s"
+
+    for report in reports:
+        exit_code = "-" if report["exit_code"] is None else str(report["exit_code"])
+        print(f"  {report['host']:<28} {report['status']:<12} {seconds(report['connect_seconds']):>8} "
+              f"{seconds(report['push_seconds']):>8} {seconds(report['run_seconds']):>9} {exit_code:>5}")
+        for problem in report["problems"][:5]:
+            print(f"      {problem}")
+
+def run_fleet_mode(args):
+    """Provisions the hosts in args.fleet and reports on them; returns the exit code."""
+    try:
+        hosts = read_inventory(args.fleet)
+    except (OSError, ValueError) as e:
+        print(f"❌ Could not read inventory: {e}")
+        return 1
+    if not hosts:
+        print(f"ℹ️  No hosts in {args.fleet}")
+        return 0
+
+    start = time.perf_counter()
+    reports = run_fleet(hosts, jobs=args.fleet_jobs, ssh_options=args.ssh_option,
+                        remote_args=shlex.split(args.remote_args))
+    elapsed = time.perf_counter() - start
+    print_fleet_report(reports, elapsed)
+    if args.fleet_report:
+        with open(args.fleet_report, "w", encoding="utf-8") as f:
+            json.dump({"elapsed_seconds": elapsed, "hosts": reports}, f, indent=2)
+        print(f"ℹ️  Wrote fleet report to {args.fleet_report}")
+    if args.profile_json:
+        write_profile_json(args.profile_json)
+    return 0 if all(report["status"] == "ok" for report in reports) else 1
+
+def main(argv=None):
+    """Main function to run the installation process.
+
+    Returns the process exit code: 1 if any stage (or, in --fleet mode, any
+    host) failed.
+    """
+    args = parse_args(argv)
+    exit_code = 0
 
-def main():
-    """Main function to run the installation process."""
     # Change to script directory to ensure we find packages.json
     script_dir = os.path.dirname(os.path.abspath(__file__))
     os.chdir(script_dir)
 
+    if args.refresh_shell_cache:
+        refresh_fish_init_cache(script_dir, force=args.force)
+        if find_tool("zsh") is not None:
+            build_zsh_startup(script_dir, force=args.force)
+        return
+
+    if args.links_only:
+        install_dotfile_links(backup=not args.keep_conflicts)
+        return
+
     try:
-        with open("packages.json", "r") as f:
-            config = json.load(f)
+        compiled = load_manifest("packages.json")
     except FileNotFoundError:
         print("Error: 'packages.json' not found.")
         print(f"Current directory: {os.getcwd()}")
         print("Make sure both install_packages.py and packages.json are in the same directory.")
         if sys.platform.startswith("win"):
             input("Press Enter to exit...")
+        return 1
+    except ManifestError as e:
+        print("❌ packages.json is invalid:")
+        for error in e.errors:
+            print(f"  - {error}")
+        return 1
+
+    if args.fleet:
+        return run_fleet_mode(args)
+
+    configure_downloads(offline=args.offline, mirror=args.mirror)
+    configure_package_cache(args.package_cache)
+    if args.fill_mirror:
+        print(f"Filling mirror {args.fill_mirror}...")
+        fill_mirror(args.fill_mirror)
         return
 
     os_key, package_manager = get_os_info()
 
-    if os_key and os_key in config:
-        os_config = config[os_key]
-
-        # Install packages via the standard package manager
-        if "pkg" in os_config:
-            if check_and_install_manager(package_manager):
-                install_with_manager(os_config["pkg"], package_manager)
-
-        # Install packages via Cargo
-        if "cargo" in os_config:
-            if check_and_install_cargo():
-                install_cargo_packages(os_config["cargo"])
-
-        # Install fish shell configuration if on macOS/Linux
-        if os_key in ["macOS", "Linux"]:
-            install_fish_config()
-
-        # Install oh-my-posh on Linux only
-        if os_key == "Linux" and "oh_my_posh" in os_config and os_config["oh_my_posh"]:
-            install_oh_my_posh_linux()
-
-        # Install FiraCode font for oh-my-posh on all platforms (after packages are installed)
-        omp_installed = False
-        if os_key == "Linux" and "oh_my_posh" in os_config and os_config["oh_my_posh"]:
-            omp_installed = True
-        elif os_key in ["macOS", "Windows"] and "pkg" in os_config:
-            # Check if oh-my-posh is in the package list
-            omp_packages = ["oh-my-posh", "JanDeDobbeleer.OhMyPosh"]
-            omp_installed = any(pkg in os_config["pkg"] for pkg in omp_packages)
-
-        if omp_installed:
-            font_success = install_omp_font(os_key)
-            if not font_success:
-                print("\n⚠️  Installation completed with issues: FiraCode font installation failed")
+    if os_key and os_key in compiled["os"]:
+        manifest = dict(compiled["os"][os_key], source_hash=compiled["source_hash"])
+        for note in compiled["notes"]:
+            if note.startswith(f"{os_key}.") and args.plan != "json":
+                print(f"ℹ️  {note}")
+
+        if args.plan:
+            plan = build_install_plan(os_key, package_manager, manifest,
+                                      state=load_state(args.state_file), force=args.force)
+            if args.plan == "json":
+                print(json.dumps(plan, indent=2))
             else:
-                print("\n✅ Installation process completed successfully!")
-
-            # Set up fish shell after everything is installed
-            if os_key in ["macOS", "Linux"]:
-                setup_fish_post_install(os_key)
+                print_install_plan(plan)
+            return
+
+        if args.verify:
+            healthy = run_verification(os_key, manifest, report_path=args.health_report,
+                                       timeout=args.verify_timeout)
+            return 0 if healthy else 1
+
+        lock = acquire_run_lock(args.state_file)
+        if lock is None:
+            print("ℹ️  Another install run is in progress, exiting")
+            return 1
+
+        state = None
+        if args.upgrade:
+            stages = build_upgrade_stages(package_manager, manifest, cargo_cpus=args.cargo_cpus)
+        else:
+            state = load_state(args.state_file)
+            stages = build_install_stages(os_key, package_manager, manifest, cargo_cpus=args.cargo_cpus,
+                                          state=state, force=args.force,
+                                          backup_conflicts=not args.keep_conflicts,
+                                          font_archive=args.font_archive)
+        results = run_stages(stages, jobs=args.jobs, lock_timeout=args.lock_timeout)
+        if failed_stages(stages, results):
+            exit_code = 1
+
+        # Checked after every stage, even failed ones, so a skipped stage can't
+        # hide a broken tool. Running it here rather than as a stage also means
+        # the stage threads are gone and the check processes can be forked.
+        # A run where every step was unchanged installed nothing, so it stays
+        # close to instant; --verify checks such a machine on demand.
+        if nothing_changed(state):
+            print("\nℹ️  Nothing changed since the last run, skipping the health check (use --verify to run it)")
+        elif not run_verification(os_key, manifest, report_path=args.health_report,
+                                  timeout=args.verify_timeout):
+            exit_code = 1
+
+        if args.upgrade:
+            if exit_code:
+                print("\n⚠️  Upgrade completed with issues")
+            else:
+                print("\n✅ Upgrade completed!")
+        elif "font" in results and not results["font"]:
+            print("\n⚠️  Installation completed with issues: FiraCode font installation failed")
+        elif exit_code:
+            print("\n⚠️  Installation completed with issues, see above")
+        elif "font" in results:
+            print("\n✅ Installation process completed successfully!")
         else:
             print("\n✅ Installation process completed!")
 
-            # Still try to set up fish even if oh-my-posh wasn't installed
-            if os_key in ["macOS", "Linux"]:
-                setup_fish_post_install(os_key)
+        print_timing_summary()
+        if args.profile_json:
+            write_profile_json(args.profile_json)
     else:
         print("Unsupported operating system or no package list found.")
+        exit_code = 1
 
     # On Windows, pause before closing when run directly
     if sys.platform.startswith("win"):
         input("Press Enter to exit...")
+    return exit_code
 
 if __name__ == "__main__":
-    main()
+    sys.exit(main())
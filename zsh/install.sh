@@ -1,3 +1,4 @@
-# http://www.thegeekstuff.com/2010/10/linux-ln-command-examples/
-# ln -s /full/path/of/original/file /full/path/of/soft/link/file
-ln -sf $HOME/dotfiles/zsh/zshrc.sh $HOME/.zshrc
+# Links ~/.zshrc and the other dotfiles through install_packages.py, which only
+# replaces links that differ and swaps each one in atomically
+dotfiles_dir="$(cd "$(dirname "$0")/.." && pwd)"
+python3 "$dotfiles_dir/install_packages.py" --links-only "$@"
@@ -4,11 +4,8 @@ export LC_CTYPE="en_GB.UTF-8"
 export LC_ALL="en_GB.UTF-8"
 export TERM="xterm-256color"
 
-# Check if zplug is installed
-if [[ ! -d ~/.zplug ]]; then
-	git clone https://github.com/zplug/zplug ~/.zplug
-	source ~/.zplug/init.zsh && zplug update --self
-fi
+# The repo checkout, wherever it is: ~/.zshrc links to zsh/zshrc.sh inside it
+DOTFILES_DIR="${${(%):-%x}:A:h:h}"
 
 if [ -f ~/.env ]; then
 	source ~/.env
@@ -16,7 +13,13 @@ if [ -f ~/.env ]; then
 fi
 
 # Essential
-source ~/.zplug/init.zsh
+# zplug and its plugins are installed by install_packages.py, never at startup
+if [[ -f ~/.zplug/init.zsh ]]; then
+	source ~/.zplug/init.zsh
+else
+	echo "zplug is not installed, run install_packages.py to set it up"
+	zplug() { : }
+fi
 
 # Sources
 if [ -f ~/.iterm2_shell_integration.`basename $SHELL` ]; then
@@ -124,8 +127,13 @@ precmd() {
 
 
 # Includes
-source ~/dotfiles/zsh/aliases.sh
-source ~/dotfiles/zsh/functions.sh
+source "$DOTFILES_DIR/zsh/aliases.sh"
+# Functions autoload from the cache built by install_packages.py when it exists
+if [[ -f "${XDG_CACHE_HOME:-$HOME/.cache}/dotfiles/zsh/functions.zsh" ]]; then
+	source "${XDG_CACHE_HOME:-$HOME/.cache}/dotfiles/zsh/functions.zsh"
+else
+	source "$DOTFILES_DIR/zsh/functions.sh"
+fi
 
 # Node
 export NPM_PACKAGES="${HOME}/.npm-packages"
@@ -205,7 +213,7 @@ if [[ -f ~/extras.sh ]]; then
 	source ~/extras.sh
 fi
 
-PATH=${PATH}:$HOME/dotfiles/bin
+PATH=${PATH}:$DOTFILES_DIR/bin
 
 if [ -d "$HOME/go/bin" ]; then
 	PATH=${PATH}:$HOME/go/bin
@@ -237,14 +245,9 @@ export ZSH_PLUGINS_ALIAS_TIPS_TEXT='💡 '
 
 # Add a bunch more of your favorite plugins!
 
-# Install plugins that have not been installed yet
-if ! zplug check --verbose; then
-	printf "Install? [y/N]: "
-	if read -q; then
-		echo; zplug install
-	else
-		echo
-	fi
+# Plugins are installed by install_packages.py so startup never clones anything
+if ! zplug check; then
+	echo "Some zplug plugins are missing, run install_packages.py to install them"
 fi
 
 zplug load